@@ -33,6 +33,8 @@
 # ANIm: uses MUMmer (NUCmer) to align the input sequences.
 # ANIb: uses BLASTN to align 1000nt fragments of the input sequences
 # TETRA: calculates tetranucleotide frequencies of each input sequence
+# ANIkmer: estimates ANI from the k-mers shared by the input sequences,
+#          without alignment (fast, for screening)
 #
 # This script takes as main input a directory containing a set of
 # correctly-formatted FASTA multiple sequence files. All sequences for a
@@ -56,6 +58,8 @@
 # TETRA: Tab-separated text file describing the Z-scores for each
 #        tetranucleotide in each input sequence.
 #
+# ANIkmer: no intermediate files.
+#
 # In addition, all methods produce a table of output percentage identity (ANIm
 # and ANIb) or correlation (TETRA), between each sequence.
 #
@@ -160,16 +164,18 @@ import pandas as pd
 import random
 import shutil
 import sys
-import tarfile
+import tempfile
 import time
 import traceback
 
 from argparse import ArgumentParser
 
-from pyani import (anib, anim, tetra, pyani_config, pyani_files,
-                   pyani_graphics, pyani_tools)
+from pyani import (anib, anikmer, anim, dereplicate, tetra, pyani_archive,
+                   pyani_backends, pyani_config, pyani_files, pyani_graphics,
+                   pyani_tools)
 from pyani import run_multiprocessing as run_mp
 from pyani import run_sge
+from pyani import sketch
 from pyani.pyani_config import params_mpl, ALIGNDIR, FRAGSIZE, TETRA_FILESTEMS
 from pyani import __version__ as VERSION
 
@@ -184,8 +190,19 @@ def parse_cmdline():
                         action="store", default=None, required=True,
                         help="Output directory (required)")
     parser.add_argument("-i", "--indir", dest="indirname",
-                        action="store", default=None, required=True,
-                        help="Input directory name (required)")
+                        action="store", default=None,
+                        help="Input directory name (required, unless "
+                        "--query_dir and --reference_dir are given; not "
+                        "to be used with them)")
+    parser.add_argument("--query_dir", dest="query_dirname",
+                        action="store", default=None,
+                        help="Directory of query sequences, each compared "
+                        "only with each sequence in --reference_dir, "
+                        "instead of all-vs-all (ANIm/ANIb/ANIkmer)")
+    parser.add_argument("--reference_dir", dest="reference_dirname",
+                        action="store", default=None,
+                        help="Directory of reference sequences, for use "
+                        "with --query_dir")
     parser.add_argument("-v", "--verbose", dest="verbose",
                         action="store_true", default=False,
                         help="Give verbose output")
@@ -214,6 +231,13 @@ def parse_cmdline():
     parser.add_argument("--nocompress", dest="nocompress",
                         action="store_true", default=False,
                         help="Don't compress/delete the comparison output")
+    parser.add_argument("--compression", dest="compression",
+                        action="store", default="gzip",
+                        choices=sorted(pyani_archive.ARCHIVE_SUFFIXES),
+                        help="Archive format for comparison output: gzip "
+                        "(.tar.gz), zstd (.tar.zst; needs zstandard) or zip "
+                        "(indexed, so single pairs can be extracted) "
+                        "(default gzip)")
     parser.add_argument("-g", "--graphics", dest="graphics",
                         action="store_true", default=False,
                         help="Generate heatmap of ANI")
@@ -233,23 +257,88 @@ def parse_cmdline():
                         help="Path to file containing sequence classes")
     parser.add_argument("-m", "--method", dest="method",
                         action="store", default="ANIm",
-                        choices=["ANIm", "ANIb", "ANIblastall", "TETRA"],
+                        choices=["ANIm", "ANIb", "ANIblastall", "TETRA",
+                                 "ANIkmer"],
                         help="ANI method (default ANIm)")
     parser.add_argument("--scheduler", dest="scheduler",
                         action="store", default="multiprocessing",
-                        choices=["multiprocessing", "SGE"],
+                        choices=["multiprocessing", "SGE", "SLURM"],
                         help="Job scheduler (default multiprocessing, i.e. locally)")
     parser.add_argument("--workers", dest="workers",
                         action="store", default=None, type=int,
                         help="Number of worker processes for multiprocessing "
                         "(default zero, meaning use all available cores)")
+    parser.add_argument("--threads", dest="threads",
+                        action="store", default=1, type=int,
+                        help="Most threads for each NUCmer/BLASTN job; "
+                        "jobs get threads in proportion to the product of "
+                        "their genome lengths, and are packed into the "
+                        "available cores "
+                        "(default 1; NUCmer threading needs MUMmer 4)")
+    parser.add_argument("--chunksize", dest="chunksize",
+                        action="store", default=1, type=int,
+                        help="Number of short jobs to run one after another "
+                        "as a single local/cluster job; 0 sizes batches from "
+                        "estimated job cost (default 1, no batching)")
+    parser.add_argument("--shard_outputs", dest="shard_outputs",
+                        action="store_true", default=False,
+                        help="Write pairwise NUCmer/BLAST output to hashed "
+                        "subdirectories of the output directory, for very "
+                        "large analyses")
+    parser.add_argument("--scratch", dest="scratch",
+                        action="store", default=None,
+                        help="Node-local directory (e.g. tmpfs) in which "
+                        "NUCmer/BLAST output is written and processed, "
+                        "before being moved to the output directory in bulk "
+                        "(multiprocessing scheduler only)")
+    parser.add_argument("--prefilter", dest="prefilter",
+                        action="store", default=None, type=float,
+                        help="Skip NUCmer/BLAST comparisons of pairs whose "
+                        "ANI, estimated from MinHash sketches, is below "
+                        "this fraction (e.g. 0.8); these are reported as "
+                        "not computed (default: compare all pairs)")
+    parser.add_argument("--dereplicate", dest="dereplicate",
+                        action="store", default=None, type=float,
+                        help="Greedily cluster genomes (ANIm only): each "
+                        "genome is compared only with current cluster "
+                        "representatives, and joins the first cluster "
+                        "with ANIm identity at or above this fraction "
+                        "(e.g. 0.95); writes cluster assignments, and "
+                        "results for representatives only")
+    parser.add_argument("--derep_coverage", dest="derep_coverage",
+                        action="store", default=0.0, type=float,
+                        help="Minimum alignment coverage of both genomes "
+                        "to join a cluster, with --dereplicate (default 0)")
+    parser.add_argument("--derep_order", dest="derep_order",
+                        action="store", default="size",
+                        help="Order in which genomes are considered as "
+                        "cluster representatives, with --dereplicate: "
+                        "'size' (largest first), 'input' (file name "
+                        "order), or the path to a file of genome names, "
+                        "one per line, in order of preference (e.g. by "
+                        "assembly quality) (default size)")
+    parser.add_argument("--nodedup", dest="nodedup",
+                        action="store_true", default=False,
+                        help="Compare every input genome, even if its "
+                        "sequences are identical to another's (default: "
+                        "compare each distinct genome once, and copy "
+                        "results to its duplicates)")
+    parser.add_argument("--max_memory", dest="max_memory",
+                        action="store", default=None, type=float,
+                        help="Memory budget (GB) for concurrent local jobs, "
+                        "estimated from genome sizes (default no limit)")
+    parser.add_argument("--memory_scale", dest="memory_scale",
+                        action="store", default=1.0, type=float,
+                        help="Multiply the per-base memory estimates of "
+                        "NUCmer/BLAST jobs used with --max_memory by this "
+                        "factor (default 1)")
     parser.add_argument("--SGEgroupsize", dest="sgegroupsize",
                         action="store", default=10000, type=int,
-                        help="Number of jobs to place in an SGE array group "
-                        "(default 10000)")
+                        help="Number of jobs to place in an SGE/SLURM array "
+                        "group (default 10000)")
     parser.add_argument("--SGEargs", dest="sgeargs",
                         action="store", default=None, type=str,
-                        help="Additional arguments for qsub")
+                        help="Additional arguments for qsub (or sbatch)")
     parser.add_argument("--maxmatch", dest="maxmatch",
                         action="store_true", default=False,
                         help="Override MUMmer to allow all NUCmer matches")
@@ -273,6 +362,15 @@ def parse_cmdline():
                         action="store",
                         default=pyani_config.FORMATDB_DEFAULT,
                         help="Path to BLAST formatdb executable")
+    parser.add_argument("--blastdb_cache", dest="blastdb_cache",
+                        action="store", default=None,
+                        help="Directory for reusable BLAST databases, keyed "
+                        "by genome content and tool version (ANIb, "
+                        "ANIblastall)")
+    parser.add_argument("--combined_blastdb", dest="combined_blastdb",
+                        action="store_true", default=False,
+                        help="Search each genome's fragments once against a "
+                        "single database of all genomes (ANIb only)")
     parser.add_argument("--write_excel", dest="write_excel",
                         action="store_true",
                         default=False,
@@ -334,7 +432,7 @@ def make_outdir():
         os.makedirs(args.outdirname)   # We make the directory recursively
         # Depending on the choice of method, a subdirectory will be made for
         # alignment output files
-        if args.method != 'TETRA':
+        if args.method in ALIGNDIR:
             os.makedirs(os.path.join(args.outdirname, ALIGNDIR[args.method]))
     except OSError:
         # This gets thrown if the directory exists. If we've forced overwrite/
@@ -346,24 +444,285 @@ def make_outdir():
             sys.exit(1)
 
 
+# Make a working directory for comparison output
+def make_workdir():
+    """Returns the directory under which comparison jobs write output.
+
+    This is the output directory, unless --scratch is given. In that case a
+    new directory (with the alignment output subdirectory for the method)
+    is made under the scratch path, and the comparison output written there
+    is moved to the output directory by stage_out().
+    """
+    if args.scratch is None:
+        return args.outdirname
+    workdir = tempfile.mkdtemp(prefix="pyani_", dir=args.scratch)
+    os.makedirs(os.path.join(workdir, ALIGNDIR[args.method]))
+    logger.info("Staging comparison output in %s", workdir)
+    return workdir
+
+
+# Move comparison output from scratch to the output directory
+def stage_out(workdir, paths):
+    """Moves the passed paths from the working directory to the output
+    directory, then removes the working directory.
+
+    - workdir - working directory, from make_workdir()
+    - paths - paths of output (e.g. archives, or the alignment output
+    directory) under workdir to keep
+
+    Does nothing if the working directory is the output directory.
+    """
+    if workdir == args.outdirname:
+        return
+    for path in paths:
+        dest = os.path.join(args.outdirname, os.path.relpath(path, workdir))
+        if os.path.isdir(dest) and not os.listdir(dest):
+            os.rmdir(dest)  # Placeholder made by make_outdir()
+        logger.info("Moving %s to %s", path, dest)
+        shutil.move(path, dest)
+    logger.info("Removing staging directory %s", workdir)
+    shutil.rmtree(workdir)
+
+
+# Keep comparison output from a failed run on scratch
+def rescue_workdir(workdir, alndir, archive=None):
+    """Moves any comparison output left in the working directory to the
+    output directory, then removes the working directory.
+
+    - workdir - working directory, from make_workdir()
+    - alndir - alignment output directory under workdir
+    - archive - pyani_archive.Archive for alndir, if one was opened
+
+    Called whether or not the comparisons succeeded. Does nothing if the
+    working directory is the output directory, or has already been staged
+    out. Otherwise, output of the comparisons that completed is kept; if it
+    cannot be moved, the working directory is left in place and its path
+    logged.
+    """
+    if workdir == args.outdirname or not os.path.isdir(workdir):
+        return
+    logger.error("Comparisons did not complete; keeping output from %s",
+                 workdir)
+    paths = [alndir] + ([] if archive is None else [archive.path])
+    try:
+        stage_out(workdir, [path for path in paths if os.path.exists(path)])
+    except (OSError, shutil.Error):
+        logger.error("Could not move comparison output: it remains in %s",
+                     workdir)
+        logger.error(last_exception())
+
+
+# Open an archive for comparison output, unless not compressing
+def open_output_archive(outdir):
+    """Returns a pyani_archive.Archive for the passed output directory, or
+    None if output is not to be compressed.
+
+    Output files are added to the archive as they are read, so compression
+    runs alongside result processing.
+    """
+    if args.nocompress:
+        return None
+    return pyani_archive.Archive(outdir, args.compression, args.workers)
+
+
 # Compress output directory and delete it
-def compress_delete_outdir(outdir):
-    """Compress the contents of the passed directory to .tar.gz and delete."""
-    # Compress output in .tar.gz file and remove raw output
-    tarfn = outdir + '.tar.gz'
-    logger.info("\tCompressing output from %s to %s", outdir, tarfn)
-    with tarfile.open(tarfn, "w:gz") as fh:
-        fh.add(outdir)
+def compress_delete_outdir(outdir, archive=None):
+    """Compress the contents of the passed directory and delete it.
+
+    - outdir - path to output directory
+    - archive - pyani_archive.Archive already holding some of the output
+    (default: a new archive in the --compression format)
+    """
+    if archive is None:
+        archive = pyani_archive.Archive(outdir, args.compression,
+                                        args.workers)
+    logger.info("\tCompressing output from %s to %s", outdir, archive.path)
+    archive.add_tree()
+    archive.close()
     logger.info("\tRemoving output directory %s", outdir)
     shutil.rmtree(outdir)
 
 
+# Convert the --max_memory budget to bytes
+def get_memory_budget():
+    """Returns the local job memory budget in bytes, or None if unlimited.
+
+    Job memory estimates are scaled by --memory_scale, by dividing the
+    budget by that factor.
+    """
+    if args.max_memory is None:
+        return None
+    return int(args.max_memory * 1024 ** 3 / args.memory_scale)
+
+
+# Get the scheduler backend for cluster runs
+def get_cluster_backend():
+    """Returns the pyani_backends backend for the chosen cluster scheduler."""
+    if args.scheduler == "SLURM":
+        return pyani_backends.SLURMBackend()
+    return pyani_backends.SGEBackend()
+
+
+# Get the names of reference sequences from their paths
+def get_reference_names(references):
+    """Returns the list of names for the passed reference files, or None.
+
+    - references - paths to each reference file, or None (all-vs-all)
+    """
+    if references is None:
+        return None
+    return [os.path.splitext(os.path.split(fname)[-1])[0] for
+            fname in references]
+
+
+# Find input genomes with sequences identical to another's
+def get_duplicates(digests, infiles, references=None):
+    """Returns dictionary of representative genomes, keyed by duplicate.
+
+    - digests - dictionary of sequence content digests, keyed by genome,
+    from pyani_files.get_sequence_lengths() (None with --nodedup, when
+    digests are not computed)
+    - infiles - paths to each input file
+    - references - paths to each reference file (optional)
+
+    Duplicates are found among the input (query) genomes, and among the
+    reference genomes, separately: a query identical to a reference is
+    still compared with it. If --nodedup is given, the dictionary is empty.
+    """
+    if args.nodedup:
+        return {}
+    duplicates = {}
+    for fnames in (infiles, references or []):
+        names = [os.path.splitext(os.path.split(fname)[-1])[0] for
+                 fname in fnames]
+        duplicates.update(pyani_files.get_duplicates(
+            {name: digests[name] for name in names}))
+    if duplicates:
+        logger.info("Skipping %d duplicate input genomes:\n%s",
+                    len(duplicates),
+                    os.linesep.join(["\t%s: identical to %s" % (dup, org)
+                                     for dup, org in
+                                     sorted(duplicates.items())]))
+    return duplicates
+
+
+# Remove duplicate genomes from a list of input files
+def drop_duplicates(fnames, duplicates):
+    """Returns the passed list of files, without duplicate genomes.
+
+    - fnames - paths to input files, or None
+    - duplicates - dictionary of representative genomes, keyed by duplicate
+    """
+    if fnames is None:
+        return None
+    return [fname for fname in fnames if
+            os.path.splitext(os.path.split(fname)[-1])[0] not in duplicates]
+
+
+# Find pairs of input genomes too distant to compare
+def get_pruned_pairs(infiles, references=None):
+    """Returns the set of pairs of input genomes not to compare.
+
+    - infiles - paths to each input file
+    - references - paths to each reference file (optional)
+
+    If --prefilter is given, each pair with estimated ANI below that value
+    (see pyani.sketch) is returned, as a frozenset of the two genome names.
+    Otherwise, the set is empty.
+    """
+    if args.prefilter is None:
+        return set()
+    if references is None:
+        ncomps = len(infiles) * (len(infiles) - 1) // 2
+    else:
+        ncomps = len(infiles) * len(references)
+    sketchfiles = infiles + (references or [])
+    logger.info("Sketching %d input files", len(sketchfiles))
+    sketches = sketch.get_sketches(sketchfiles, workers=args.workers)
+    pruned = sketch.get_pruned_pairs(sketches, args.prefilter,
+                                     references=get_reference_names(
+                                         references))
+    logger.info("Skipping %d of %d comparisons with estimated ANI < %.3f",
+                len(pruned), ncomps, args.prefilter)
+    return pruned
+
+
+# Mark comparisons skipped by --prefilter as not computed
+def mark_not_computed(results, pruned):
+    """Mark each of the passed pairs as not computed in ANIResults.
+
+    - results - ANIResults object
+    - pruned - set of pairs of genome names, from get_pruned_pairs()
+    """
+    for pair in pruned:
+        results.add_not_computed(*sorted(pair))
+
+
+# Run jobs locally, with multiprocessing
+def run_local_jobs(jobs):
+    """Runs the passed jobs with multiprocessing, returning the summed exit
+    codes.
+
+    - jobs - iterable of Jobs, which may have dependencies
+
+    Jobs are run as a stream, as they are generated, unless they are to be
+    batched (--chunksize), which needs the whole job graph.
+    """
+    if args.chunksize == 1:
+        return run_mp.run_job_stream(jobs, workers=args.workers,
+                                     logger=logger,
+                                     memory=get_memory_budget())
+    return run_mp.run_dependency_graph(list(jobs), workers=args.workers,
+                                       logger=logger,
+                                       memory=get_memory_budget(),
+                                       chunksize=args.chunksize)
+
+
+# Run NUCmer jobs with the chosen scheduler
+def run_nucmer_jobs(joblist, jobprefix=None):
+    """Runs the passed NUCmer jobs, returning the summed exit codes.
+
+    - joblist - iterable of Jobs, from anim.iter_nucmer_jobs()
+    - jobprefix - prefix for cluster job array names (default:
+    args.jobprefix)
+    """
+    if args.scheduler == 'multiprocessing':
+        logger.info("Running jobs with multiprocessing")
+        if args.workers is None:
+            logger.info("(using maximum number of available " +
+                        "worker threads)")
+        else:
+            logger.info("(using %d worker threads, if available)",
+                        args.workers)
+        cumval = run_local_jobs(joblist)
+        logger.info("Cumulative return value: %d", cumval)
+        if 0 < cumval:
+            logger.warning("At least one NUCmer comparison failed. " +
+                           "ANIm may fail.")
+        else:
+            logger.info("All multiprocessing jobs complete.")
+    else:
+        logger.info("Running jobs with %s", args.scheduler)
+        logger.info("Jobarray group size set to %d", args.sgegroupsize)
+        cumval = run_sge.run_job_stream(
+            joblist, logger=logger, jgprefix=jobprefix or args.jobprefix,
+            sgegroupsize=args.sgegroupsize, sgeargs=args.sgeargs,
+            chunksize=args.chunksize, backend=get_cluster_backend())
+        logger.info("Cumulative return value: %d", cumval)
+        if 0 < cumval:
+            logger.warning("At least one NUCmer comparison failed. " +
+                           "ANIm may fail.")
+    return cumval
+
+
 # Calculate ANIm for input
-def calculate_anim(infiles, org_lengths):
+def calculate_anim(infiles, org_lengths, references=None):
     """Returns ANIm result dataframes for files in input directory.
 
     - infiles - paths to each input file
     - org_lengths - dictionary of input sequence lengths, keyed by sequence
+    - references - paths to each reference file; if given, infiles are
+    queries, and each is compared only with each reference
 
     Finds ANI by the ANIm method, as described in Richter et al (2009)
     Proc Natl Acad Sci USA 106: 19126-19131 doi:10.1073/pnas.0906412106.
@@ -383,68 +742,175 @@ def calculate_anim(infiles, org_lengths):
     """
     logger.info("Running ANIm")
     logger.info("Generating NUCmer command-lines")
-    deltadir = os.path.join(args.outdirname, ALIGNDIR['ANIm'])
+    workdir = args.outdirname if args.skip_nucmer else make_workdir()
+    deltadir = os.path.join(workdir, ALIGNDIR['ANIm'])
     logger.info("Writing nucmer output to %s", deltadir)
-    # Schedule NUCmer runs
-    if not args.skip_nucmer:
-        joblist = anim.generate_nucmer_jobs(infiles, args.outdirname,
+    pruned = get_pruned_pairs(infiles, references)
+    archive = None
+    try:
+        # Schedule NUCmer runs
+        if not args.skip_nucmer:
+            # Jobs are generated as the scheduler consumes them
+            joblist = anim.iter_nucmer_jobs(infiles, workdir,
                                             nucmer_exe=args.nucmer_exe,
                                             filter_exe=args.filter_exe,
                                             maxmatch=args.maxmatch,
-                                            jobprefix=args.jobprefix)
-        if args.scheduler == 'multiprocessing':
-            logger.info("Running jobs with multiprocessing")
-            if args.workers is None:
-                logger.info("(using maximum number of available " +
-                            "worker threads)")
-            else:
-                logger.info("(using %d worker threads, if available)",
-                            args.workers)
-            cumval = run_mp.run_dependency_graph(joblist,
-                                                 workers=args.workers, 
-                                                 logger=logger)
-            logger.info("Cumulative return value: %d", cumval)
-            if 0 < cumval:
-                logger.warning("At least one NUCmer comparison failed. " +
-                               "ANIm may fail.")
-            else:
-                logger.info("All multiprocessing jobs complete.")
+                                            jobprefix=args.jobprefix,
+                                            threads=args.threads,
+                                            lengths=org_lengths,
+                                            shard=args.shard_outputs,
+                                            manifest=True, skip=pruned,
+                                            references=references)
+            cumval = run_nucmer_jobs(joblist)
         else:
-            logger.info("Running jobs with SGE")
-            logger.info("Jobarray group size set to %d", args.sgegroupsize)
-            run_sge.run_dependency_graph(joblist,
-                                         logger=logger,
-                                         jgprefix=args.jobprefix,
-                                         sgegroupsize=args.sgegroupsize,
-                                         sgeargs=args.sgeargs)
-    else:
-        logger.warning("Skipping NUCmer run (as instructed)!")
-
-    # Process resulting .delta files
-    logger.info("Processing NUCmer .delta files.")
-    results = anim.process_deltadir(deltadir, org_lengths, logger=logger)
-    if results.zero_error:  # zero percentage identity error
-        if not args.skip_nucmer and args.scheduler == 'multiprocessing':
-            if 0 < cumval:
-                logger.error("This has possibly been a NUCmer run failure, " +
-                             "please investigate")
-                logger.error(last_exception())
-                sys.exit(1)
-            else:
-                logger.error("This is possibly due to a NUCmer comparison " +
-                             "being too distant for use. Please consider " +
-                             "using the --maxmatch option.")
-                logger.error("This is alternatively due to NUCmer run " +
-                             "failure, analysis will continue, but please " +
-                             "investigate.")
-    if not args.nocompress:
-        logger.info("Compressing/deleting %s", deltadir)
-        compress_delete_outdir(deltadir)
+            logger.warning("Skipping NUCmer run (as instructed)!")
+
+        # Process resulting .delta files
+        logger.info("Processing NUCmer .delta files.")
+        archive = open_output_archive(deltadir)
+        results = anim.process_deltadir(deltadir, org_lengths, logger=logger,
+                                        archive=archive,
+                                        references=get_reference_names(
+                                            references))
+        mark_not_computed(results, pruned)
+        if results.zero_error:  # zero percentage identity error
+            if not args.skip_nucmer and args.scheduler == 'multiprocessing':
+                if 0 < cumval:
+                    logger.error("This has possibly been a NUCmer run " +
+                                 "failure, please investigate")
+                    logger.error(last_exception())
+                    sys.exit(1)
+                else:
+                    logger.error("This is possibly due to a NUCmer " +
+                                 "comparison being too distant for use. " +
+                                 "Please consider using the --maxmatch " +
+                                 "option.")
+                    logger.error("This is alternatively due to NUCmer run " +
+                                 "failure, analysis will continue, but " +
+                                 "please investigate.")
+        if not args.nocompress:
+            logger.info("Compressing/deleting %s", deltadir)
+            compress_delete_outdir(deltadir, archive)
+        stage_out(workdir, [deltadir if archive is None else archive.path])
+    finally:
+        rescue_workdir(workdir, deltadir, archive)
 
     # Return processed data from .delta files
     return results
 
 
+# Order genomes for dereplication
+def get_derep_order(infiles, org_lengths):
+    """Returns input genome names in order of preference as representatives.
+
+    - infiles - paths to each input file
+    - org_lengths - dictionary of input sequence lengths, keyed by sequence
+
+    The order is set by --derep_order: largest genome first ('size'), file
+    name order ('input'), or the order of names in a file. Genomes not
+    named in the file follow, largest first.
+    """
+    names = [os.path.splitext(os.path.split(fname)[-1])[0] for
+             fname in infiles]
+    if args.derep_order == "input":
+        return names
+    bysize = sorted(names, key=lambda name: (-org_lengths[name], name))
+    if args.derep_order == "size":
+        return bysize
+    with open(args.derep_order, 'r') as ifh:
+        preferred = [line.strip() for line in ifh if line.strip() in
+                     org_lengths]
+    preferred = list(dict.fromkeys(preferred))  # First mention only
+    return preferred + [name for name in bysize if name not in
+                        set(preferred)]
+
+
+# Dereplicate input genomes with ANIm
+def dereplicate_anim(infiles, org_lengths):
+    """Returns (clusters, results) from greedy ANIm dereplication.
+
+    - infiles - paths to each input file
+    - org_lengths - dictionary of input sequence lengths, keyed by sequence
+
+    Genomes are clustered by dereplicate.dereplicate(), in the order given
+    by get_derep_order(). NUCmer jobs are built, for each batch of genomes
+    against the current representatives, by anim.iter_nucmer_jobs(), and
+    run with the chosen scheduler; each batch holds one genome per worker
+    (--workers, or one per core).
+
+    Returns the cluster members keyed by representative, and ANIm results
+    for the representatives against each other.
+    """
+    logger.info("Dereplicating %d genomes with ANIm (identity >= %.3f, " +
+                "coverage >= %.3f)", len(infiles), args.dereplicate,
+                args.derep_coverage)
+    workdir = make_workdir()
+    deltadir = os.path.join(workdir, ALIGNDIR['ANIm'])
+    logger.info("Writing nucmer output to %s", deltadir)
+    paths = {os.path.splitext(os.path.split(fname)[-1])[0]: fname for
+             fname in infiles}
+    rounds, compared = [], []
+    archive = None
+    try:
+
+        def compare(queries, references=None):
+            """Run NUCmer comparisons, yielding the parsed alignments."""
+            rounds.append(len(rounds))
+            jobprefix = "%s_%d" % (args.jobprefix, rounds[-1])
+            joblist = anim.iter_nucmer_jobs(
+                [paths[name] for name in queries], workdir,
+                nucmer_exe=args.nucmer_exe, filter_exe=args.filter_exe,
+                maxmatch=args.maxmatch, jobprefix=jobprefix,
+                threads=args.threads, lengths=org_lengths,
+                shard=args.shard_outputs, manifest=True,
+                references=None if references is None else
+                [paths[name] for name in references])
+            run_nucmer_jobs(joblist, jobprefix)
+            # The manifest lists only the output of this round's jobs
+            for qname, sname, deltafile in pyani_files.get_pairwise_outputs(
+                    deltadir, '.filter', org_lengths, logger):
+                compared.append(deltafile)
+                yield (qname, sname) + anim.parse_delta(deltafile)
+
+        batchsize = args.workers or os.cpu_count() or 1
+        clusters, results = dereplicate.dereplicate(
+            get_derep_order(infiles, org_lengths), org_lengths, compare,
+            args.dereplicate, args.derep_coverage, batchsize, logger)
+        logger.info("Found %d clusters, with %d comparisons", len(clusters),
+                    len(compared))
+        archive = open_output_archive(deltadir)
+        if not args.nocompress:
+            logger.info("Compressing/deleting %s", deltadir)
+            compress_delete_outdir(deltadir, archive)
+        stage_out(workdir, [deltadir if archive is None else archive.path])
+    finally:
+        rescue_workdir(workdir, deltadir, archive)
+    return clusters, results
+
+
+# Write dereplication cluster assignments
+def write_clusters(clusters, duplicates):
+    """Write genome cluster assignments to the output directory.
+
+    - clusters - cluster members, keyed by representative, from
+    dereplicate_anim()
+    - duplicates - dictionary of representative genomes, keyed by duplicate
+
+    Each genome is listed with the representative of its cluster, as an
+    Excel-format file (if args.write_excel is True) and plain text
+    tab-separated file.
+    """
+    logger.info("Writing %d clusters to %s", len(clusters),
+                args.outdirname)
+    dfr = pd.DataFrame(dereplicate.get_cluster_table(clusters, duplicates),
+                       columns=["genome", "representative"])
+    dfr = dfr.set_index("genome")
+    stem = os.path.join(args.outdirname, pyani_config.DEREP_FILESTEM)
+    if args.write_excel:
+        dfr.to_excel(stem + '.xlsx', index=True)
+    dfr.to_csv(stem + '.tab', index=True, sep="\t")
+
+
 # Calculate TETRA for input
 def calculate_tetra(infiles):
     """Calculate TETRA for files in input directory.
@@ -478,12 +944,37 @@ def calculate_tetra(infiles):
     return tetra_correlations
 
 
+# Calculate ANIkmer for input
+def calculate_anikmer(infiles, org_lengths, references=None):
+    """Returns ANIkmer result dataframes for files in input directory.
+
+    - infiles - paths to each input file
+    - org_lengths - dictionary of input sequence lengths, keyed by sequence
+    - references - paths to each reference file; if given, infiles are
+    queries, and each is compared only with each reference
+
+    Estimates ANI from the containment of each sequence's k-mers in each
+    other sequence, using scaled k-mer sketches (see pyani.anikmer). No
+    alignment is carried out, so no comparison output is written.
+    """
+    logger.info("Running ANIkmer")
+    sketchfiles = infiles + (references or [])
+    logger.info("Sketching %d input files", len(sketchfiles))
+    sketches = anikmer.get_sketches(sketchfiles, workers=args.workers)
+    logger.info("Estimating ANI from shared k-mers")
+    return anikmer.process_sketches(sketches, org_lengths,
+                                    references=get_reference_names(
+                                        references))
+
+
 # Calculate ANIb for input
-def unified_anib(infiles, org_lengths):
+def unified_anib(infiles, org_lengths, references=None):
     """Calculate ANIb for files in input directory.
 
     - infiles - paths to each input file
     - org_lengths - dictionary of input sequence lengths, keyed by sequence
+    - references - paths to each reference file; if given, infiles are
+    queries, whose fragments are searched only against each reference
 
     Calculates ANI by the ANIb method, as described in Goris et al. (2007)
     Int J Syst Evol Micr 57: 81-91. doi:10.1099/ijs.0.64483-0. There are
@@ -512,79 +1003,118 @@ def unified_anib(infiles, org_lengths):
     output directory in plain text tab-separated format.
     """
     logger.info("Running %s", args.method)
-    blastdir = os.path.join(args.outdirname, ALIGNDIR[args.method])
+    workdir = args.outdirname if args.skip_blastn else make_workdir()
+    blastdir = os.path.join(workdir, ALIGNDIR[args.method])
     logger.info("Writing BLAST output to %s", blastdir)
-    # Build BLAST databases and run pairwise BLASTN
-    if not args.skip_blastn:
-        # Make sequence fragments
-        logger.info("Fragmenting input files, and writing to %s",
-                    args.outdirname)
-        # Fraglengths does not get reused with BLASTN
-        fragfiles, fraglengths = anib.fragment_fasta_files(infiles,
-                                                           blastdir,
-                                                           args.fragsize)
-        # Export fragment lengths as JSON, in case we re-run with --skip_blastn
-        with open(os.path.join(blastdir,
-                               'fraglengths.json'), 'w') as outfile:
-            json.dump(fraglengths, outfile)
-
-        # Which executables are we using?
-        #if args.method == "ANIblastall":
-        #    format_exe = args.formatdb_exe
-        #    blast_exe = args.blastall_exe
-        #else:
-        #    format_exe = args.makeblastdb_exe
-        #    blast_exe = args.blastn_exe
-
-        # Run BLAST database-building and executables from a jobgraph
-        logger.info("Creating job dependency graph")
-        jobgraph = anib.make_job_graph(infiles, fragfiles,
-                                       anib.make_blastcmd_builder(args.method,
-                                                                  blastdir))
-        #jobgraph = anib.make_job_graph(infiles, fragfiles, blastdir,
-        #                               format_exe, blast_exe, args.method,
-        #                               jobprefix=args.jobprefix)
-        if args.scheduler == 'multiprocessing':
-            logger.info("Running jobs with multiprocessing")
-            logger.info("Running job dependency graph")
-            cumval = run_mp.run_dependency_graph(jobgraph,
-                                                 logger=logger)
-            if 0 < cumval:
-                logger.warning("At least one BLAST run failed. " +
-                               "%s may fail.", args.method)
-            else:
-                logger.info("All multiprocessing jobs complete.")
-        else:
-            run_sge.run_dependency_graph(jobgraph, logger=logger)
-            logger.info("Running jobs with SGE")
-    else:
-        # Import fragment lengths from JSON
-        if args.method == "ANIblastall":
-            with open(os.path.join(blastdir, 'fraglengths.json'),
-                      'rU') as infile:
-                fraglengths = json.load(infile)
-        else:
-            fraglengths = None
-        logger.warning("Skipping BLASTN runs (as instructed)!")
-
-    # Process pairwise BLASTN output
-    logger.info("Processing pairwise %s BLAST output.", args.method)
+    pruned = get_pruned_pairs(infiles, references)
+    archive = None
     try:
-        data = anib.process_blast(blastdir, org_lengths,
-                                  fraglengths=fraglengths, mode=args.method)
-    except ZeroDivisionError:
-        logger.error("One or more BLAST output files has a problem.")
+        # Build BLAST databases and run pairwise BLASTN
         if not args.skip_blastn:
-            if 0 < cumval:
-                logger.error("This is possibly due to BLASTN run failure, " +
-                             "please investigate")
+            # Make sequence fragments
+            logger.info("Fragmenting input files, and writing to %s",
+                        blastdir)
+            # Fraglengths does not get reused with BLASTN
+            fragfiles, fraglengths = anib.fragment_fasta_files(infiles,
+                                                               blastdir,
+                                                               args.fragsize)
+            # Export fragment lengths as JSON, in case we re-run with
+            # --skip_blastn
+            with open(os.path.join(blastdir,
+                                   'fraglengths.json'), 'w') as outfile:
+                json.dump(fraglengths, outfile)
+
+            # Which executables are we using?
+            #if args.method == "ANIblastall":
+            #    format_exe = args.formatdb_exe
+            #    blast_exe = args.blastall_exe
+            #else:
+            #    format_exe = args.makeblastdb_exe
+            #    blast_exe = args.blastn_exe
+
+            # Run BLAST database-building and executables from a jobgraph
+            logger.info("Creating job dependency graph")
+            blastcmds = anib.make_blastcmd_builder(args.method, blastdir,
+                                                   threads=args.threads,
+                                                   shard=args.shard_outputs)
+            if args.combined_blastdb:
+                logger.info("Searching a single combined BLAST database")
+                jobgraph = anib.make_combined_job_graph(infiles, fragfiles,
+                                                        blastcmds,
+                                                        lengths=org_lengths)
             else:
-                logger.error("This is possibly due to a BLASTN comparison " +
-                             "being too distant for use.")
-        logger.error(last_exception())
-    if not args.nocompress:
-        logger.info("Compressing/deleting %s", blastdir)
-        compress_delete_outdir(blastdir)
+                if args.blastdb_cache:
+                    logger.info("Using BLAST database cache %s",
+                                args.blastdb_cache)
+                jobgraph = anib.iter_job_graph(infiles, fragfiles, blastcmds,
+                                               cachedir=args.blastdb_cache,
+                                               lengths=org_lengths,
+                                               manifest=True, skip=pruned,
+                                               references=references)
+            #jobgraph = anib.make_job_graph(infiles, fragfiles, blastdir,
+            #                               format_exe, blast_exe, args.method,
+            #                               jobprefix=args.jobprefix)
+            if args.scheduler == 'multiprocessing':
+                logger.info("Running jobs with multiprocessing")
+                logger.info("Running job dependency graph")
+                cumval = run_local_jobs(jobgraph)
+                if 0 < cumval:
+                    logger.warning("At least one BLAST run failed. " +
+                                   "%s may fail.", args.method)
+                else:
+                    logger.info("All multiprocessing jobs complete.")
+            else:
+                logger.info("Running jobs with %s", args.scheduler)
+                cumval = run_sge.run_job_stream(
+                    jobgraph, logger=logger, jgprefix=args.jobprefix,
+                    sgegroupsize=args.sgegroupsize, sgeargs=args.sgeargs,
+                    chunksize=args.chunksize, backend=get_cluster_backend())
+                if 0 < cumval:
+                    logger.warning("At least one BLAST run failed. " +
+                                   "%s may fail.", args.method)
+                else:
+                    logger.info("All %s jobs complete.", args.scheduler)
+            if args.blastdb_cache and not args.combined_blastdb:
+                count = anib.cache_blastdbs(references or infiles, blastcmds,
+                                            args.blastdb_cache)
+                logger.info("Added %d BLAST databases to cache %s", count,
+                            args.blastdb_cache)
+        else:
+            # Import fragment lengths from JSON
+            if args.method == "ANIblastall":
+                with open(os.path.join(blastdir, 'fraglengths.json'),
+                          'rU') as infile:
+                    fraglengths = json.load(infile)
+            else:
+                fraglengths = None
+            logger.warning("Skipping BLASTN runs (as instructed)!")
+
+        # Process pairwise BLASTN output
+        logger.info("Processing pairwise %s BLAST output.", args.method)
+        archive = open_output_archive(blastdir)
+        try:
+            data = anib.process_blast(
+                blastdir, org_lengths, fraglengths=fraglengths,
+                mode=args.method, archive=archive,
+                references=get_reference_names(references),
+                shard=args.shard_outputs)
+            mark_not_computed(data, pruned)
+        except ZeroDivisionError:
+            logger.error("One or more BLAST output files has a problem.")
+            if not args.skip_blastn:
+                if 0 < cumval:
+                    logger.error("This is possibly due to BLASTN run " +
+                                 "failure, please investigate")
+                else:
+                    logger.error("This is possibly due to a BLASTN " +
+                                 "comparison being too distant for use.")
+            logger.error(last_exception())
+        if not args.nocompress:
+            logger.info("Compressing/deleting %s", blastdir)
+            compress_delete_outdir(blastdir, archive)
+        stage_out(workdir, [blastdir if archive is None else archive.path])
+    finally:
+        rescue_workdir(workdir, blastdir, archive)
 
     # Return processed BLAST data
     return data
@@ -632,7 +1162,8 @@ def draw(filestems, gformat):
         fullstem = os.path.join(args.outdirname, filestem)
         outfilename = fullstem + '.%s' % gformat
         infilename = fullstem + '.tab'
-        df = pd.read_csv(infilename, index_col=0, sep="\t")
+        # Comparisons skipped by --prefilter are drawn as zero
+        df = pd.read_csv(infilename, index_col=0, sep="\t").fillna(0)
         logger.info("Writing heatmap to %s", outfilename)
         params = pyani_graphics.Params(params_mpl(df)[filestem],
                                        pyani_tools.get_labels(args.labels),
@@ -721,10 +1252,24 @@ if __name__ == '__main__':
     logger.info("command-line: %s", ' '.join(sys.argv))
 
     # Have we got an input and output directory? If not, exit.
-    if args.indirname is None:
+    if (args.query_dirname is None) != (args.reference_dirname is None):
+        logger.error("--query_dir and --reference_dir must be used " +
+                     "together (exiting)")
+        sys.exit(1)
+    if args.query_dirname is not None and args.indirname is not None:
+        logger.error("-i/--indir cannot be used with --query_dir and " +
+                     "--reference_dir (exiting)")
+        sys.exit(1)
+    if args.query_dirname is not None:
+        indirnames = [args.query_dirname, args.reference_dirname]
+        logger.info("Query directory: %s", args.query_dirname)
+        logger.info("Reference directory: %s", args.reference_dirname)
+    elif args.indirname is None:
         logger.error("No input directory name (exiting)")
         sys.exit(1)
-    logger.info("Input directory: %s", args.indirname)
+    else:
+        indirnames = [args.indirname]
+        logger.info("Input directory: %s", args.indirname)
     if args.outdirname is None:
         logger.error("No output directory name (exiting)")
         sys.exit(1)
@@ -735,7 +1280,9 @@ if __name__ == '__main__':
 
     # Check for the presence of space characters in any of the input filenames
     # or output directory. If we have any, abort here and now.
-    filenames = [args.outdirname] + os.listdir(args.indirname)
+    filenames = [args.outdirname]
+    for indirname in indirnames:
+        filenames += os.listdir(indirname)
     for fname in filenames:
         if ' ' in  os.path.abspath(fname):
             logger.error("File or directory '%s' contains whitespace", fname)
@@ -743,6 +1290,60 @@ if __name__ == '__main__':
             logger.error("(exiting)")
             sys.exit(1)
 
+    if args.combined_blastdb and args.method != "ANIb":
+        logger.error("--combined_blastdb can only be used with ANIb")
+        sys.exit(1)
+
+    if args.query_dirname is not None:
+        if args.method == "TETRA":
+            logger.error("--query_dir cannot be used with TETRA")
+            sys.exit(1)
+        if args.combined_blastdb:
+            logger.error("--query_dir cannot be used with --combined_blastdb")
+            sys.exit(1)
+
+    if args.scratch is not None:
+        if args.method not in ALIGNDIR:
+            logger.error("--scratch can only be used with ANIm and ANIb")
+            sys.exit(1)
+        if args.scheduler != "multiprocessing":
+            logger.error("--scratch can only be used with the " +
+                         "multiprocessing scheduler")
+            sys.exit(1)
+        if not os.path.isdir(args.scratch):
+            logger.error("Missing scratch directory: %s", args.scratch)
+            sys.exit(1)
+
+    if args.prefilter is not None:
+        if args.method not in ALIGNDIR:
+            logger.error("--prefilter can only be used with ANIm and ANIb")
+            sys.exit(1)
+        if args.combined_blastdb:
+            logger.error("--prefilter cannot be used with --combined_blastdb")
+            sys.exit(1)
+
+    if args.dereplicate is not None:
+        if args.method != "ANIm":
+            logger.error("--dereplicate can only be used with ANIm")
+            sys.exit(1)
+        if args.query_dirname is not None or args.skip_nucmer or \
+                args.prefilter is not None:
+            logger.error("--dereplicate cannot be used with --query_dir, " +
+                         "--skip_nucmer or --prefilter")
+            sys.exit(1)
+        if args.derep_order not in ("size", "input") and \
+                not os.path.isfile(args.derep_order):
+            logger.error("Missing genome order file: %s", args.derep_order)
+            sys.exit(1)
+
+    if args.memory_scale <= 0:
+        logger.error("--memory_scale must be positive")
+        sys.exit(1)
+
+    if args.compression == "zstd" and pyani_archive.zstandard is None:
+        logger.error("--compression zstd needs the zstandard package")
+        sys.exit(1)
+
     if args.labels and not os.path.isfile(args.labels):
         logger.error("Missing labels file: %s", args.labels)
         sys.exit(1)
@@ -757,7 +1358,9 @@ if __name__ == '__main__':
                "ANIb": (unified_anib, pyani_config.ANIB_FILESTEMS),
                "TETRA": (calculate_tetra, pyani_config.TETRA_FILESTEMS),
                "ANIblastall": (unified_anib,
-                               pyani_config.ANIBLASTALL_FILESTEMS)}
+                               pyani_config.ANIBLASTALL_FILESTEMS),
+               "ANIkmer": (calculate_anikmer,
+                           pyani_config.ANIKMER_FILESTEMS)}
     if args.method not in methods:
         logger.error("ANI method %s not recognised (exiting)", args.method)
         logger.error("Valid methods are: %s", list(methods.keys()))
@@ -770,7 +1373,7 @@ if __name__ == '__main__':
         logger.warning("Producing graphics with no new recalculations")
     else:
         # Have we got a valid scheduler choice?
-        schedulers = ["multiprocessing", "SGE"]
+        schedulers = ["multiprocessing", "SGE", "SLURM"]
         if args.scheduler not in schedulers:
             logger.error("scheduler %s not recognised (exiting)",
                          args.scheduler)
@@ -778,9 +1381,17 @@ if __name__ == '__main__':
             sys.exit(1)
         logger.info("Using scheduler method: %s", args.scheduler)
         
-        # Get input files
-        logger.info("Identifying FASTA files in %s", args.indirname)
-        infiles = pyani_files.get_fasta_files(args.indirname)
+        # Get input files: queries and references are kept separately, and
+        # only compared with each other
+        indirname, references = args.indirname, None
+        if args.query_dirname is not None:
+            logger.info("Identifying FASTA files in %s",
+                        args.reference_dirname)
+            references = pyani_files.get_fasta_files(args.reference_dirname)
+            logger.info("Reference files:\n\t%s", '\n\t'.join(references))
+            indirname = args.query_dirname
+        logger.info("Identifying FASTA files in %s", indirname)
+        infiles = pyani_files.get_fasta_files(indirname)
         logger.info("Input files:\n\t%s", '\n\t'.join(infiles))
 
         # Are we subsampling? If so, make the selection here
@@ -788,20 +1399,45 @@ if __name__ == '__main__':
             infiles = subsample_input(infiles)
             logger.info("Sampled input files:\n\t%s", '\n\t'.join(infiles))
 
-        # Get lengths of input sequences
+        # Get lengths of input sequences, and their digests unless not
+        # deduplicating
         logger.info("Processing input sequence lengths")
-        org_lengths = pyani_files.get_sequence_lengths(infiles)
+        digests = None if args.nodedup else {}
+        org_lengths = pyani_files.get_sequence_lengths(infiles +
+                                                       (references or []),
+                                                       digests)
+        if references is not None and \
+                len(org_lengths) < len(infiles) + len(references):
+            logger.error("Query and reference sequence names must be " +
+                         "distinct (exiting)")
+            sys.exit(1)
         logger.info("Sequence lengths:\n" +
                     os.linesep.join(["\t%s: %d" % (k, v) for
                                      k, v in list(org_lengths.items())]))
 
+        # Compare each distinct genome only once
+        duplicates = get_duplicates(digests, infiles, references)
+        infiles = drop_duplicates(infiles, duplicates)
+        references = drop_duplicates(references, duplicates)
+        org_lengths = {org: length for org, length in org_lengths.items() if
+                       org not in duplicates}
+
         # Run appropriate method on the contents of the input directory,
         # and write out corresponding results.
         logger.info("Carrying out %s analysis", args.method)
-        if args.method == "TETRA":
+        # Results of each distinct genome are copied to its duplicates,
+        # except when dereplicating: duplicates then join the cluster of the
+        # genome they duplicate, and results are for representatives only
+        if args.dereplicate is not None:
+            clusters, results = dereplicate_anim(infiles, org_lengths)
+            write_clusters(clusters, duplicates)
+        elif args.method == "TETRA":
             results = methods[args.method][0](infiles)
+            results = pyani_tools.expand_duplicates(results, duplicates)
         else:
-            results = methods[args.method][0](infiles, org_lengths)
+            results = methods[args.method][0](infiles, org_lengths,
+                                              references)
+            results.add_duplicates(duplicates)
         write(results)
 
     # Do we want graphical output?
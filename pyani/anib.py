@@ -83,8 +83,14 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import hashlib
+import json
 import os
+import re
 import shutil
+import subprocess
+
+from functools import lru_cache
 
 import pandas as pd
 
@@ -93,7 +99,11 @@ from Bio import SeqIO
 from . import pyani_config
 from . import pyani_files
 from . import pyani_jobs
-from .pyani_tools import ANIResults, BLASTcmds, BLASTexes, BLASTfunctions
+from .pyani_tools import (BLASTcmds, BLASTexes, BLASTfunctions,
+                          get_ani_results)
+
+# Name under which BLAST database files are stored in the cache
+BLASTDB_CACHE_STEM = "db"
 
 
 # Divide input FASTA sequences into fragments
@@ -163,21 +173,221 @@ def get_fragment_lengths(fastafile):
 
 
 # Create dictionary of database building commands, keyed by dbname
-def build_db_jobs(infiles, blastcmds):
-    """Returns dictionary of db-building commands, keyed by dbname."""
+def build_db_jobs(infiles, blastcmds, cachedir=None, lengths=None):
+    """Returns dictionary of db-building commands, keyed by dbname.
+
+    - infiles - paths to each input sequence file
+    - blastcmds - BLASTcmds object for construction of commands
+    - cachedir - path to persistent BLAST database cache (optional)
+    - lengths - dictionary of sequence lengths, keyed by organism (optional)
+
+    If a cache directory is given, input files whose database is already
+    in the cache are linked into the output directory, and no database
+    construction job is created for them.
+    """
     dbjobdict = {}  # Dict of database construction jobs, keyed by filename
     # Create dictionary of database building jobs, keyed by db name
     # defining jobnum for later use as last job index used
     for idx, fname in enumerate(infiles):
-        dbjobdict[blastcmds.get_db_name(fname)] = \
-                pyani_jobs.Job("%s_db_%06d" % (blastcmds.prefix, idx),
-                               blastcmds.build_db_cmd(fname))
+        if cachedir is not None:
+            dbname = os.path.join(blastcmds.outdir, os.path.split(fname)[-1])
+            cached = get_cached_blastdb(cachedir, fname,
+                                        blastcmds.exes.format_exe)
+            if len(cached):
+                link_cached_blastdb(cached, dbname)
+                continue
+        dbcmd, dbname = blastcmds.build_db(fname)
+        dbjobdict[dbname] = pyani_jobs.Job("%s_db_%06d" %
+                                           (blastcmds.prefix, idx), dbcmd,
+                                           cost=get_blast_cost(fname,
+                                                               lengths=lengths))
     return dbjobdict
 
 
+# Estimate the relative cost of a BLAST job
+def get_blast_cost(fname1, fname2=None, lengths=None):
+    """Returns estimated relative cost of a BLAST job on the passed files.
+
+    - fname1 - path to (fragmented) query or database FASTA file
+    - fname2 - path to (fragmented) subject FASTA file (optional)
+    - lengths - dictionary of sequence lengths, keyed by organism
+
+    A pairwise search is costed as the product of the two genome lengths,
+    and a single-genome job (database construction, or a search against a
+    combined database) as the genome length. Returns zero if no lengths
+    are given.
+    """
+    if lengths is None:
+        return 0
+    cost = 1
+    for fname in [fname for fname in (fname1, fname2) if fname is not None]:
+        stem = os.path.splitext(os.path.split(fname)[-1])[0]
+        cost *= lengths[stem.replace('-fragments', '')]
+    return cost
+
+
+# Estimate the memory used by a BLAST job
+def get_blast_memory(fnames, lengths=None):
+    """Returns estimated memory use (bytes) of a BLAST job on passed files.
+
+    - fnames - paths to the (fragmented) query and database FASTA files
+    - lengths - dictionary of sequence lengths, keyed by organism
+
+    Memory is estimated as pyani_config.BLASTN_MEMORY_PER_BASE bytes for
+    each base of query and database sequence. Returns zero if no lengths
+    are given.
+    """
+    if lengths is None:
+        return 0
+    stems = [os.path.splitext(os.path.split(fname)[-1])[0] for
+             fname in fnames]
+    return pyani_config.BLASTN_MEMORY_PER_BASE * \
+        sum([lengths[stem.replace('-fragments', '')] for stem in stems])
+
+
+# Get the version string of the BLAST database formatting tool
+@lru_cache(maxsize=None)
+def get_blastdb_tool_version(format_exe):
+    """Returns version string reported by the passed makeblastdb/formatdb.
+
+    - format_exe - path to the database formatting executable
+
+    Legacy formatdb has no -version option. If the executable does not
+    report a version, the string identifies it by its path and
+    modification time instead, so that the cache is still partitioned by
+    tool, and invalidated when the tool is replaced. If it cannot be found
+    at all, its path is returned.
+    """
+    try:
+        result = subprocess.run([format_exe, '-version'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+    except OSError:
+        result = None
+    if result is not None and result.returncode == 0:
+        lines = result.stdout.decode('utf-8', 'replace').strip().split('\n')
+        if lines[0].strip():
+            return lines[0].strip()
+    exepath = shutil.which(format_exe)
+    if exepath is None:
+        return format_exe
+    exepath = os.path.realpath(exepath)
+    return "%s %d" % (exepath, os.stat(exepath).st_mtime_ns)
+
+
+# Get the BLAST database cache key for an input file
+def get_blastdb_cache_key(filename, format_exe):
+    """Returns cache key for the BLAST database built from the passed file.
+
+    - filename - path to input FASTA file
+    - format_exe - path to the database formatting executable
+
+    The key is the SHA-256 digest of the file contents together with the
+    version of the database formatting tool, so that a database is rebuilt
+    if either changes.
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as ifh:
+        for block in iter(lambda: ifh.read(1 << 20), b''):
+            digest.update(block)
+    digest.update(get_blastdb_tool_version(format_exe).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# Get paths to cached BLAST database files for an input file
+def get_cached_blastdb(cachedir, filename, format_exe):
+    """Returns list of cached database files for the passed input file.
+
+    - cachedir - path to persistent BLAST database cache
+    - filename - path to input FASTA file
+    - format_exe - path to the database formatting executable
+
+    Cached databases are stored as <cachedir>/<key>/<BLASTDB_CACHE_STEM>.*,
+    whatever the name of the file they were built from, so that the same
+    sequence supplied under another name also finds them; an empty list is
+    returned if there is no cached database for the file.
+    """
+    keydir = os.path.join(cachedir,
+                          get_blastdb_cache_key(filename, format_exe))
+    if not os.path.isdir(keydir):
+        return []
+    stem = BLASTDB_CACHE_STEM + '.'
+    return sorted([os.path.join(keydir, fname) for fname in
+                   os.listdir(keydir) if fname.startswith(stem)])
+
+
+# Symlink cached BLAST database files into the output directory
+def link_cached_blastdb(cachedfiles, dbname):
+    """Symlinks cached database files so that they are found as dbname.
+
+    - cachedfiles - paths to database files in the cache
+    - dbname - database path that BLAST commands will use
+
+    Each cached <BLASTDB_CACHE_STEM>.<ext> file is linked as dbname.<ext>.
+    """
+    for cachedfile in cachedfiles:
+        linkname = dbname + \
+            os.path.split(cachedfile)[-1][len(BLASTDB_CACHE_STEM):]
+        if os.path.lexists(linkname):
+            os.remove(linkname)
+        os.symlink(os.path.abspath(cachedfile), linkname)
+
+
+# Copy newly-built BLAST databases into the cache
+def cache_blastdbs(infiles, blastcmds, cachedir):
+    """Copies BLAST databases built in the output directory to the cache.
+
+    - infiles - paths to each input sequence file
+    - blastcmds - BLASTcmds object used to build the databases
+    - cachedir - path to persistent BLAST database cache
+
+    Returns the number of databases added to the cache. Database files
+    are stored under a fixed name (see get_cached_blastdb()), and are
+    copied to a temporary directory that is renamed into place, so that
+    concurrent runs never see a partially-written cache entry.
+    """
+    os.makedirs(cachedir, exist_ok=True)
+    count = 0
+    for fname in infiles:
+        keydir = os.path.join(cachedir,
+                              get_blastdb_cache_key(fname,
+                                                    blastcmds.exes.format_exe))
+        if os.path.isdir(keydir):
+            if any(dbfname.startswith(BLASTDB_CACHE_STEM + '.') for
+                   dbfname in os.listdir(keydir)):
+                continue
+            shutil.rmtree(keydir, ignore_errors=True)  # Old cache layout
+        basename = os.path.split(fname)[-1]
+        dbfiles = [dbfname for dbfname in os.listdir(blastcmds.outdir) if
+                   dbfname.startswith(basename + '.')]
+        dbfiles = [dbfname for dbfname in dbfiles if
+                   os.path.isfile(os.path.join(blastcmds.outdir, dbfname)) and
+                   not os.path.islink(os.path.join(blastcmds.outdir,
+                                                   dbfname))]
+        if not len(dbfiles):
+            continue
+        tmpdir = keydir + '.tmp.%d' % os.getpid()
+        os.makedirs(tmpdir, exist_ok=True)
+        for dbfname in dbfiles:
+            shutil.copy(os.path.join(blastcmds.outdir, dbfname),
+                        os.path.join(tmpdir, BLASTDB_CACHE_STEM +
+                                     dbfname[len(basename):]))
+        try:
+            os.rename(tmpdir, keydir)
+        except OSError:  # Another run cached this database first
+            shutil.rmtree(tmpdir)
+            continue
+        count += 1
+    return count
+
+
 def make_blastcmd_builder(mode, outdir, format_exe=None, blast_exe=None,
-                          prefix="ANIBLAST"):
-    """Returns BLASTcmds object for construction of BLAST commands."""
+                          prefix="ANIBLAST", threads=1, shard=False):
+    """Returns BLASTcmds object for construction of BLAST commands.
+
+    If shard is True, pairwise BLAST output is written to hashed shard
+    subdirectories of outdir (see pyani_files.get_shard()).
+    """
     if mode == "ANIb":  # BLAST/formatting executable depends on mode
         blastcmds = BLASTcmds(BLASTfunctions(construct_makeblastdb_cmd,
                                              construct_blastn_cmdline),
@@ -185,7 +395,7 @@ def make_blastcmd_builder(mode, outdir, format_exe=None, blast_exe=None,
                                         pyani_config.MAKEBLASTDB_DEFAULT,
                                         blast_exe or \
                                         pyani_config.BLASTN_DEFAULT),
-                              prefix, outdir)
+                              prefix, outdir, threads, shard)
     else:
         blastcmds = BLASTcmds(BLASTfunctions(construct_formatdb_cmd,
                                              construct_blastall_cmdline),
@@ -193,16 +403,25 @@ def make_blastcmd_builder(mode, outdir, format_exe=None, blast_exe=None,
                                         pyani_config.FORMATDB_DEFAULT,
                                         blast_exe or \
                                         pyani_config.BLASTALL_DEFAULT),
-                              prefix, outdir)
+                              prefix, outdir, threads, shard)
     return blastcmds
 
 
 # Make a dependency graph of BLAST commands
-def make_job_graph(infiles, fragfiles, blastcmds):
+def make_job_graph(infiles, fragfiles, blastcmds, cachedir=None,
+                   lengths=None, manifest=False, skip=None,
+                   references=None):
     """Return a job dependency graph, based on the passed input sequence files.
 
     - infiles - a list of paths to input FASTA files
     - fragfiles - a list of paths to fragmented input FASTA files
+    - cachedir - path to persistent BLAST database cache (optional)
+    - lengths - dictionary of sequence lengths, keyed by organism (optional)
+    - manifest - write a manifest of the expected output files (see
+    iter_job_graph())
+    - skip - set of pairs of organisms (as frozensets) not to compare
+    - references - a list of paths to reference FASTA files (see
+    iter_job_graph())
 
     By default, will run ANIb - it *is* possible to make a mess of passing the
     wrong executable for the mode you're using.
@@ -210,38 +429,238 @@ def make_job_graph(infiles, fragfiles, blastcmds):
     All items in the returned graph list are BLAST executable jobs that must
     be run *after* the corresponding database creation. The Job objects
     corresponding to the database creation are contained as dependencies.
-    How those jobs are scheduled depends on the scheduler (see
+    Where a database was found in the cache, there is no such dependency.
+    If sequence lengths are given, each Job's cost and memory use are
+    estimated from them (see get_blast_cost(), get_blast_memory()). How
+    those jobs are scheduled depends on the scheduler (see
     run_multiprocessing.py, run_sge.py)
     """
-    joblist = []    # Holds list of job dependency graphs
-
-    # Get dictionary of database-building jobs
-    dbjobdict = build_db_jobs(infiles, blastcmds)
-
-    # Create list of BLAST executable jobs, with dependencies
-    jobnum = len(dbjobdict)
-    for idx, fname1 in enumerate(fragfiles[:-1]):
-        for fname2 in fragfiles[idx+1:]:
-            jobnum += 1
-            jobs = \
-                [pyani_jobs.Job("%s_exe_%06d_a" %
-                                (blastcmds.prefix, jobnum),
-                                blastcmds.build_blast_cmd(fname1,
-                                                          fname2.replace\
-                                                          ('-fragments', ''))),
-                 pyani_jobs.Job("%s_exe_%06d_b" %
-                                (blastcmds.prefix, jobnum),
-                                blastcmds.build_blast_cmd(fname2,
-                                                          fname1.replace\
-                                                          ('-fragments', '')))]
-            jobs[0].add_dependency(dbjobdict[fname1.replace('-fragments', '')])
-            jobs[1].add_dependency(dbjobdict[fname2.replace('-fragments', '')])
-            joblist.extend(jobs)
-
-    # Return the dependency graph
+    return list(iter_job_graph(infiles, fragfiles, blastcmds, cachedir,
+                               lengths, manifest, skip, references))
+
+
+# Generate the BLAST jobs of a dependency graph on demand
+def iter_job_graph(infiles, fragfiles, blastcmds, cachedir=None,
+                   lengths=None, manifest=False, skip=None,
+                   references=None):
+    """Yield the BLAST jobs of a job dependency graph, one at a time.
+
+    - infiles - a list of paths to input FASTA files
+    - fragfiles - a list of paths to fragmented input FASTA files
+    - cachedir - path to persistent BLAST database cache (optional)
+    - lengths - dictionary of sequence lengths, keyed by organism (optional)
+    - manifest - write a manifest of the expected output files
+    - skip - set of pairs of organisms (as frozensets) not to compare, e.g.
+    from sketch.get_pruned_pairs()
+    - references - a list of paths to reference FASTA files; if given,
+    infiles and fragfiles are queries, and the fragments of each query are
+    searched only against the database of each reference
+
+    The jobs are those returned by make_job_graph(), in the same order. The
+    database-building jobs (one per input file) are created up front, but
+    each pair of BLAST jobs is only created when requested, so that a
+    runner consuming the jobs as a stream (see
+    run_multiprocessing.run_job_stream(), run_sge.run_job_stream()) can
+    start work without building the whole graph.
+
+    If manifest is True, the .blast_tab output expected from each BLAST job
+    is recorded, as the job is generated, in the pyani_config.MANIFEST file
+    of the BLAST output directory, for process_blast().
+    """
+    # Get dictionary of database-building jobs: in query-vs-reference mode,
+    # only the references are searched
+    dbfiles = infiles if references is None else references
+    dbjobdict = build_db_jobs(dbfiles, blastcmds, cachedir, lengths)
+
+    manifest_fh = None
+    if manifest:
+        manifest_fh = open(os.path.join(blastcmds.outdir,
+                                        pyani_config.MANIFEST), 'w')
+    try:
+        for job in iter_blast_jobs(fragfiles, blastcmds, dbjobdict,
+                                   len(dbfiles), lengths, manifest_fh,
+                                   skip, references):
+            yield job
+    finally:
+        if manifest_fh is not None:
+            manifest_fh.close()
+
+
+# Generate pairwise BLAST jobs
+def iter_blast_jobs(fragfiles, blastcmds, dbjobdict, jobnum=0, lengths=None,
+                    manifest_fh=None, skip=None, references=None):
+    """Yield BLAST jobs for each pair of fragmented input files.
+
+    - fragfiles - a list of paths to fragmented input FASTA files
+    - blastcmds - BLASTcmds object for construction of BLAST commands
+    - dbjobdict - dictionary of database-building Jobs, keyed by database
+    - jobnum - jobs are numbered from jobnum + 1
+    - lengths - dictionary of sequence lengths, keyed by organism (optional)
+    - manifest_fh - open manifest file, to record output files (optional)
+    - skip - set of pairs of organisms (as frozensets) not to compare
+    - references - a list of paths to reference FASTA files (optional)
+
+    By default, each pair of input files is searched in both directions
+    (two jobs). If references are given, the fragments of each query are
+    only searched against the database of each reference (one job).
+
+    If lengths are given, pairs are generated in decreasing order of
+    estimated cost (see get_blast_cost()), so the largest searches start
+    first, and each search is given threads in proportion to its cost (see
+    pyani_jobs.get_job_threads()), up to blastcmds.threads.
+    """
+    stems = {fname: os.path.splitext(os.path.split(fname)[-1])[0].replace(
+        '-fragments', '') for fname in fragfiles + (references or [])}
+
+    sizes, maxcost = None, 0
+    if lengths is not None:
+        sizes = {fname: lengths[stem] for fname, stem in stems.items()}
+        largest = next(pyani_files.iter_pairs(fragfiles, references, sizes),
+                       None)
+        if largest is not None:
+            maxcost = get_blast_cost(largest[0], largest[1], lengths)
+
+    # Create BLAST executable jobs, with dependencies
+    for fname1, fname2 in pyani_files.iter_pairs(fragfiles, references,
+                                                 sizes):
+        if skip and frozenset((stems[fname1], stems[fname2])) in skip:
+            continue
+        jobnum += 1
+        if references is None:
+            searches = ((fname1, fname2.replace('-fragments', '')),
+                        (fname2, fname1.replace('-fragments', '')))
+        else:
+            searches = ((fname1, os.path.join(blastcmds.outdir,
+                                              os.path.split(fname2)[-1])),)
+        cost = get_blast_cost(fname1, fname2, lengths)
+        threads = pyani_jobs.get_job_threads(cost, maxcost,
+                                             blastcmds.threads)
+        for suffix, (query, dbname) in zip('ab', searches):
+            job = pyani_jobs.Job("%s_exe_%06d_%s" %
+                                 (blastcmds.prefix, jobnum, suffix),
+                                 blastcmds.build_blast_cmd(query, dbname,
+                                                           threads),
+                                 threads=threads)
+            job.cost = cost
+            job.memory = get_blast_memory([fname1, fname2], lengths)
+            # Each BLAST job depends on the database it searches
+            if dbname in dbjobdict:
+                job.add_dependency(dbjobdict[dbname])
+            if manifest_fh is not None:
+                write_blast_manifest_line(manifest_fh, blastcmds, query,
+                                          dbname)
+            yield job
+
+
+# Record the output of a BLAST job in a manifest
+def write_blast_manifest_line(manifest_fh, blastcmds, fname, dbname):
+    """Writes the manifest line for a search of dbname with query fname.
+
+    - manifest_fh - open manifest file, in the BLAST output directory
+    - blastcmds - BLASTcmds object used to build the search's command
+    - fname - fragmented query FASTA filename
+    - dbname - BLAST database filename
+    """
+    qname = os.path.splitext(os.path.split(fname)[-1])[0]
+    qname = qname.replace('-fragments', '')
+    sname = os.path.splitext(os.path.split(dbname)[-1])[0]
+    outfile = os.path.join(blastcmds.get_blast_outdir(fname, dbname),
+                           "%s_vs_%s.blast_tab" % (qname, sname))
+    pyani_files.write_manifest_line(manifest_fh, qname, sname,
+                                    os.path.relpath(outfile,
+                                                    blastcmds.outdir))
+
+
+# Write all input sequences to a single FASTA file for a combined database
+def write_combined_fasta(infiles, outdirname):
+    """Writes all input sequences to one FASTA file, returns its path.
+
+    - infiles - paths to each input sequence file
+    - outdirname - path to output directory
+
+    Each sequence is renamed gNNNNNN_MMMMMM, where NNNNNN is the index of
+    its input file, so that BLAST subject IDs can be mapped back to the
+    genome they came from. The genome names, in index order, are written
+    to COMBINED_GENOMES in the output directory.
+    """
+    outfname = os.path.join(outdirname, pyani_config.COMBINED_DB + '.fna')
+    genomes = []
+    with open(outfname, 'w') as ofh:
+        for gidx, fname in enumerate(infiles):
+            genomes.append(os.path.splitext(os.path.split(fname)[-1])[0])
+            for sidx, seq in enumerate(SeqIO.parse(fname, 'fasta')):
+                seq.id = "g%06d_%06d" % (gidx, sidx)
+                seq.description = ''
+                SeqIO.write(seq, ofh, 'fasta')
+    with open(os.path.join(outdirname,
+                           pyani_config.COMBINED_GENOMES), 'w') as ofh:
+        json.dump(genomes, ofh)
+    return outfname
+
+
+# Make a dependency graph of BLAST commands against a combined database
+def make_combined_job_graph(infiles, fragfiles, blastcmds, lengths=None):
+    """Return a job dependency graph searching one combined BLAST database.
+
+    - infiles - a list of paths to input FASTA files
+    - fragfiles - a list of paths to fragmented input FASTA files
+    - blastcmds - BLASTcmds object for construction of commands (ANIb only)
+    - lengths - dictionary of sequence lengths, keyed by organism (optional)
+
+    Rather than one BLASTN job per ordered pair of genomes, the fragments
+    of each genome are searched once against a single database built from
+    all input genomes, so there are n BLASTN jobs rather than n(n-1). Each
+    BLASTN job depends on the single database construction job. The output
+    is split into pairwise .blast_tab files by process_blast().
+
+    BLAST scales E-values by database size, so each search is run with the
+    size of the smallest genome as its database size (see
+    get_combined_dbsize()), and split_combined_blast() rescales E-values to
+    each subject genome's size before applying the pairwise E-value
+    threshold.
+    """
+    if lengths is None:
+        lengths = pyani_files.get_sequence_lengths(infiles)
+    combined = write_combined_fasta(infiles, blastcmds.outdir)
+    dbsize = get_combined_dbsize(
+        [os.path.splitext(os.path.split(fname)[-1])[0] for fname in infiles],
+        lengths)
+    dbcmd, dbname = construct_makeblastdb_cmd(combined, blastcmds.outdir,
+                                              blastcmds.exes.format_exe)
+    dbjob = pyani_jobs.Job("%s_db_%06d" % (blastcmds.prefix, 0),
+                           dbcmd + " -parse_seqids")
+    ntargets = sum([1 for fname in infiles for _ in
+                    SeqIO.parse(fname, 'fasta')])
+    joblist = []
+    for idx, fname in enumerate(fragfiles):
+        job = pyani_jobs.Job("%s_exe_%06d" % (blastcmds.prefix, idx + 1),
+                             construct_blastn_combined_cmdline(
+                                 fname, dbname, blastcmds.outdir, ntargets,
+                                 dbsize, blastcmds.exes.blast_exe,
+                                 blastcmds.threads),
+                             threads=blastcmds.threads,
+                             cost=get_blast_cost(fname, lengths=lengths),
+                             memory=get_blast_memory([fname] + infiles,
+                                                     lengths))
+        job.add_dependency(dbjob)
+        joblist.append(job)
     return joblist
 
 
+# Get the database size used for searches against a combined database
+def get_combined_dbsize(genomes, lengths):
+    """Returns the database size (bases) for combined-database searches.
+
+    - genomes - names of the genomes in the combined database
+    - lengths - dictionary of sequence lengths, keyed by organism
+
+    This is the size of the smallest genome, so that E-values are no
+    larger than those of a pairwise search against any one genome, and no
+    hit that a pairwise search would report is lost.
+    """
+    return min([lengths[genome] for genome in genomes])
+
+
 # Generate list of makeblastdb command lines from passed filenames
 def generate_blastdb_commands(filenames, outdir, blastdb_exe=None,
                               mode="ANIb"):
@@ -333,30 +752,70 @@ def generate_blastn_commands(filenames, outdir, blast_exe=None, mode="ANIb"):
 
 # Generate single BLASTN command line
 def construct_blastn_cmdline(fname1, fname2, outdir,
-                             blastn_exe=pyani_config.BLASTN_DEFAULT):
+                             blastn_exe=pyani_config.BLASTN_DEFAULT,
+                             threads=1):
     """Returns a single blastn command.
 
     - filename - input filename
     - blastn_exe - path to BLASTN executable
+    - threads - number of threads for BLASTN (-num_threads)
     """
     fstem1 = os.path.splitext(os.path.split(fname1)[-1])[0]
     fstem2 = os.path.splitext(os.path.split(fname2)[-1])[0]
     fstem1 = fstem1.replace('-fragments', '')
     prefix = os.path.join(outdir, "%s_vs_%s" % (fstem1, fstem2))
     cmd = "{0} -out {1}.blast_tab -query {2} -db {3} " +\
-        "-xdrop_gap_final 150 -dust no -evalue 1e-15 " +\
+        "-xdrop_gap_final 150 -dust no -evalue {4} " +\
         "-max_target_seqs 1 -outfmt '6 qseqid sseqid length mismatch " +\
         "pident nident qlen slen qstart qend sstart send positive " +\
         "ppos gaps' -task blastn"
-    return cmd.format(blastn_exe, prefix, fname1, fname2)
+    if threads > 1:
+        cmd += " -num_threads %d" % threads
+    return cmd.format(blastn_exe, prefix, fname1, fname2,
+                      pyani_config.BLASTN_EVALUE)
+
+
+# Generate single BLASTN command line against a combined database
+def construct_blastn_combined_cmdline(fname, dbname, outdir, ntargets,
+                                      dbsize,
+                                      blastn_exe=pyani_config.BLASTN_DEFAULT,
+                                      threads=1):
+    """Returns a single blastn command against a combined database.
+
+    - fname - fragmented query FASTA filename
+    - dbname - path to the combined BLAST database
+    - ntargets - number of sequences in the combined database
+    - dbsize - effective database size (-dbsize), from get_combined_dbsize()
+    - blastn_exe - path to BLASTN executable
+    - threads - number of threads for BLASTN (-num_threads)
+
+    All database sequences may be reported, so that the best hit to each
+    subject genome is available; output is written to
+    <query>.blast_combined. The E-value and bit score of each hit are added
+    to the pairwise output columns, for split_combined_blast().
+    """
+    fstem = os.path.splitext(os.path.split(fname)[-1])[0]
+    fstem = fstem.replace('-fragments', '')
+    prefix = os.path.join(outdir, fstem)
+    cmd = "{0} -out {1}.blast_combined -query {2} -db {3} " +\
+        "-xdrop_gap_final 150 -dust no -evalue {5} -dbsize {6} " +\
+        "-max_target_seqs {4} -outfmt '6 qseqid sseqid length mismatch " +\
+        "pident nident qlen slen qstart qend sstart send positive " +\
+        "ppos gaps evalue bitscore' -task blastn"
+    if threads > 1:
+        cmd += " -num_threads %d" % threads
+    return cmd.format(blastn_exe, prefix, fname, dbname, ntargets,
+                      pyani_config.BLASTN_EVALUE, dbsize)
 
 
 # Generate single BLASTALL command line
 def construct_blastall_cmdline(fname1, fname2, outdir,
-                               blastall_exe=pyani_config.BLASTALL_DEFAULT):
+                               blastall_exe=pyani_config.BLASTALL_DEFAULT,
+                               threads=1):
     """Returns a single blastall command.
 
     - blastall_exe - path to BLASTALL executable
+    - threads - number of processors for BLASTALL (-a)
     """
     fstem1 = os.path.splitext(os.path.split(fname1)[-1])[0]
     fstem2 = os.path.splitext(os.path.split(fname2)[-1])[0]
@@ -365,12 +824,84 @@ def construct_blastall_cmdline(fname1, fname2, outdir,
     cmd = "{0} -p blastn -o {1}.blast_tab -i {2} -d {3} " +\
         "-X 150 -q -1 -F F -e 1e-15 " +\
         "-b 1 -v 1 -m 8"
+    if threads > 1:
+        cmd += " -a %d" % threads
     return cmd.format(blastall_exe, prefix, fname1, fname2)
 
 
+# Split combined-database BLASTN output into pairwise output files
+def split_combined_blast(blastfile, genomes, outdir, lengths,
+                         manifest_fh=None, shard=False):
+    """Writes pairwise .blast_tab files from one combined-database search.
+
+    - blastfile - path to <query>.blast_combined output
+    - genomes - list of genome names, indexed as in write_combined_fasta()
+    - outdir - path to directory for pairwise .blast_tab output
+    - lengths - dictionary of sequence lengths, keyed by organism
+    - manifest_fh - open manifest file, to which each output file is
+    written (see pyani_files.write_manifest_line()) (optional)
+    - shard - write output to hashed shard subdirectories of outdir (see
+    pyani_files.get_shard())
+
+    Each hit's E-value is first rescaled from the combined search's
+    database size (see get_combined_dbsize()) to the size of its subject
+    genome, as for a pairwise search against that genome, and hits above
+    pyani_config.BLASTN_EVALUE are discarded. Then, for each query fragment
+    and subject genome, only the hits to the subject sequence with the
+    highest bit score are kept, as -max_target_seqs 1 does for a pairwise
+    search. Hits to the query's own genome are discarded. The E-value and
+    bit score columns are removed, so the output has the same columns as
+    pairwise BLASTN output. Returns the list of pairwise output files.
+    """
+    qname = os.path.splitext(os.path.split(blastfile)[-1])[0]
+    dbsize = get_combined_dbsize(genomes, lengths)
+    pairlines = {sname: [] for sname in genomes if sname != qname}
+    hits = []  # (fragment, genome, subject sequence, bit score, line)
+    bestscores = {}  # Best (bit score, subject), keyed by (fragment, genome)
+    with open(blastfile, 'r') as ifh:
+        for line in ifh:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 3:
+                continue
+            sid = fields[1].split('|')[-1]
+            match = re.match(r'g(\d+)_', sid)
+            if match is None:
+                continue
+            sname = genomes[int(match.group(1))]
+            if sname == qname:
+                continue
+            evalue, bitscore = float(fields[-2]), float(fields[-1])
+            if evalue * lengths[sname] / dbsize > pyani_config.BLASTN_EVALUE:
+                continue
+            key = (fields[0], sname)
+            bestscores[key] = max(bestscores.get(key, (bitscore, sid)),
+                                  (bitscore, sid))
+            hits.append((key, sid, '\t'.join(fields[:-2]) + '\n'))
+    for key, sid, line in hits:
+        if bestscores[key][1] == sid:
+            pairlines[key[1]].append(line)
+    outfiles = []
+    for sname, lines in sorted(pairlines.items()):
+        stem = "%s_vs_%s" % (qname, sname)
+        relpath = stem + '.blast_tab'
+        if shard:
+            relpath = os.path.join(pyani_files.get_shard(stem), relpath)
+            os.makedirs(os.path.join(outdir, os.path.dirname(relpath)),
+                        exist_ok=True)
+        outfname = os.path.join(outdir, relpath)
+        with open(outfname, 'w') as ofh:
+            ofh.writelines(lines)
+        if manifest_fh is not None:
+            pyani_files.write_manifest_line(manifest_fh, qname, sname,
+                                            relpath)
+        outfiles.append(outfname)
+    return outfiles
+
+
 # Process pairwise BLASTN output
 def process_blast(blast_dir, org_lengths, fraglengths=None, mode="ANIb",
-                  identity=0.3, coverage=0.7, logger=None):
+                  identity=0.3, coverage=0.7, logger=None, archive=None,
+                  references=None, shard=False):
     """Returns a tuple of ANIb results for .blast_tab files in the output dir.
 
     - blast_dir - path to the directory containing .blast_tab files
@@ -379,6 +910,12 @@ def process_blast(blast_dir, org_lengths, fraglengths=None, mode="ANIb",
     needed for BLASTALL output
     - mode - parsing BLASTN+ or BLASTALL output?
     - logger - a logger for messages
+    - archive - pyani_archive.Archive to which each .blast_tab file is added
+    as it is read (optional)
+    - references - names of the reference sequences, for query-vs-reference
+    output (optional)
+    - shard - write pairwise files split from combined-database output to
+    hashed shard subdirectories (see split_combined_blast())
 
     Returns the following pandas dataframes in an ANIResults object;
     query sequences are rows, subject sequences are columns:
@@ -388,38 +925,59 @@ def process_blast(blast_dir, org_lengths, fraglengths=None, mode="ANIb",
     - alignment_coverage - non-symmetrical: coverage of query
     - similarity_errors - non-symmetrical: count of similarity errors
 
+    If references are given, the dataframes are rectangular: the other
+    sequences (queries) are rows, and references are columns.
+
+    Output from searches against a combined database (.blast_combined
+    files) is first split into pairwise .blast_tab files, which are listed
+    in a new manifest.
+
     May throw a ZeroDivisionError if one or more BLAST runs failed, or a
     very distant sequence was included in the analysis.
     """
-    # Process directory to identify input files
-    blastfiles = pyani_files.get_input_files(blast_dir, '.blast_tab')
+    # Split any combined-database output into pairwise files
+    combinedfiles = pyani_files.get_input_files(blast_dir, '.blast_combined')
+    if len(combinedfiles):
+        with open(os.path.join(blast_dir,
+                               pyani_config.COMBINED_GENOMES), 'r') as ifh:
+            genomes = json.load(ifh)
+        with open(os.path.join(blast_dir, pyani_config.MANIFEST),
+                  'w') as manifest_fh:
+            for combinedfile in combinedfiles:
+                split_combined_blast(combinedfile, genomes, blast_dir,
+                                     org_lengths, manifest_fh, shard)
+
+    # Identify input files, from the manifest written at job generation if
+    # there is one, otherwise from the directory and any shard
+    # subdirectories
+    blastfiles = pyani_files.get_pairwise_outputs(blast_dir, '.blast_tab',
+                                                  org_lengths, logger)
     # Hold data in ANIResults object
-    results = ANIResults(list(org_lengths.keys()), mode)
-
-    # Fill diagonal NA values for alignment_length with org_lengths
-    for org, length in list(org_lengths.items()):
-        results.alignment_lengths[org][org] = length
-
-    # Process .blast_tab files assuming that the filename format holds:
-    # org1_vs_org2.blast_tab:
-    for blastfile in blastfiles:
-        qname, sname = \
-            os.path.splitext(os.path.split(blastfile)[-1])[0].split('_vs_')
+    results = get_ani_results(org_lengths, mode, references)
 
+    # Process .blast_tab files for each (query, subject) pair
+    for qname, sname, blastfile in blastfiles:
         # We may have BLAST files from other analyses in the same directory
         # If this occurs, we raise a warning, and skip the file
-        if qname not in list(org_lengths.keys()):
+        if qname not in org_lengths:
             if logger:
                 logger.warning("Query name %s not in input " % qname +
                                "sequence list, skipping %s" % blastfile)
             continue
-        if sname not in list(org_lengths.keys()):
+        if sname not in org_lengths:
             if logger:
                 logger.warning("Subject name %s not in input " % sname +
                                "sequence list, skipping %s" % blastfile)
             continue
+        if not results.includes(qname, sname):
+            if logger:
+                logger.warning("%s is not a query-vs-reference " % blastfile +
+                               "comparison, skipping")
+            continue
         resultvals = parse_blast_tab(blastfile, fraglengths,
-                                     identity, coverage, mode)
+                                     identity, coverage, mode, qname)
+        if archive is not None:
+            archive.add(blastfile)
         query_cover = float(resultvals[0]) / org_lengths[qname]
 
         # Populate dataframes: when assigning data, we need to note that
@@ -433,11 +991,13 @@ def process_blast(blast_dir, org_lengths, fraglengths=None, mode="ANIb",
 
 
 # Parse BLASTALL output to get total alignment length and mismatches
-def parse_blast_tab(filename, fraglengths, identity, coverage, mode="ANIb"):
+def parse_blast_tab(filename, fraglengths, identity, coverage, mode="ANIb",
+                    qname=None):
     """Returns (alignment length, similarity errors, mean_pid) tuple
     from .blast_tab
 
     - filename - path to .blast_tab file
+    - qname - name of the query sequence (optional)
 
     Calculate the alignment length and total number of similarity errors (as
     we would with ANIm), as well as the Goris et al.-defined mean identity
@@ -450,8 +1010,12 @@ def parse_blast_tab(filename, fraglengths, identity, coverage, mode="ANIb"):
     over an alignable region of at least 70% of their length.
     '''
     """
-    # Assuming that the filename format holds org1_vs_org2.blast_tab:
-    qname = os.path.splitext(os.path.split(filename)[-1])[0].split('_vs_')[0]
+    # Unless given, the query name is taken from the filename, assuming that
+    # the format org1_vs_org2.blast_tab holds
+    if qname is None:
+        qname = pyani_files.split_pair_name(
+            os.path.splitext(os.path.split(filename)[-1])[0],
+            fraglengths or {})[0]
     # Load output as dataframe
     if mode == "ANIblastall":
         qfraglengths = fraglengths[qname]
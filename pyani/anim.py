@@ -21,12 +21,21 @@ counts, average nucleotide identity (ANI) percentages, and minimum aligned
 percentage (of whole genome) for each pairwise comparison.
 """
 
+import operator
 import os
 
 from . import pyani_config
 from . import pyani_files
 from . import pyani_jobs
-from .pyani_tools import ANIResults
+from .pyani_tools import get_ani_results
+
+
+# Templates for NUCmer and delta-filter command lines, filled with the
+# arguments: executable, mode, output prefix, query and subject stems, and
+# (NUCmer only) query and subject FASTA paths
+NUCMER_CMDLINE = "{0} {1} -p {2}{3}_vs_{4} {5} {6}"
+FILTER_CMDLINE = "delta_filter_wrapper.py {0} -1 {1}{2}_vs_{3}.delta " + \
+                 "{1}{2}_vs_{3}.filter"
 
 
 # Generate list of Job objects, one per NUCmer run
@@ -34,27 +43,160 @@ def generate_nucmer_jobs(filenames, outdir='.',
                          nucmer_exe=pyani_config.NUCMER_DEFAULT,
                          filter_exe=pyani_config.FILTER_DEFAULT,
                          maxmatch=False,
-                         jobprefix="ANINUCmer"):
+                         jobprefix="ANINUCmer",
+                         threads=1,
+                         lengths=None,
+                         shard=False,
+                         manifest=False,
+                         skip=None,
+                         references=None):
     """Return a list of Jobs describing NUCmer command-lines for ANIm
 
     - filenames - a list of paths to input FASTA files
     - outdir - path to output directory
     - nucmer_exe - location of the nucmer binary
     - maxmatch - Boolean flag indicating to use NUCmer's -maxmatch option
+    - threads - most threads for each NUCmer job (see iter_nucmer_jobs())
+    - lengths - dictionary of sequence lengths, keyed by organism (optional)
+    - shard - write output to hashed shard subdirectories of the output
+    directory (see pyani_files.get_shard())
+    - manifest - write a manifest of the expected .filter output files
+    - skip - set of pairs of organisms (as frozensets) not to compare
+    - references - a list of paths to reference FASTA files; if given,
+    each of filenames is compared only with each reference
+
+    See iter_nucmer_jobs(), which generates the Jobs one at a time.
+    """
+    return list(iter_nucmer_jobs(filenames, outdir, nucmer_exe, filter_exe,
+                                 maxmatch, jobprefix, threads, lengths,
+                                 shard, manifest, skip, references))
+
+
+# Generate Job objects, one per NUCmer run, on demand
+def iter_nucmer_jobs(filenames, outdir='.',
+                     nucmer_exe=pyani_config.NUCMER_DEFAULT,
+                     filter_exe=pyani_config.FILTER_DEFAULT,
+                     maxmatch=False,
+                     jobprefix="ANINUCmer",
+                     threads=1,
+                     lengths=None,
+                     shard=False,
+                     manifest=False,
+                     skip=None,
+                     references=None):
+    """Yield Jobs describing NUCmer command-lines for ANIm, one per pair
 
-    Loop over all FASTA files, generating Jobs describing NUCmer command lines
-    for each pairwise comparison.
+    - filenames - a list of paths to input FASTA files
+    - outdir - path to output directory
+    - nucmer_exe - location of the nucmer binary
+    - maxmatch - Boolean flag indicating to use NUCmer's -maxmatch option
+    - threads - most threads for each NUCmer job; with lengths, jobs get
+    threads in proportion to their size
+    - lengths - dictionary of sequence lengths, keyed by organism (optional)
+    - shard - write output to hashed shard subdirectories of the output
+    directory (see pyani_files.get_shard())
+    - manifest - write a manifest of the expected .filter output files
+    - skip - set of pairs of organisms (as frozensets) not to compare, e.g.
+    from sketch.get_pruned_pairs()
+    - references - a list of paths to reference FASTA files; if given,
+    each of filenames (the queries) is compared only with each reference,
+    and output is named <query>_vs_<reference>
+
+    Each Job yielded is a delta-filter job, with the NUCmer job for the same
+    comparison as its dependency. Jobs are only created as they are
+    requested, so a runner that consumes them as a stream (see
+    run_multiprocessing.run_job_stream(), run_sge.run_job_stream()) can
+    start the first comparison without building the whole job graph.
+
+    Loop over all pairs of FASTA files (see pyani_files.iter_pairs()),
+    generating Jobs describing NUCmer command lines for each pairwise
+    comparison. If sequence lengths
+    are given, each Job's cost is estimated as the combined length of the
+    two genomes, as NUCmer run time grows roughly linearly with the input
+    size, and the pairs are generated in decreasing order of cost, so that
+    the largest comparisons start first. Each NUCmer Job is also given
+    threads in proportion to the product of the two genome lengths (see
+    pyani_jobs.get_job_threads()), up to threads for the largest
+    comparison, so that expensive comparisons get more cores, and cheap
+    ones leave cores free for other jobs. NUCmer memory use is estimated from the same total, using
+    pyani_config.NUCMER_MEMORY_PER_BASE (or NUCMER_MAXMATCH_MEMORY_PER_BASE
+    with --maxmatch).
+
+    Each Job holds its command line as one of the shared templates
+    NUCMER_CMDLINE and FILTER_CMDLINE, with a tuple of arguments (see
+    get_nucmer_cmdline_args()) that refers to strings shared between jobs,
+    rather than as a rendered string, to keep large job graphs small.
+
+    If sharding, each comparison's output goes to the shard subdirectory
+    for its <stem1>_vs_<stem2> name, which is created the first time it is
+    used, so that no one directory holds millions of files.
+
+    If manifest is True, the .filter output expected from each comparison
+    is recorded, as its jobs are generated, in the pyani_config.MANIFEST
+    file of the "nucmer_output" directory, for process_deltadir().
     """
-    ncmds, fcmds = generate_nucmer_commands(filenames, outdir, nucmer_exe,
-                                            filter_exe, maxmatch)
-    joblist = []
-    for idx, ncmd in enumerate(ncmds):
-        njob = pyani_jobs.Job("%s_%06d-n" % (jobprefix, idx), ncmd)
-        fjob = pyani_jobs.Job("%s_%06d-f" % (jobprefix, idx), fcmds[idx])
-        fjob.add_dependency(njob)
-        #joblist.append(njob)  # not required: dependency in fjob
-        joblist.append(fjob)
-    return joblist
+    stems = {fname: os.path.splitext(os.path.split(fname)[-1])[0] for
+             fname in filenames + (references or [])}
+    if maxmatch:
+        mem_per_base = pyani_config.NUCMER_MAXMATCH_MEMORY_PER_BASE
+    else:
+        mem_per_base = pyani_config.NUCMER_MEMORY_PER_BASE
+    prefix, mode = get_nucmer_cmdline_args(outdir, maxmatch, threads)
+    pairprefix, key = prefix, ''
+    shards = {}  # Shard -> output prefix, shared between jobs
+    manifest_fh = None
+    if manifest:
+        os.makedirs(prefix, exist_ok=True)
+        manifest_fh = open(os.path.join(prefix, pyani_config.MANIFEST), 'w')
+    sizes, maxproduct = None, 0
+    if lengths is not None:
+        sizes = {fname: lengths[stem] for fname, stem in stems.items()}
+        largest = next(pyani_files.iter_pairs(filenames, references, sizes),
+                       None)
+        if largest is not None:
+            maxproduct = sizes[largest[0]] * sizes[largest[1]]
+    modes = {threads: mode}  # Thread count -> mode, shared between jobs
+    jobnum = 0
+    try:
+        for fname1, fname2 in pyani_files.iter_pairs(filenames, references,
+                                                     sizes, operator.add):
+            stem1, stem2 = stems[fname1], stems[fname2]
+            if skip and frozenset((stem1, stem2)) in skip:
+                continue
+            if shard:
+                key = pyani_files.get_shard("%s_vs_%s" % (stem1, stem2))
+                if key not in shards:
+                    os.makedirs(os.path.join(prefix, key), exist_ok=True)
+                    shards[key] = os.path.join(prefix, key, '')
+                pairprefix = shards[key]
+            cost, jobthreads = 0, threads
+            if lengths is not None:
+                cost = lengths[stem1] + lengths[stem2]
+                jobthreads = pyani_jobs.get_job_threads(
+                    lengths[stem1] * lengths[stem2], maxproduct, threads)
+            if jobthreads not in modes:
+                modes[jobthreads] = get_nucmer_cmdline_args(
+                    outdir, maxmatch, jobthreads)[1]
+            njob = pyani_jobs.Job("%s_%06d-n" % (jobprefix, jobnum),
+                                  NUCMER_CMDLINE, threads=jobthreads,
+                                  cost=cost, memory=mem_per_base * cost,
+                                  args=(nucmer_exe, modes[jobthreads],
+                                        pairprefix, stem1, stem2, fname1,
+                                        fname2))
+            fjob = pyani_jobs.Job("%s_%06d-f" % (jobprefix, jobnum),
+                                  FILTER_CMDLINE, cost=cost,
+                                  args=(filter_exe, pairprefix,
+                                        stem1, stem2))
+            fjob.add_dependency(njob)
+            if manifest_fh is not None:
+                pyani_files.write_manifest_line(
+                    manifest_fh, stem1, stem2,
+                    os.path.join(key, "%s_vs_%s.filter" % (stem1, stem2)))
+            yield fjob
+            jobnum += 1
+    finally:
+        if manifest_fh is not None:
+            manifest_fh.close()
 
 
 # Generate list of NUCmer pairwise comparison command lines from
@@ -62,7 +204,7 @@ def generate_nucmer_jobs(filenames, outdir='.',
 def generate_nucmer_commands(filenames, outdir='.',
                              nucmer_exe=pyani_config.NUCMER_DEFAULT,
                              filter_exe=pyani_config.FILTER_DEFAULT,
-                             maxmatch=False):
+                             maxmatch=False, threads=1):
     """Return a tuple of lists of NUCmer command-lines for ANIm
 
     The first element is a list of NUCmer commands, the second a list
@@ -74,6 +216,7 @@ def generate_nucmer_commands(filenames, outdir='.',
     - outdir - path to output directory
     - nucmer_exe - location of the nucmer binary
     - maxmatch - Boolean flag indicating to use NUCmer's -maxmatch option
+    - threads - number of threads for each NUCmer command
 
     Loop over all FASTA files generating NUCmer command lines for each
     pairwise comparison.
@@ -83,7 +226,7 @@ def generate_nucmer_commands(filenames, outdir='.',
         for fname2 in filenames[idx+1:]:
             ncmd, dcmd = construct_nucmer_cmdline(fname1, fname2, outdir,
                                                   nucmer_exe, filter_exe,
-                                                  maxmatch)
+                                                  maxmatch, threads)
             nucmer_cmdlines.append(ncmd)
             delta_filter_cmdlines.append(dcmd)
     return (nucmer_cmdlines, delta_filter_cmdlines)
@@ -94,7 +237,7 @@ def generate_nucmer_commands(filenames, outdir='.',
 def construct_nucmer_cmdline(fname1, fname2, outdir='.',
                              nucmer_exe=pyani_config.NUCMER_DEFAULT,
                              filter_exe=pyani_config.FILTER_DEFAULT,
-                             maxmatch=False):
+                             maxmatch=False, threads=1):
     """Returns a tuple of NUCmer and delta-filter commands
 
     The split into a tuple was made necessary by changes to SGE/OGE. The
@@ -109,23 +252,41 @@ def construct_nucmer_cmdline(fname1, fname2, outdir='.',
     - outdir - path to output directory
     - maxmatch - Boolean flag indicating whether to use NUCmer's -maxmatch
     option. If not, the -mum option is used instead
+    - threads - number of threads for NUCmer; values greater than one add
+    the --threads option, which requires MUMmer 4
+    """
+    prefix, mode = get_nucmer_cmdline_args(outdir, maxmatch, threads)
+    stem1 = os.path.splitext(os.path.split(fname1)[-1])[0]
+    stem2 = os.path.splitext(os.path.split(fname2)[-1])[0]
+    nucmercmd = NUCMER_CMDLINE.format(nucmer_exe, mode, prefix, stem1, stem2,
+                                      fname1, fname2)
+    filtercmd = FILTER_CMDLINE.format(filter_exe, prefix, stem1, stem2)
+    return(nucmercmd, filtercmd)
+    #return "{0}; {1}".format(nucmercmd, filtercmd)
+
+
+# Get the arguments shared by all NUCmer command lines in an analysis
+def get_nucmer_cmdline_args(outdir='.', maxmatch=False, threads=1):
+    """Returns (output prefix, mode) arguments for NUCMER_CMDLINE.
+
+    - outdir - path to output directory
+    - maxmatch - Boolean flag indicating whether to use NUCmer's -maxmatch
+    option. If not, the -mum option is used instead
+    - threads - number of threads for NUCmer; values greater than one add
+    the --threads option, which requires MUMmer 4
+
+    The output prefix is the "nucmer_output" subdirectory of outdir, with a
+    trailing separator, so that appending "<stem1>_vs_<stem2>" gives the
+    same path as os.path.join().
     """
-    outsubdir = os.path.join(outdir, pyani_config.ALIGNDIR['ANIm'])
-    outprefix = os.path.join(outsubdir, "%s_vs_%s" %
-                             (os.path.splitext(os.path.split(fname1)[-1])[0],
-                              os.path.splitext(os.path.split(fname2)[-1])[0]))
+    prefix = os.path.join(outdir, pyani_config.ALIGNDIR['ANIm'], '')
     if maxmatch:
         mode = "--maxmatch"
     else:
         mode = "--mum"
-    nucmercmd = "{0} {1} -p {2} {3} {4}".format(nucmer_exe, mode, outprefix,
-                                                fname1, fname2)
-    filtercmd = "delta_filter_wrapper.py " + \
-    "{0} -1 {1} {2}".format(filter_exe,
-                            outprefix + '.delta',
-                            outprefix + '.filter')
-    return(nucmercmd, filtercmd)
-    #return "{0}; {1}".format(nucmercmd, filtercmd)
+    if threads > 1:
+        mode += " --threads %d" % threads
+    return prefix, mode
 
 
 # Parse NUCmer delta file to get total alignment length and total sim_errors
@@ -150,11 +311,16 @@ def parse_delta(filename):
 
 
 # Parse all the .delta files in the passed directory
-def process_deltadir(delta_dir, org_lengths, logger=None):
+def process_deltadir(delta_dir, org_lengths, logger=None, archive=None,
+                     references=None):
     """Returns a tuple of ANIm results for .deltas in passed directory.
 
     - delta_dir - path to the directory containing .delta files
     - org_lengths - dictionary of total sequence lengths, keyed by sequence
+    - archive - pyani_archive.Archive to which each comparison's .delta and
+    .filter files are added as they are read (optional)
+    - references - names of the reference sequences, for query-vs-reference
+    output (optional)
 
     Returns the following pandas dataframes in an ANIResults object;
     query sequences are rows, subject sequences are columns:
@@ -164,39 +330,47 @@ def process_deltadir(delta_dir, org_lengths, logger=None):
     - alignment_coverage - non-symmetrical: coverage of query and subject
     - similarity_errors - symmetrical: count of similarity errors
 
+    If references are given, the dataframes are rectangular: the other
+    sequences (queries) are rows, and references are columns, so only
+    query coverage is reported.
+
     May throw a ZeroDivisionError if one or more NUCmer runs failed, or a
     very distant sequence was included in the analysis.
     """
-    # Process directory to identify input files - as of v0.2.4 we use the
-    # .filter files that result from delta-filter (1:1 alignments)
-    deltafiles = pyani_files.get_input_files(delta_dir, '.filter')
+    # Identify input files - as of v0.2.4 we use the .filter files that
+    # result from delta-filter (1:1 alignments). These are listed in the
+    # manifest written at job generation, if there is one; otherwise they
+    # are found in the directory, and any shard subdirectories
+    deltafiles = pyani_files.get_pairwise_outputs(delta_dir, '.filter',
+                                                  org_lengths, logger)
 
     # Hold data in ANIResults object
-    results = ANIResults(list(org_lengths.keys()), "ANIm")
-
-    # Fill diagonal NA values for alignment_length with org_lengths
-    for org, length in list(org_lengths.items()):
-        results.alignment_lengths[org][org] = length
-
-    # Process .delta files assuming that the filename format holds:
-    # org1_vs_org2.delta
-    for deltafile in deltafiles:
-        qname, sname = \
-            os.path.splitext(os.path.split(deltafile)[-1])[0].split('_vs_')
+    results = get_ani_results(org_lengths, "ANIm", references)
 
+    # Process .filter files for each (query, subject) pair
+    for qname, sname, deltafile in deltafiles:
         # We may have .delta files from other analyses in the same directory
         # If this occurs, we raise a warning, and skip the .delta file
-        if qname not in list(org_lengths.keys()):
+        if qname not in org_lengths:
             if logger:
                 logger.warning("Query name %s not in input " % qname +
                                "sequence list, skipping %s" % deltafile)
             continue
-        if sname not in list(org_lengths.keys()):
+        if sname not in org_lengths:
             if logger:
                 logger.warning("Subject name %s not in input " % sname +
                                "sequence list, skipping %s" % deltafile)
             continue
+        if not results.includes(qname, sname):
+            if logger:
+                logger.warning("%s is not a query-vs-reference " % deltafile +
+                               "comparison, skipping")
+            continue
         tot_length, tot_sim_error = parse_delta(deltafile)
+        if archive is not None:
+            archive.add(deltafile)
+            if os.path.isfile(os.path.splitext(deltafile)[0] + '.delta'):
+                archive.add(os.path.splitext(deltafile)[0] + '.delta')
         if tot_length == 0 and logger is not None:
             if logger:
                 logger.warning("Total alignment length reported in " +
@@ -0,0 +1,155 @@
+# Copyright 2017, The James Hutton Insitute
+# Author: Leighton Pritchard
+#
+# This code is part of the pyani package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of
+# this package.
+
+"""Code to dereplicate genomes by greedy clustering on ANIm.
+
+Genomes are taken in order of preference as cluster representatives (e.g.
+by assembly quality or size). Each genome is compared only with the
+representatives of the clusters found so far, and joins the first cluster
+whose representative it matches (ANIm identity, and alignment coverage of
+both genomes, at or above a threshold). A genome that matches no
+representative becomes the representative of a new cluster. With k
+clusters, this needs about n * k comparisons, rather than the
+n * (n - 1) / 2 of an all-vs-all analysis.
+
+Each representative has been compared with every earlier representative
+when it is found, so ANIm results for the representatives against each
+other are obtained without any further comparisons.
+"""
+
+from collections import OrderedDict
+
+from .pyani_tools import get_ani_results
+
+
+# Calculate ANIm identity from an alignment
+def get_identity(length, errors):
+    """Returns the identity of an alignment, or zero if nothing aligned.
+
+    - length - total aligned length
+    - errors - total similarity errors
+    """
+    try:
+        return 1 - float(errors) / length
+    except ZeroDivisionError:
+        return 0
+
+
+# Greedily cluster genomes
+def dereplicate(names, org_lengths, compare, identity, coverage=0.0,
+                batchsize=1, logger=None):
+    """Returns (clusters, results) from greedy dereplication of genomes.
+
+    - names - genome names, in order of preference as representatives
+    - org_lengths - dictionary of total sequence lengths, keyed by genome
+    - compare - function to run comparisons, called as
+    compare(queries, references) to compare each query genome with each
+    reference genome, or compare(queries) to compare each pair of queries
+    (both lists of genome names); it returns an iterable of (query,
+    subject, aligned length, similarity errors) for the comparisons, e.g.
+    from anim.parse_delta()
+    - identity - minimum ANIm identity (as a fraction) to join a cluster
+    - coverage - minimum alignment coverage of both genomes to join a
+    cluster
+    - batchsize - number of genomes compared with the representatives at
+    once, so that comparisons can run in parallel
+    - logger - a logger for messages (optional)
+
+    Each batch of genomes is compared with the current representatives.
+    Genomes in the batch matching no representative are then compared with
+    each other, and are assigned in order, each joining the first new
+    cluster in the batch that it matches, so that the clusters are the same
+    for any batch size. A comparison that produced no output counts as no
+    match.
+
+    Returns an OrderedDict of cluster members, keyed by representative, in
+    the order the clusters were found; each cluster's members are in order
+    of preference, with the representative first. Also returns an
+    ANIResults object of ANIm results for the representatives against each
+    other.
+    """
+    alignments = {}  # (query, subject) -> (aligned length, sim. errors)
+    clusters = OrderedDict()
+
+    def run(queries, references=None):
+        """Run comparisons, keeping the alignment of each."""
+        for qname, sname, length, errors in compare(queries, references):
+            alignments[(qname, sname)] = (length, errors)
+
+    def matches(qname, sname):
+        """Return True if the two genomes belong in the same cluster."""
+        length, errors = alignments.get(
+            (qname, sname), alignments.get((sname, qname), (0, 0)))
+        return get_identity(length, errors) >= identity and \
+            float(length) / max(org_lengths[qname],
+                                org_lengths[sname]) >= coverage
+
+    for start in range(0, len(names), batchsize):
+        batch = names[start:start + batchsize]
+        reps = list(clusters)
+        if reps:
+            run(batch, reps)
+        unassigned = []
+        for name in batch:
+            rep = next((rep for rep in reps if matches(name, rep)), None)
+            if rep is None:
+                unassigned.append(name)
+            else:
+                clusters[rep].append(name)
+        if len(unassigned) > 1:
+            run(unassigned)
+        newreps = []
+        for name in unassigned:
+            rep = next((rep for rep in newreps if matches(name, rep)), None)
+            if rep is None:
+                newreps.append(name)
+                clusters[name] = [name]
+            else:
+                clusters[rep].append(name)
+        if logger:
+            logger.info("Dereplicated %d of %d genomes: %d clusters",
+                        start + len(batch), len(names), len(clusters))
+
+    # Representatives have all been compared with each other
+    results = get_ani_results(OrderedDict((rep, org_lengths[rep]) for
+                                          rep in clusters), "ANIm")
+    reps = list(clusters)
+    for idx, rep1 in enumerate(reps[:-1]):
+        for rep2 in reps[idx + 1:]:
+            qname, sname = rep1, rep2
+            if (qname, sname) not in alignments:
+                qname, sname = rep2, rep1
+            if (qname, sname) not in alignments:
+                results.add_not_computed(qname, sname)
+                continue
+            length, errors = alignments[(qname, sname)]
+            results.add_tot_length(qname, sname, length)
+            results.add_sim_errors(qname, sname, errors)
+            results.add_pid(qname, sname, get_identity(length, errors))
+            results.add_coverage(qname, sname,
+                                 float(length) / org_lengths[qname],
+                                 float(length) / org_lengths[sname])
+    return clusters, results
+
+
+# Tabulate cluster membership
+def get_cluster_table(clusters, duplicates=None):
+    """Returns a list of (genome, representative) pairs, one per genome.
+
+    - clusters - OrderedDict of cluster members, keyed by representative,
+    from dereplicate()
+    - duplicates - dictionary of representative genomes, keyed by duplicate
+    (see pyani_files.get_duplicates()); each duplicate is placed in the
+    cluster of the genome it duplicates (optional)
+
+    Genomes are listed by cluster, in cluster order.
+    """
+    copies = {}
+    for dup, org in sorted((duplicates or {}).items()):
+        copies.setdefault(org, []).append(dup)
+    return [(name, rep) for rep, members in clusters.items() for member in
+            members for name in [member] + copies.get(member, [])]
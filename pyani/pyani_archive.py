@@ -0,0 +1,160 @@
+# Copyright 2017, The James Hutton Insitute
+# Author: Leighton Pritchard
+#
+# This code is part of the pyani package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of
+# this package.
+
+"""Code to archive comparison output for pyani.
+
+Pairwise comparison output can be archived as it is read, rather than in a
+single pass over the output directory once the analysis is complete. Three
+archive formats are supported:
+
+- gzip - a .tar.gz file, compressed in parallel blocks (each block is a
+  separate gzip member, so the file can be read with tar/gzip as usual)
+- zstd - a .tar.zst file, compressed with multithreaded Zstandard; this
+  needs the optional zstandard package
+- zip - a .zip file, which is an indexed container: the output for any one
+  pair can be extracted without reading the rest of the archive
+"""
+
+import gzip
+import os
+import tarfile
+import zipfile
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .pyani_config import ARCHIVE_BLOCKSIZE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Archive formats, and the suffix for each
+ARCHIVE_SUFFIXES = {'gzip': '.tar.gz',
+                    'zstd': '.tar.zst',
+                    'zip': '.zip'}
+
+
+# Write a gzip stream, compressing blocks in parallel
+class ParallelGzipWriter(object):
+    """File-like object that gzip-compresses written data in parallel.
+
+    Data is collected into blocks of ARCHIVE_BLOCKSIZE bytes, and each block
+    is compressed as a separate gzip member by a pool of threads (zlib
+    releases the GIL while compressing). Compressed blocks are written to
+    the underlying file in order. A series of gzip members is itself a valid
+    gzip stream.
+    """
+    def __init__(self, fileobj, threads=None, compresslevel=6):
+        """Instantiate a ParallelGzipWriter.
+
+        - fileobj        File object to write compressed data to
+        - threads        Int, number of compression threads (default: one
+                         per core)
+        - compresslevel  Int, gzip compression level
+        """
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.threads = threads or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = deque()  # Futures for compressed blocks, in order
+        self.buffer = bytearray()
+
+    def write(self, data):
+        """Write data to the compressed stream."""
+        self.buffer.extend(data)
+        while len(self.buffer) >= ARCHIVE_BLOCKSIZE:
+            self.submit(bytes(self.buffer[:ARCHIVE_BLOCKSIZE]))
+            del self.buffer[:ARCHIVE_BLOCKSIZE]
+        return len(data)
+
+    def submit(self, block):
+        """Compress a block in the thread pool, keeping a bounded queue."""
+        self.pending.append(self.executor.submit(gzip.compress, block,
+                                                 self.compresslevel))
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        """Compress any remaining data, and write all compressed blocks."""
+        if len(self.buffer):
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while len(self.pending):
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+
+
+# Archive output files as they are read
+class Archive(object):
+    """Archive of comparison output, to which files are added one by one."""
+    def __init__(self, outdir, fmt='gzip', threads=None):
+        """Instantiate an Archive for the passed output directory.
+
+        - outdir        String, path to the output directory; the archive
+                        is written alongside it, as outdir + suffix
+        - fmt           String, archive format: 'gzip', 'zstd' or 'zip'
+        - threads       Int, number of compression threads (default: one
+                        per core)
+
+        Raises ValueError if the format is unknown, or is 'zstd' and the
+        zstandard package is not installed.
+        """
+        if fmt not in ARCHIVE_SUFFIXES:
+            raise ValueError("Unknown archive format %s" % fmt)
+        if fmt == 'zstd' and zstandard is None:
+            raise ValueError("zstd archives need the zstandard package")
+        self.outdir = outdir
+        self.root = os.path.dirname(os.path.normpath(outdir))
+        self.fmt = fmt
+        self.path = outdir + ARCHIVE_SUFFIXES[fmt]
+        self.added = set()  # Paths of files already in the archive
+        self.fileobj, self.stream = None, None
+        if fmt == 'zip':
+            self.container = zipfile.ZipFile(self.path, 'w',
+                                             zipfile.ZIP_DEFLATED,
+                                             allowZip64=True)
+            return
+        self.fileobj = open(self.path, 'wb')
+        if fmt == 'zstd':
+            self.stream = zstandard.ZstdCompressor(
+                threads=threads or -1).stream_writer(self.fileobj)
+        else:
+            self.stream = ParallelGzipWriter(self.fileobj, threads)
+        self.container = tarfile.open(fileobj=self.stream, mode='w|')
+
+    def add(self, path):
+        """Add the file at the passed path to the archive, once.
+
+        Files are stored under the name of the output directory, wherever
+        that directory is (e.g. nucmer_output/<query>_vs_<subject>.delta),
+        so archives of output staged on scratch have the same layout.
+        """
+        path = os.path.normpath(path)
+        if path in self.added:
+            return
+        arcname = os.path.relpath(path, self.root)
+        if self.fmt == 'zip':
+            self.container.write(path, arcname)
+        else:
+            self.container.add(path, arcname)
+        self.added.add(path)
+
+    def add_tree(self):
+        """Add all files in the output directory not yet in the archive."""
+        for dirpath, _, filenames in os.walk(self.outdir):
+            for fname in sorted(filenames):
+                self.add(os.path.join(dirpath, fname))
+
+    def close(self):
+        """Finish writing the archive."""
+        self.container.close()
+        if self.stream is not None:
+            self.stream.close()
+        if self.fileobj is not None and not self.fileobj.closed:
+            self.fileobj.close()
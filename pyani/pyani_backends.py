@@ -0,0 +1,317 @@
+# Copyright 2013-2017, The James Hutton Insitute
+# Author: Leighton Pritchard
+#
+# This code is part of the pyani package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of
+# this package.
+
+"""Code to talk to cluster schedulers for pyani.
+
+The cluster runner (run_sge.py) compiles a job dependency graph into job
+scripts and array jobs, submits them in dependency order, and waits for
+them to finish. Everything specific to a particular scheduler is kept in a
+backend class here, so that the same runner can drive different clusters:
+
+- SGEBackend     Sun/Open/Univa Grid Engine (qsub, qstat)
+- SLURMBackend   SLURM (sbatch, squeue, sacct)
+
+A backend provides the header for job scripts, submits single jobs and
+array jobs with dependency holds (on all tasks of a job, or task-by-task),
+and polls the scheduler for the status of many jobs at once.
+
+Job scripts written by run_sge.py refer to the array task index as
+$SGE_TASK_ID; backends for other schedulers set this variable in their
+script header.
+"""
+
+import getpass
+import shlex
+import subprocess
+
+from collections import defaultdict
+from xml.etree import ElementTree
+
+from . import pyani_config
+from .pyani_jobs import JobGroup
+
+
+# Base class for scheduler backends
+class SchedulerBackend:
+    """Interface for submitting jobs to, and polling, a cluster scheduler.
+
+    Subclasses implement script_header, build_submit_args(), submit_command()
+    and poll().
+    """
+    name = None                      # Name of the scheduler, for logging
+    script_header = "#!/bin/sh\n"    # First lines of each job script
+
+    def submit(self, job, root_dir, extra_args=None):
+        """Submit the passed Job or JobGroup, and return its job ID.
+
+        - job           Job or JobGroup, with a script at job.scriptpath
+        - root_dir      Root directory for scheduler output
+        - extra_args    String, additional arguments to the submit command
+
+        JobGroups are submitted as array jobs. The job is held on its
+        dependencies, which must already have been submitted. The job ID is
+        also stored as job.jobid. Raises subprocess.CalledProcessError if
+        submission fails.
+        """
+        args = self.build_submit_args(job, root_dir)
+        if extra_args is not None:
+            args += shlex.split(extra_args)
+        result = subprocess.run(self.submit_command() + args +
+                                [job.scriptpath],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, check=True,
+                                universal_newlines=True)
+        job.jobid = self.parse_jobid(result.stdout)
+        return job.jobid
+
+    def submit_command(self):
+        """Returns the submit command line, as a list, before job options."""
+        raise NotImplementedError
+
+    def build_submit_args(self, job, root_dir):
+        """Returns the list of submit options for the passed job."""
+        raise NotImplementedError
+
+    def parse_jobid(self, output):
+        """Returns the job ID from the submit command's output."""
+        raise NotImplementedError
+
+    def poll(self, jobs):
+        """Updates the state of the passed jobs from the scheduler.
+
+        - jobs          Iterable of Job/JobGroup objects
+
+        Jobs that the scheduler no longer reports as queued or running are
+        marked as finished. Returns the list of jobs still known to the
+        scheduler, or raises subprocess.CalledProcessError if the scheduler
+        cannot be queried.
+        """
+        raise NotImplementedError
+
+    def is_error_state(self, state):
+        """Returns True if the passed job state indicates an error."""
+        return False
+
+
+# Grid Engine
+class SGEBackend(SchedulerBackend):
+    """Submits jobs with qsub, and polls them with qstat -xml."""
+    name = "SGE"
+    script_header = "#!/bin/sh\n#$ -S /bin/bash\n"
+
+    def __init__(self, qsub_exe=pyani_config.QSUB_DEFAULT,
+                 qstat_exe=pyani_config.QSTAT_DEFAULT):
+        """Instantiates an SGEBackend.
+
+        - qsub_exe      Path to the qsub executable
+        - qstat_exe     Path to the qstat executable
+        """
+        self.qsub_exe = qsub_exe
+        self.qstat_exe = qstat_exe
+
+    def submit_command(self):
+        """Returns the qsub command line, reporting only the job ID and
+        passing the local environment.
+        """
+        return [self.qsub_exe, '-terse', '-V']
+
+    def build_submit_args(self, job, root_dir):
+        """Returns the list of qsub options for the passed job.
+
+        Jobs run in the current working directory, and are held on the IDs
+        of their dependencies (-hold_jid), or on the matching tasks of
+        their task dependencies (-hold_jid_ad).
+        """
+        args = ['-N', job.name, '-cwd', '-o', job.out, '-e', job.err]
+        # If the job uses more than one core, request a parallel environment
+        if job.threads > 1:
+            args += ['-pe', pyani_config.SGE_PE, str(job.threads)]
+        # If the job is actually a JobGroup, add the task numbering argument
+        if isinstance(job, JobGroup):
+            args += ['-t', '1:%d' % job.tasks]
+        if len(job.dependencies) > 0:
+            args += ['-hold_jid', ','.join([get_job_reference(dep) for dep in
+                                            job.dependencies])]
+        if isinstance(job, JobGroup) and len(job.task_dependencies) > 0:
+            args += ['-hold_jid_ad',
+                     ','.join([get_job_reference(dep) for dep in
+                               job.task_dependencies])]
+        return args
+
+    def parse_jobid(self, output):
+        """Returns the job ID from qsub -terse output, which is <ID> for
+        single jobs, or <ID>.<task range> for array jobs.
+        """
+        return output.strip().split('.', 1)[0]
+
+    def poll(self, jobs):
+        """Updates the state of the passed jobs from one call to qstat -xml.
+
+        Jobs are matched by their job IDs, or by name for jobs without one.
+        """
+        result = subprocess.run([self.qstat_exe, '-xml'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, check=True)
+        states = parse_qstat_xml(result.stdout)
+        states.update(parse_qstat_xml(result.stdout, 'JB_name'))
+        outstanding = []
+        for job in jobs:
+            if get_job_reference(job) in states:
+                job.state = ','.join(sorted(states[get_job_reference(job)]))
+                outstanding.append(job)
+            else:
+                job.state = None
+                job.finished = True
+        return outstanding
+
+    def is_error_state(self, state):
+        """Returns True if SGE reports a task in an error state (e.g. Eqw)."""
+        return state is not None and 'E' in state
+
+
+# SLURM
+class SLURMBackend(SchedulerBackend):
+    """Submits jobs with sbatch, and polls them with squeue and sacct."""
+    name = "SLURM"
+    script_header = "#!/bin/bash\nSGE_TASK_ID=${SLURM_ARRAY_TASK_ID}\n"
+
+    def __init__(self, sbatch_exe=pyani_config.SBATCH_DEFAULT,
+                 squeue_exe=pyani_config.SQUEUE_DEFAULT,
+                 sacct_exe=pyani_config.SACCT_DEFAULT):
+        """Instantiates a SLURMBackend.
+
+        - sbatch_exe    Path to the sbatch executable
+        - squeue_exe    Path to the squeue executable
+        - sacct_exe     Path to the sacct executable, or None to skip
+                        looking up the final state of finished jobs
+        """
+        self.sbatch_exe = sbatch_exe
+        self.squeue_exe = squeue_exe
+        self.sacct_exe = sacct_exe
+
+    def submit_command(self):
+        """Returns the sbatch command line, reporting only the job ID."""
+        return [self.sbatch_exe, '--parsable']
+
+    def build_submit_args(self, job, root_dir):
+        """Returns the list of sbatch options for the passed job.
+
+        Jobs are held until their dependencies have finished, whatever
+        their exit status (afterany), as with SGE holds. Tasks held on the
+        matching tasks of another array (aftercorr) are only released if
+        those tasks succeed, so jobs whose dependencies can never be met are
+        cancelled by SLURM (--kill-on-invalid-dep) rather than left pending.
+        """
+        args = ['--job-name=%s' % job.name,
+                '--output=%s/%%x.%%A.%%a.out' % job.out,
+                '--error=%s/%%x.%%A.%%a.err' % job.err]
+        if job.threads > 1:
+            args.append('--cpus-per-task=%d' % job.threads)
+        if isinstance(job, JobGroup):
+            args.append('--array=1-%d' % job.tasks)
+        dependencies = ['afterany:%s' % dep.jobid for dep in
+                        job.dependencies]
+        if isinstance(job, JobGroup):
+            dependencies += ['aftercorr:%s' % dep.jobid for dep in
+                             job.task_dependencies]
+        if len(dependencies):
+            args += ['--dependency=%s' % ','.join(dependencies),
+                     '--kill-on-invalid-dep=yes']
+        return args
+
+    def parse_jobid(self, output):
+        """Returns the job ID from sbatch --parsable output, which is <ID>
+        or <ID>;<cluster>.
+        """
+        return output.strip().split(';', 1)[0]
+
+    def poll(self, jobs):
+        """Updates the state of the passed jobs from one call to squeue.
+
+        squeue lists the user's queued and running jobs, with array tasks
+        under the ID of their array job. The final state of jobs that have
+        left the queue is looked up with a single call to sacct.
+        """
+        result = subprocess.run([self.squeue_exe, '--noheader',
+                                 '--user=%s' % getpass.getuser(),
+                                 '--format=%F %t'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, check=True,
+                                universal_newlines=True)
+        states = defaultdict(set)
+        for line in result.stdout.splitlines():
+            if len(line.split()) == 2:
+                jobid, state = line.split()
+                states[jobid].add(state)
+        outstanding, finished = [], []
+        for job in jobs:
+            if job.jobid in states:
+                job.state = ','.join(sorted(states[job.jobid]))
+                outstanding.append(job)
+            else:
+                job.state = None
+                job.finished = True
+                finished.append(job)
+        if self.sacct_exe is not None and len(finished):
+            self.get_final_states(finished)
+        return outstanding
+
+    def get_final_states(self, jobs):
+        """Sets the state of the passed finished jobs from one call to sacct.
+
+        Each job's state is the set of states of its tasks (e.g. COMPLETED,
+        FAILED, CANCELLED).
+        """
+        result = subprocess.run([self.sacct_exe, '--noheader', '--parsable2',
+                                 '--allocations', '--format=JobID,State',
+                                 '--jobs=%s' % ','.join([job.jobid for job in
+                                                         jobs])],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, check=True,
+                                universal_newlines=True)
+        states = defaultdict(set)
+        for line in result.stdout.splitlines():
+            if '|' in line:
+                jobid, state = line.split('|', 1)
+                states[jobid.split('_', 1)[0]].add(state.split()[0])
+        for job in jobs:
+            if job.jobid in states:
+                job.state = ','.join(sorted(states[job.jobid]))
+
+    def is_error_state(self, state):
+        """Returns True if SLURM reports a job that failed or was stopped."""
+        return state is not None and \
+            any([code in state for code in ('FAILED', 'CANCELLED', 'TIMEOUT',
+                                            'OUT_OF_MEMORY', 'NODE_FAIL')])
+
+
+# Parse qstat XML output into job states
+def parse_qstat_xml(xmltext, field='JB_job_number'):
+    """Returns a dictionary of job states, keyed by job ID, from the passed
+    qstat -xml output.
+
+    - xmltext     String, the XML written by qstat -xml
+    - field       String, the qstat field to key jobs by (e.g. 'JB_name')
+
+    Each value is the set of state codes (e.g. 'qw', 'r', 'Eqw') reported
+    for the job's tasks.
+    """
+    states = defaultdict(set)
+    for joblist in ElementTree.fromstring(xmltext).iter('job_list'):
+        key = joblist.findtext(field)
+        if key is not None:
+            states[key].add(joblist.findtext('state', ''))
+    return states
+
+
+def get_job_reference(job):
+    """Returns the scheduler job ID of the passed job, or its name if it was
+    not submitted by pyani.
+    """
+    if job.jobid is None:
+        return job.name
+    return job.jobid
@@ -18,6 +18,10 @@ MAKEBLASTDB_DEFAULT = "makeblastdb"
 BLASTALL_DEFAULT = "blastall"
 FORMATDB_DEFAULT = "formatdb"
 QSUB_DEFAULT = "qsub"
+QSTAT_DEFAULT = "qstat"
+SBATCH_DEFAULT = "sbatch"
+SQUEUE_DEFAULT = "squeue"
+SACCT_DEFAULT = "sacct"
 
 # Stems for output files
 ANIM_FILESTEMS = ("ANIm_alignment_lengths", "ANIm_percentage_identity",
@@ -27,17 +31,49 @@ ANIB_FILESTEMS = ("ANIb_alignment_lengths", "ANIb_percentage_identity",
                   "ANIb_alignment_coverage", "ANIb_similarity_errors",
                   "ANIb_hadamard")
 TETRA_FILESTEMS = ("TETRA_correlations",)
+ANIKMER_FILESTEMS = ("ANIkmer_alignment_lengths",
+                     "ANIkmer_percentage_identity",
+                     "ANIkmer_alignment_coverage",
+                     "ANIkmer_similarity_errors",
+                     "ANIkmer_hadamard")
 ANIBLASTALL_FILESTEMS = ("ANIblastall_alignment_lengths",
                          "ANIblastall_percentage_identity",
                          "ANIblastall_alignment_coverage",
                          "ANIblastall_similarity_errors",
                          "ANIblastall_hadamard")
+# Genome cluster assignments from --dereplicate
+DEREP_FILESTEM = "ANIm_clusters"
 
 # Output subdirectory names for each method
 ALIGNDIR = {'ANIm': 'nucmer_output',
             'ANIb': 'blastn_output',
             'ANIblastall': 'blastall_output'}
 
+# Sharded output layout: levels of subdirectories, named by hex digits of a
+# hash of each output's name (two levels of 256 each)
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+# Manifest of expected pairwise output files, in each output subdirectory
+MANIFEST = "manifest.tab"
+
+# Size of the blocks compressed in parallel when archiving output (bytes)
+ARCHIVE_BLOCKSIZE = 4 * 1024 ** 2
+
+# MinHash sketches for the --prefilter estimate of ANI: k-mer size, and
+# number of hashes kept per genome
+SKETCH_KMER = 21
+SKETCH_SIZE = 1000
+# Scaled sketches for ANIkmer keep about one in every SKETCH_SCALE k-mers
+SKETCH_SCALE = 200
+
+# E-value threshold for ANIb BLASTN searches
+BLASTN_EVALUE = 1e-15
+
+# Names of the combined ANIb database, and its genome index file
+COMBINED_DB = "combined_genomes"
+COMBINED_GENOMES = "combined_genomes.json"
+
 # Any valid matplotlib colour map can be used here
 # See, e.g. http://matplotlib.org/xkcd/examples/color/colormaps_reference.html
 MPL_CBAR = 'Spectral'
@@ -45,8 +81,40 @@ MPL_CBAR = 'Spectral'
 # Parameters for analyses
 FRAGSIZE = 1020  # Default ANIb fragment size
 
+# Estimated peak memory use (bytes) per base of input sequence, for admitting
+# jobs to the local scheduler within a --max_memory budget. These are
+# deliberately generous allowances, rather than measurements for any one
+# platform or program version:
+# - NUCmer holds a suffix tree of the reference in memory, of the order of
+#   10-20 bytes per base; --maxmatch also keeps all non-unique matches, and
+#   is allowed three times as much
+# - BLASTN holds the database 2-bit packed, and small per-fragment hit
+#   lists, so needs well under 2 bytes per base
+# To check them for a given installation, run a single comparison under
+# /usr/bin/time -v and divide the "Maximum resident set size" by the
+# combined length of the two genomes. If they are too low for a system,
+# the --memory_scale option scales all estimates up.
+NUCMER_MEMORY_PER_BASE = 20
+NUCMER_MAXMATCH_MEMORY_PER_BASE = 60
+BLASTN_MEMORY_PER_BASE = 2
+
+# Chunking of short jobs: batches of jobs run one after another as a single
+# scheduler task (see pyani_jobs.chunk_jobs())
+CHUNK_MAXSIZE = 100  # Most jobs in one chunk
+CHUNKS_PER_WORKER = 4  # Target chunks per core for local runs, for balance
+SGE_CHUNKS = 1000  # Target chunks (array tasks) per layer of SGE jobs
+STREAM_LOOKAHEAD = 16  # Jobs generated ahead, per core, for local streams
+MEMORY_LOOKAHEAD = 100  # Queued jobs checked for one that fits free memory
+MEMORY_BACKFILL = 16  # Jobs started past one waiting for memory, before
+                      # no more are, until it fits
+
 # SGE/OGE scheduler parameters
 SGE_WAIT = 0.01  # Base unit of time (s) to wait between polling SGE
+SGE_PE = "smp"   # Parallel environment for multithreaded jobs
+SGE_MAXWAIT = 60  # Longest time (s) to wait between polling SGE
+SGE_INDEX_WIDTH = 16  # Bytes per record in array job command file indexes
+SGE_RESCANS = 2  # Scans for the sentinels of jobs that have left SGE, as
+                 # shared filesystems may show new files late
 
 # Custom Matplotlib colourmaps
 # 1a) Map for species boundaries (95%: 0.95), blue for values at
@@ -121,6 +189,13 @@ def params_mpl(df):
             'ANIm_similarity_errors': ('afmhot', df.values.min(),
                                        df.values.max()),
             'TETRA_correlations': ('spbnd_BuRd', 0, 1),
+            'ANIkmer_alignment_lengths': ('afmhot', df.values.min(),
+                                          df.values.max()),
+            'ANIkmer_percentage_identity': ('spbnd_BuRd', 0, 1),
+            'ANIkmer_alignment_coverage': ('BuRd', 0, 1),
+            'ANIkmer_hadamard': ('hadamard_BuRd', 0, 1),
+            'ANIkmer_similarity_errors': ('afmhot', df.values.min(),
+                                          df.values.max()),
             'ANIblastall_alignment_lengths': ('afmhot', df.values.min(),
                                               df.values.max()),
             'ANIblastall_percentage_identity': ('spbnd_BuRd', 0, 1),
@@ -7,10 +7,15 @@
 
 """Code to help handle files for average nucleotide identity calculations."""
 
+import hashlib
+import heapq
+import operator
 import os
 
 from Bio import SeqIO
 
+from .pyani_config import MANIFEST, SHARD_LEVELS, SHARD_WIDTH
+
 
 # Get a list of FASTA files from the input directory
 def get_fasta_files(dirname):
@@ -35,18 +40,251 @@ def get_input_files(dirname, *ext):
     return [os.path.join(dirname, f) for f in filelist]
 
 
+# Get files in a (possibly sharded) output directory
+def get_sharded_files(dirname, *ext):
+    """Returns files in passed directory and its shard subdirectories,
+    filtered by extension.
+
+    - dirname - path to output directory
+    - *ext - list of arguments describing permitted file extensions
+
+    Output directories may be flat, or sharded into SHARD_LEVELS levels of
+    subdirectories (see get_shard()). Each directory is read once with
+    os.scandir(), and only subdirectories named as shards are descended,
+    so no single, very large, directory listing is needed.
+    """
+    filelist = []
+    dirs = [(dirname, 0)]
+    while len(dirs):
+        path, level = dirs.pop()
+        for entry in os.scandir(path):
+            if entry.is_dir():
+                if level < SHARD_LEVELS and is_shard_name(entry.name):
+                    dirs.append((entry.path, level + 1))
+            elif os.path.splitext(entry.name)[-1] in ext:
+                filelist.append(entry.path)
+    return filelist
+
+
+# Get the shard subdirectory for an output file
+def get_shard(name):
+    """Returns the relative shard subdirectory for the passed output name.
+
+    - name - output file name (or stem), e.g. org1_vs_org2
+
+    The shard is SHARD_LEVELS nested directories, each named by SHARD_WIDTH
+    hex digits of the MD5 digest of the name, so that outputs are spread
+    evenly, and the shard for any output can be found from its name alone.
+    """
+    digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+    return os.path.join(*[digest[level * SHARD_WIDTH:
+                                 (level + 1) * SHARD_WIDTH] for
+                          level in range(SHARD_LEVELS)])
+
+
+def is_shard_name(dirname):
+    """Returns True if the passed directory name is a shard name."""
+    return len(dirname) == SHARD_WIDTH and \
+        all([char in "0123456789abcdef" for char in dirname])
+
+
+# Get the pairs of input files to compare
+def iter_pairs(filenames, references=None, sizes=None, cost=operator.mul):
+    """Yields (filename1, filename2) for each comparison to be made.
+
+    - filenames - list of paths to input files
+    - references - list of paths to reference input files (optional)
+    - sizes - dictionary of sizes (e.g. sequence lengths), keyed by path
+    (optional)
+    - cost - function giving the estimated cost of a comparison from the
+    sizes of its two files, which must not decrease as either size grows
+    (default: their product)
+
+    By default, each unordered pair of input files is yielded once, in
+    input order (all-vs-all). If references are given, the input files are
+    queries, and each (query, reference) pair is yielded instead.
+
+    If sizes are given, the same pairs are yielded in decreasing order of
+    estimated cost instead (longest processing time first), so that runners
+    that start jobs as they are generated still start the largest
+    comparisons first. The files are sorted by size, and the largest
+    remaining pair is taken from a heap holding the next pair for each
+    file, so the pairs are never all held at once.
+    """
+    if sizes is not None:
+        for pair in iter_pairs_by_cost(filenames, references, sizes, cost):
+            yield pair
+        return
+    if references is None:
+        for idx, fname1 in enumerate(filenames[:-1]):
+            for fname2 in filenames[idx + 1:]:
+                yield fname1, fname2
+    else:
+        for fname1 in filenames:
+            for fname2 in references:
+                yield fname1, fname2
+
+
+# Generate pairs of files in decreasing order of estimated cost
+def iter_pairs_by_cost(filenames, references, sizes, cost):
+    """Yields the pairs of iter_pairs(), largest estimated cost first.
+
+    See iter_pairs() for the arguments. Files of equal size are taken in
+    input order, and each all-vs-all pair is yielded in input order, as by
+    iter_pairs() without sizes.
+    """
+    position = {fname: idx for idx, fname in enumerate(filenames)}
+    rows = sorted(filenames, key=lambda fname: (-sizes[fname],
+                                                position[fname]))
+    if references is None:
+        columns = rows  # Each file is paired with the files after it
+        starts = range(1, len(rows) + 1)
+    else:
+        columns = [fname for _, fname in
+                   sorted(enumerate(references),
+                          key=lambda col: (-sizes[col[1]], col[0]))]
+        starts = [0] * len(rows)
+    heap = [(-cost(sizes[fname], sizes[columns[col]]), row, col) for
+            row, (fname, col) in enumerate(zip(rows, starts)) if
+            col < len(columns)]
+    heapq.heapify(heap)
+    while len(heap):
+        _, row, col = heapq.heappop(heap)
+        if references is None:
+            yield tuple(sorted((rows[row], columns[col]),
+                               key=position.get))
+        else:
+            yield rows[row], columns[col]
+        if col + 1 < len(columns):
+            heapq.heappush(heap, (-cost(sizes[rows[row]],
+                                        sizes[columns[col + 1]]),
+                                  row, col + 1))
+
+
+# Get pairwise output files, from a manifest or the output directory
+def get_pairwise_outputs(dirname, ext, names, logger=None):
+    """Yields (query, subject, path) for each pairwise output file.
+
+    - dirname - path to output directory
+    - ext - extension of the output files, e.g. '.filter'
+    - names - collection of input sequence names (e.g. a dictionary keyed
+    by name), used to split file names when there is no manifest
+    - logger - a logger for messages (optional)
+
+    If the directory has a manifest (see write_manifest_line()), the
+    outputs it lists are yielded in manifest order, and only those files
+    are read; listed outputs that do not exist are skipped, with a
+    warning. Otherwise, files with the passed extension are found in the
+    directory and its shard subdirectories (see get_sharded_files()), and
+    each <query>_vs_<subject> file name is split into sequence names with
+    split_pair_name().
+    """
+    manifest = os.path.join(dirname, MANIFEST)
+    if os.path.isfile(manifest):
+        with open(manifest, 'r') as ifh:
+            for line in ifh:
+                qname, sname, path = line.rstrip('\n').split('\t')
+                if os.path.splitext(path)[-1] != ext:
+                    continue
+                path = os.path.join(dirname, path)
+                if not os.path.isfile(path):
+                    if logger:
+                        logger.warning("Expected output %s is missing, "
+                                       "skipping", path)
+                    continue
+                yield qname, sname, path
+        return
+    for path in get_sharded_files(dirname, ext):
+        stem = os.path.splitext(os.path.split(path)[-1])[0]
+        qname, sname = split_pair_name(stem, names)
+        yield qname, sname, path
+
+
+# Split a pairwise output file name into sequence names
+def split_pair_name(stem, names):
+    """Returns (query, subject) names from a <query>_vs_<subject> stem.
+
+    - stem - file name, without extension
+    - names - collection of input sequence names
+
+    Sequence names may themselves contain '_vs_', so each possible split is
+    tried, and the first that gives two known names is returned. If none
+    does, the split at the first '_vs_' is returned.
+    """
+    parts = stem.split('_vs_')
+    for idx in range(1, len(parts)):
+        qname, sname = '_vs_'.join(parts[:idx]), '_vs_'.join(parts[idx:])
+        if qname in names and sname in names:
+            return qname, sname
+    return parts[0], '_vs_'.join(parts[1:])
+
+
+# Record an expected pairwise output file in a manifest
+def write_manifest_line(handle, qname, sname, path):
+    """Writes a manifest line for one pairwise output file.
+
+    - handle - open file handle for the manifest (pyani_config.MANIFEST, in
+    the output directory)
+    - qname - query sequence name
+    - sname - subject sequence name
+    - path - path to the output file, relative to the output directory
+
+    Each line is <query>\t<subject>\t<path>, so results can be read without
+    listing the output directory or parsing file names.
+    """
+    handle.write("%s\t%s\t%s\n" % (qname, sname, path))
+
+
 # Get lengths of input sequences
-def get_sequence_lengths(fastafilenames):
+def get_sequence_lengths(fastafilenames, digests=None):
     """Returns dictionary of sequence lengths, keyed by organism.
 
+    - fastafilenames - paths to FASTA files, one per organism
+    - digests - dictionary to fill with a digest of each organism's
+    sequence content, keyed by organism (optional)
+
     Biopython's SeqIO module is used to parse all sequences in the FASTA
     file corresponding to each organism, and the total base count in each
     is obtained.
 
+    If a digests dictionary is passed, the sequence content of each
+    organism is hashed as it is read. Sequences are normalised to upper
+    case, and their hashes are sorted, so that the digest does not depend
+    on sequence names, line length or record order: organisms with the
+    same digest have identical sequences (see get_duplicates()).
+
     NOTE: ambiguity symbols are not discounted.
     """
     tot_lengths = {}
     for fn in fastafilenames:
-        tot_lengths[os.path.splitext(os.path.split(fn)[-1])[0]] = \
-            sum([len(s) for s in SeqIO.parse(fn, 'fasta')])
+        org = os.path.splitext(os.path.split(fn)[-1])[0]
+        seqdigests = []
+        tot_lengths[org] = 0
+        for seq in SeqIO.parse(fn, 'fasta'):
+            tot_lengths[org] += len(seq)
+            if digests is not None:
+                seqdigests.append(hashlib.md5(
+                    str(seq.seq).upper().encode()).hexdigest())
+        if digests is not None:
+            digests[org] = hashlib.md5(
+                '\n'.join(sorted(seqdigests)).encode()).hexdigest()
     return tot_lengths
+
+
+# Find organisms with identical sequences
+def get_duplicates(digests):
+    """Returns dictionary of representative organisms, keyed by duplicate.
+
+    - digests - dictionary of sequence content digests, keyed by organism,
+    from get_sequence_lengths()
+
+    The first organism (in dictionary order) with each digest represents
+    it; every later organism with the same digest is a duplicate.
+    """
+    representatives, duplicates = {}, {}
+    for org, digest in digests.items():
+        if digest in representatives:
+            duplicates[org] = representatives[digest]
+        else:
+            representatives[digest] = org
+    return duplicates
@@ -67,11 +67,11 @@ def clean_axis(axis):
 
 
 # Add classes colorbar to Seaborn plot
-def get_seaborn_colorbar(dfr, classes):
+def get_seaborn_colorbar(dfr, classes, orientation='row'):
     """Return a colorbar representing classes, for a Seaborn plot.
 
-    The aim is to get a pd.Series for the passed dataframe columns,
-    in the form:
+    The aim is to get a pd.Series for the passed dataframe rows (or
+    columns, if orientation is 'col'), in the form:
     0    colour for class in col 0
     1    colour for class in col 1
     ...  colour for class in col ...
@@ -84,35 +84,42 @@ def get_seaborn_colorbar(dfr, classes):
                                                  reverse=True,
                                                  start=1, rot=-2))}
     lvl_pal = {cls: paldict[lvl] for (cls, lvl) in list(classes.items())}
-    col_cb = pd.Series(dfr.index).map(lvl_pal)
+    names = dfr.index if orientation == 'row' else dfr.columns
+    col_cb = pd.Series(names).map(lvl_pal)
     # The col_cb Series index now has to match the dfr.index, but
     # we don't create the Series with this (and if we try, it
     # fails) - so change it with this line
-    col_cb.index = dfr.index
+    col_cb.index = names
     return col_cb
 
 
 # Get safe Seaborn labels
-def get_safe_seaborn_labels(dfr, labels):
-    """Returns labels guaranteed to correspond to the dataframe."""
+def get_safe_seaborn_labels(dfr, labels, orientation='row'):
+    """Returns labels guaranteed to correspond to the dataframe rows (or
+    columns, if orientation is 'col')."""
+    names = dfr.index if orientation == 'row' else dfr.columns
     if labels is not None:
-        return [labels.get(i, i) for i in dfr.index]
-    return [i for i in dfr.index]
+        return [labels.get(i, i) for i in names]
+    return [i for i in names]
 
 
 # Return a clustermap
 def get_seaborn_clustermap(dfr, params, title=None, annot=True):
     """Returns a Seaborn clustermap."""
+    # Query-vs-reference output may not be square, and a single row or
+    # column cannot be clustered
     fig = sns.clustermap(dfr,
                          cmap=params.cmap,
                          vmin=params.vmin,
                          vmax=params.vmax,
-                         col_colors=params.colorbar,
+                         col_colors=params.colcolorbar,
                          row_colors=params.colorbar,
+                         row_cluster=dfr.shape[0] > 1,
+                         col_cluster=dfr.shape[1] > 1,
                          figsize=(params.figsize,
                                   params.figsize),
                          linewidths=params.linewidths,
-                         xticklabels=params.labels,
+                         xticklabels=params.collabels,
                          yticklabels=params.labels,
                          annot=annot)
     fig.cax.yaxis.set_label_position('left')
@@ -140,24 +147,27 @@ def heatmap_seaborn(dfr, outfilename=None, title=None, params=None):
     # aesthetics, and a maximum to avoid core dumps on rendering.
     # If we hit the maximum size, we should modify font size.
     maxfigsize = 120
-    calcfigsize = dfr.shape[0] * 1.1
+    calcfigsize = max(dfr.shape) * 1.1
     figsize = min(max(8, calcfigsize), maxfigsize)
     if figsize == maxfigsize:
         scale = maxfigsize/calcfigsize
         sns.set_context("notebook", font_scale=scale)
 
-    # Add a colorbar?
+    # Add colorbars?
     if params.classes is None:
-        col_cb = None
+        row_cb, col_cb = None, None
     else:
-        col_cb = get_seaborn_colorbar(dfr, params.classes)
+        row_cb = get_seaborn_colorbar(dfr, params.classes)
+        col_cb = get_seaborn_colorbar(dfr, params.classes, 'col')
 
     # Labels are defined before we build the clustering
     # If a label mapping is missing, use the key text as fall back
+    params.collabels = get_safe_seaborn_labels(dfr, params.labels, 'col')
     params.labels = get_safe_seaborn_labels(dfr, params.labels)
 
     # Add attributes to parameter object, and draw heatmap
-    params.colorbar = col_cb
+    params.colorbar = row_cb
+    params.colcolorbar = col_cb
     params.figsize = figsize
     params.linewidths = 0.25
     fig = get_seaborn_clustermap(dfr, params, title=title)
@@ -175,7 +185,8 @@ def add_mpl_dendrogram(dfr, fig, heatmap_gs, orientation='col'):
     """Return a dendrogram and corresponding gridspec, attached to the fig
 
     Modifies the fig in-place. Orientation is either 'row' or 'col' and
-    determines location and orientation of the rendered dendrogram.
+    determines location and orientation of the rendered dendrogram. A
+    single row or column is not clustered, and has no dendrogram.
     """
     # Row or column axes?
     if orientation == 'row':
@@ -197,9 +208,12 @@ def add_mpl_dendrogram(dfr, fig, heatmap_gs, orientation='col'):
                                              wspace=0.0, hspace=0.1,
                                              height_ratios=height_ratios)
     dend_axes = fig.add_subplot(gspec[0, 0])
-    dend = sch.dendrogram(sch.linkage(dists, method='complete'),
-                          color_threshold=np.inf,
-                          orientation=orient)
+    if len(dists) > 1:
+        dend = sch.dendrogram(sch.linkage(dists, method='complete'),
+                              color_threshold=np.inf,
+                              orientation=orient)
+    else:
+        dend = {'leaves': list(range(len(dists)))}
     clean_axis(dend_axes)
     return {'dendrogram': dend,
             'gridspec': gspec}
@@ -210,7 +224,7 @@ def get_mpl_heatmap_axes(dfr, fig, heatmap_gs):
     """Return axis for Matplotlib heatmap."""
     # Create heatmap axis
     heatmap_axes = fig.add_subplot(heatmap_gs[1, 1])
-    heatmap_axes.set_xticks(np.linspace(0, dfr.shape[0]-1, dfr.shape[0]))
+    heatmap_axes.set_xticks(np.linspace(0, dfr.shape[1]-1, dfr.shape[1]))
     heatmap_axes.set_yticks(np.linspace(0, dfr.shape[0]-1, dfr.shape[0]))
     heatmap_axes.grid('off')
     heatmap_axes.xaxis.tick_bottom()
@@ -220,7 +234,8 @@ def get_mpl_heatmap_axes(dfr, fig, heatmap_gs):
 
 def add_mpl_colorbar(dfr, fig, dend, params, orientation='row'):
     """Add class colorbars to Matplotlib heatmap."""
-    for name in dfr.index[dend['dendrogram']['leaves']]:
+    names = dfr.index if orientation == 'row' else dfr.columns
+    for name in names[dend['dendrogram']['leaves']]:
         if name not in params.classes:
             params.classes[name] = name
 
@@ -230,7 +245,7 @@ def add_mpl_colorbar(dfr, fig, dend, params, orientation='row'):
 
     # colourbar
     cblist = []
-    for name in dfr.index[dend['dendrogram']['leaves']]:
+    for name in names[dend['dendrogram']['leaves']]:
         try:
             cblist.append(classdict[params.classes[name]])
         except KeyError:
@@ -308,8 +323,8 @@ def heatmap_mpl(dfr, outfilename=None, title=None, params=None):
                 labels
     """
     # Layout figure grid and add title
-    # Set figure size by the number of rows in the dataframe
-    figsize = max(8, dfr.shape[0] * 0.175)
+    # Set figure size by the number of rows or columns in the dataframe
+    figsize = max(8, max(dfr.shape) * 0.175)
     fig = plt.figure(figsize=(figsize, figsize))
     # if title:
     #     fig.suptitle(title)
@@ -325,8 +340,8 @@ def heatmap_mpl(dfr, outfilename=None, title=None, params=None):
 
     # Add heatmap axes to figure, with rows/columns as in the dendrograms
     heatmap_axes = get_mpl_heatmap_axes(dfr, fig, heatmap_gs)
-    ax_map = heatmap_axes.imshow(dfr.ix[rowdend['dendrogram']['leaves'],
-                                        coldend['dendrogram']['leaves']],
+    ax_map = heatmap_axes.imshow(dfr.iloc[rowdend['dendrogram']['leaves'],
+                                          coldend['dendrogram']['leaves']],
                                  interpolation='nearest',
                                  cmap=params.cmap, origin='lower',
                                  vmin=params.vmin, vmax=params.vmax,
@@ -342,7 +357,7 @@ def heatmap_mpl(dfr, outfilename=None, title=None, params=None):
     # Add heatmap labels
     add_mpl_labels(heatmap_axes,
                    dfr.index[rowdend['dendrogram']['leaves']],
-                   dfr.index[coldend['dendrogram']['leaves']],
+                   dfr.columns[coldend['dendrogram']['leaves']],
                    params)
 
 
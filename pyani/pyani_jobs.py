@@ -29,10 +29,11 @@ This code is essentially a frozen and cut-down version of pysge
 (https://github.com/widdowquinn/pysge)
 """
 
+import math
 import os
 import time
 
-from .pyani_config import SGE_WAIT
+from .pyani_config import CHUNK_MAXSIZE, SGE_INDEX_WIDTH, SGE_WAIT
 
 ###
 # CLASSES
@@ -43,21 +44,79 @@ from .pyani_config import SGE_WAIT
 class Job:
     """Objects in this class represent individual jobs to be run, with a list
     of dependencies (jobs that must be run first).
+
+    Analyses can create millions of Jobs, so attributes are held in slots
+    rather than a per-instance dictionary, and the command line may be held
+    as a template and a tuple of arguments, which is only rendered when the
+    command is needed. The template and most arguments can then be shared
+    between Jobs.
     """
-    def __init__(self, name, command, queue=None):
+    __slots__ = ('name', 'queue', 'template', 'args', 'threads', 'cost',
+                 'memory', 'scriptpath', 'out', 'err', 'dependencies',
+                 'submitted', 'finished', 'state', 'returncode', 'jobid')
+
+    def __init__(self, name, command, queue=None, threads=1, cost=0,
+                 memory=0, args=None):
         """Instantiates a Job object.
 
         - name           String describing the job (uniquely)
-        - command        String, the valid shell command to run the job
+        - command        String, the valid shell command to run the job, or
+                         a command template if args is given
         - queue          String, the SGE queue under which the job shall run
+        - threads        Int, the number of cores the job will use
+        - cost           Number, estimated relative cost of running the job
+        - memory         Int, estimated peak memory use of the job (bytes)
+        - args           Tuple of arguments to fill the command template
+                         with str.format(); None if command is complete
         """
         self.name = name                 # Unique name for the job
         self.queue = queue               # The SGE queue to run the job under
-        self.command = command           # Command line to run for this job
-        self.script = command
-        self.scriptPath = None           # Will hold path to the script file
+        self.template = command          # Command line (template) for job
+        self.args = args                 # Arguments for command template
+        self.threads = threads           # Number of cores the job uses
+        self.cost = cost                 # Estimated cost, for job ordering
+        self.memory = memory             # Estimated memory use (bytes)
+        self.scriptpath = None           # Will hold path to the script file
+        self.out = None                  # Scheduler STDOUT directory
+        self.err = None                  # Scheduler STDERR directory
         self.dependencies = []           # List of jobs to be completed first
         self.submitted = False           # Flag: is job submitted?
+        self.finished = False            # Flag: has job left the scheduler?
+        self.state = None                # Last scheduler state seen for job
+        self.returncode = None           # Exit code, once the job has run
+        self.jobid = None                # Scheduler job ID, once submitted
+
+    @property
+    def command(self):
+        """The command line to run for this job."""
+        if self.args is None:
+            return self.template
+        return self.template.format(*self.args)
+
+    @command.setter
+    def command(self, command):
+        """Replaces the job's command line with a complete command."""
+        self.template, self.args = command, None
+
+    @property
+    def script(self):
+        """The script to run for this job: its command line."""
+        return self.command
+
+    @script.setter
+    def script(self, script):
+        """Replaces the job's script (its command line)."""
+        self.command = script
+
+    @property
+    def scriptPath(self):
+        """Path to the job's script file, once written (alias)."""
+        return self.scriptpath
+
+    @scriptPath.setter
+    def scriptPath(self, path):
+        """Sets the path to the job's script file (alias)."""
+        self.scriptpath = path
 
     def add_dependency(self, job):
         """Add the passed job to the dependency list for this Job.  This
@@ -75,17 +134,23 @@ class Job:
         self.dependencies.remove(job)
 
     def wait(self, interval=SGE_WAIT):
-        """Wait until the job finishes, and poll SGE on its status."""
+        """Wait until the job finishes, and poll SGE on its status.
+
+        This calls qstat once per poll for this job alone; to wait for many
+        jobs, use run_sge.wait_for_jobs(), which polls for all of them at once.
+        """
         finished = False
         while not finished:
             time.sleep(interval)
             interval = min(2 * interval, 60)
-            finished = os.system("qstat -j %s > /dev/null" % (self.name))
+            finished = os.system("qstat -j %s > /dev/null" %
+                                 (self.jobid or self.name))
 
 
 class JobGroup:
     """ Class that stores a group of jobs, permitting parameter sweeps."""
-    def __init__(self, name, command, queue=None, arguments=None):
+    def __init__(self, name, command, queue=None, arguments=None,
+                 threads=1, commands=None):
         """ Instantiate a JobGroup object.  JobGroups allow for the use of
         combinatorial parameter sweeps by using the 'command' and 'arguments'
         arguments.
@@ -97,6 +162,11 @@ class JobGroup:
         - arguments         Dictionary, the values for each parameter as
                             lists of strings, keyed by an identifier for
                             the command string
+        - threads           Int, the number of cores each task will use
+        - commands          List of strings, one complete command line per
+                            task. If given, command and arguments are
+                            ignored, and each task reads its command line
+                            from a command file (see write_command_file())
 
         For example, to use a command 'my_cmd' with the arguments
         '-foo' and '-bar' having values 1, 2, 3, 4 and 'a', 'b', 'c', 'd' in
@@ -104,22 +174,37 @@ class JobGroup:
         command='my_cmd $SGE_TASK_ID -foo $fooargs -bar $barargs'
         arguments='{'fooargs': ['1','2','3','4'],
                     'barargs': ['a','b','c','d']}
+
+        To run a list of unrelated command lines as an array instead, pass
+        them as commands; the script then stays the same size however many
+        tasks there are.
         """
         self.name = name               # Set JobQueue name
         self.queue = queue             # Set SGE queue to request
         self.command = command         # Set command string
+        self.threads = threads         # Set cores used by each task
         self.dependencies = []         # Create empty list for dependencies
+        self.task_dependencies = []    # JobGroups to hold task-by-task
         self.submitted = True          # Set submitted Boolean
+        self.finished = False          # Set finished Boolean
+        self.state = None              # Last scheduler state seen for group
+        self.returncode = None         # Summed task exit codes, once run
+        self.jobid = None              # Scheduler job ID, once submitted
         if arguments is not None:
             self.arguments = arguments # Dictionary of arguments for command
         else:
             self.arguments = {}
+        self.commands = commands       # Command line for each task
+        self.commandfile = "%s.cmds" % name  # Set by write_command_file()
         self.generate_script()         # Make SGE script for sweep/array
 
     def generate_script(self):
         """Create the SGE script that will run the jobs in the JobGroup, with
         the passed arguments.
         """
+        if self.commands is not None:
+            self.generate_commandfile_script()
+            return
         self.script = ""        # Holds the script string
         total = 1               # total number of jobs in this group
 
@@ -153,6 +238,43 @@ class JobGroup:
         # set the number of tasks in this group
         self.tasks = total
 
+    def generate_commandfile_script(self):
+        """Create the SGE script that runs line $SGE_TASK_ID of the command
+        file.
+
+        The command file is accompanied by an index of fixed-width byte
+        offsets (<command file>.idx), so each task reads one index record
+        and seeks straight to its command line, however long the file is.
+        """
+        self.script = "".join([
+            'CMDFILE=%s\n' % self.commandfile,
+            'OFFSET=$(dd if=$CMDFILE.idx bs=%d skip=$(($SGE_TASK_ID - 1)) '
+            'count=1 2>/dev/null)\n' % SGE_INDEX_WIDTH,
+            'CMD=$(tail -c +$(($OFFSET + 1)) $CMDFILE | head -n 1)\n',
+            '\n',
+            'eval "$CMD"\n'])
+        self.tasks = len(self.commands)
+
+    def write_command_file(self, dirname):
+        """Write the JobGroup's command file and its offset index to the
+        passed directory, and regenerate the script to read from them.
+
+        - dirname      String, path to the directory for the command file
+        """
+        self.commandfile = os.path.join(dirname, "%s.cmds" % self.name)
+        offset, offsets = 0, []
+        with open(self.commandfile, 'wb') as ofh:
+            for command in self.commands:
+                line = ("%s\n" % command).encode()
+                offsets.append(offset)
+                ofh.write(line)
+                offset += len(line)
+        with open(self.commandfile + '.idx', 'wb') as ofh:
+            for offset in offsets:
+                ofh.write(("%*d\n" % (SGE_INDEX_WIDTH - 1,
+                                      offset)).encode())
+        self.generate_script()
+
     def add_dependency(self, job):
         """Add the passed job to the dependency list for this JobGroup.  This
         JobGroup should not execute until all dependent jobs are completed
@@ -161,6 +283,15 @@ class JobGroup:
         """
         self.dependencies.append(job)
 
+    def add_task_dependency(self, jobgroup):
+        """Add the passed JobGroup to the task dependency list for this
+        JobGroup. Each task of this JobGroup should not execute until the
+        task with the same index in the passed JobGroup is completed.
+
+        - jobgroup   JobGroup, with the same number of tasks as this one
+        """
+        self.task_dependencies.append(jobgroup)
+
     def remove_dependency(self, job):
         """ Remove the passed job from this JobGroup's dependency list
 
@@ -169,9 +300,92 @@ class JobGroup:
         self.dependencies.remove(job)
 
     def wait(self, interval=SGE_WAIT):
-        """Wait for a defined period, then poll SGE for job status."""
+        """Wait for a defined period, then poll SGE for job status.
+
+        This calls qstat once per poll for this group alone; to wait for many
+        jobs, use run_sge.wait_for_jobs(), which polls for all of them at once.
+        """
         finished = False
         while not finished:
             time.sleep(interval)
             interval = min(2 * interval, 60)
-            finished = os.system("qstat -j %s > /dev/null" % (self.name))
+            finished = os.system("qstat -j %s > /dev/null" %
+                                 (self.jobid or self.name))
+
+
+###
+# FUNCTIONS
+
+
+# Size a job's thread count by its estimated cost
+def get_job_threads(cost, maxcost, threads):
+    """Returns the number of threads for a job of the passed cost.
+
+    - cost           Number, estimated cost of the job
+    - maxcost        Number, estimated cost of the most expensive job
+    - threads        Int, the most threads for any one job
+
+    Threads are given in proportion to cost, rounded up, so that the most
+    expensive jobs get all the threads and the cheapest get one. Without
+    cost estimates, every job gets all the threads.
+    """
+    if threads <= 1 or maxcost <= 0:
+        return max(threads, 1)
+    return max(1, min(threads, int(math.ceil(threads * float(cost) /
+                                             maxcost))))
+
+
+# Batch jobs into chunks that run as a single job
+def chunk_jobs(jobs, chunksize=0, nchunks=1, maxsize=CHUNK_MAXSIZE):
+    """Returns a list of (Job, jobs) tuples, batching the passed jobs.
+
+    - jobs           List of Job objects, with no dependencies between them
+    - chunksize      Int, the number of jobs per chunk; zero to size chunks
+                     automatically from estimated job costs
+    - nchunks        Int, the target number of chunks when sizing
+                     automatically
+    - maxsize        Int, the most jobs in an automatically-sized chunk
+
+    Jobs are batched in the order passed. When sizing automatically, each
+    chunk takes jobs until its total cost would exceed 1/nchunks of the
+    total cost of all jobs (jobs of unknown, zero, cost count as one), so
+    cheap jobs are batched while expensive jobs still run alone.
+
+    Each chunk is returned as a Job that runs its jobs' commands one after
+    another, and exits with the number of commands that failed, alongside
+    the list of jobs it runs. The exit code is capped at 255, as exit
+    codes wrap modulo 256, so that 256 failures are not reported as
+    success. A chunk of one job is returned as that Job.
+    The chunk Jobs have no dependencies; these are left to the caller.
+    """
+    if chunksize > 0:
+        batches = [jobs[idx:idx + chunksize] for idx in
+                   range(0, len(jobs), chunksize)]
+    else:
+        target = sum([max(job.cost, 1) for job in jobs]) / max(nchunks, 1)
+        batches, batch, batchcost = [], [], 0
+        for job in jobs:
+            cost = max(job.cost, 1)
+            if len(batch) and (batchcost + cost > target or
+                               len(batch) >= maxsize):
+                batches.append(batch)
+                batch, batchcost = [], 0
+            batch.append(job)
+            batchcost += cost
+        if len(batch):
+            batches.append(batch)
+    chunks = []
+    for batch in batches:
+        if len(batch) == 1:
+            chunks.append((batch[0], batch))
+            continue
+        command = "fail=0; %s; exit $((fail > 255 ? 255 : fail))" % \
+            '; '.join(["(%s) || fail=$((fail + 1))" % job.command for
+                       job in batch])
+        chunks.append((Job("%s_chunk_%d" % (batch[0].name, len(batch)),
+                           command, queue=batch[0].queue,
+                           threads=max([job.threads for job in batch]),
+                           cost=sum([job.cost for job in batch]),
+                           memory=max([job.memory for job in batch])),
+                       batch))
+    return chunks
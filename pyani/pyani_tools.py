@@ -7,50 +7,92 @@
 
 """Code to support pyani."""
 
+import os
+
 import pandas as pd
 from . import pyani_config
+from .pyani_files import get_shard
 
 
 # Class to hold ANI dataframe results
 class ANIResults(object):
     """Holds ANI dataframe results."""
-    def __init__(self, labels, mode):
-        """Initialise with four empty, labelled dataframes."""
-        self.alignment_lengths = pd.DataFrame(index=labels, columns=labels,
+    def __init__(self, labels, mode, columns=None):
+        """Initialise with four empty, labelled dataframes.
+
+        By default the dataframes are square, with labels as both rows and
+        columns. If columns are given, the dataframes are rectangular, with
+        labels (queries) as rows and columns (references) as columns; as
+        there is no self-comparison, identity and coverage start as NaN
+        (not computed) rather than 1.0.
+        """
+        self.square = columns is None
+        if self.square:
+            columns, fill = labels, 1.0
+        else:
+            fill = float('nan')
+        self.alignment_lengths = pd.DataFrame(index=labels, columns=columns,
                                               dtype=float)
-        self.similarity_errors = pd.DataFrame(index=labels, columns=labels,
+        self.similarity_errors = pd.DataFrame(index=labels, columns=columns,
                                               dtype=float).fillna(0)
-        self.percentage_identity = pd.DataFrame(index=labels, columns=labels,
-                                                dtype=float).fillna(1.0)
-        self.alignment_coverage = pd.DataFrame(index=labels, columns=labels,
-                                               dtype=float).fillna(1.0)
+        self.percentage_identity = pd.DataFrame(index=labels,
+                                                columns=columns,
+                                                dtype=float).fillna(fill)
+        self.alignment_coverage = pd.DataFrame(index=labels, columns=columns,
+                                               dtype=float).fillna(fill)
         self.zero_error = False
         self.mode = mode
 
+    def includes(self, qname, sname):
+        """Return True if the dataframes have a (qname, sname) cell."""
+        return qname in self.alignment_lengths.index and \
+            sname in self.alignment_lengths.columns
+
     def add_tot_length(self, qname, sname, value, sym=True):
         """Add a total length value to self.alignment_lengths."""
         self.alignment_lengths.loc[qname, sname] = value
-        if sym:
+        if sym and self.square:
             self.alignment_lengths.loc[sname, qname] = value
 
     def add_sim_errors(self, qname, sname, value, sym=True):
         """Add a similarity error value to self.similarity_errors."""
         self.similarity_errors.loc[qname, sname] = value
-        if sym:
+        if sym and self.square:
             self.similarity_errors.loc[sname, qname] = value
 
     def add_pid(self, qname, sname, value, sym=True):
         """Add a percentage identity value to self.percentage_identity."""
         self.percentage_identity.loc[qname, sname] = value
-        if sym:
+        if sym and self.square:
             self.percentage_identity.loc[sname, qname] = value
 
     def add_coverage(self, qname, sname, qcover, scover=None):
         """Add percentage coverage values to self.alignment_coverage."""
         self.alignment_coverage.loc[qname, sname] = qcover
-        if scover:
+        if scover and self.square:
             self.alignment_coverage.loc[sname, qname] = scover
 
+    def add_not_computed(self, qname, sname):
+        """Mark a comparison as not computed (NaN), in both directions."""
+        for row, col in ((qname, sname), (sname, qname)):
+            if not self.includes(row, col):
+                continue
+            for dfr in (self.alignment_lengths, self.similarity_errors,
+                        self.percentage_identity, self.alignment_coverage):
+                dfr.loc[row, col] = float('nan')
+
+    def add_duplicates(self, duplicates):
+        """Add results for duplicate sequences, copied from their
+        representatives (see expand_duplicates())."""
+        self.alignment_lengths = expand_duplicates(self.alignment_lengths,
+                                                   duplicates)
+        self.similarity_errors = expand_duplicates(self.similarity_errors,
+                                                   duplicates)
+        self.percentage_identity = expand_duplicates(
+            self.percentage_identity, duplicates)
+        self.alignment_coverage = expand_duplicates(self.alignment_coverage,
+                                                    duplicates)
+
     @property
     def hadamard(self):
         """Return Hadamard matrix (identity * coverage)."""
@@ -61,7 +103,8 @@ class ANIResults(object):
         """Return list of (dataframe, filestem) tuples."""
         stemdict = {"ANIm": pyani_config.ANIM_FILESTEMS,
                     "ANIb": pyani_config.ANIB_FILESTEMS,
-                    "ANIblastall": pyani_config.ANIBLASTALL_FILESTEMS}
+                    "ANIblastall": pyani_config.ANIBLASTALL_FILESTEMS,
+                    "ANIkmer": pyani_config.ANIKMER_FILESTEMS}
         return zip((self.alignment_lengths, self.percentage_identity,
                     self.alignment_coverage, self.similarity_errors,
                     self.hadamard), stemdict[self.mode])
@@ -72,6 +115,54 @@ class ANIResults(object):
         #        (self.hadamard, "ANIm_hadamard")]
 
 
+# Add rows and columns for duplicate sequences to a results dataframe
+def expand_duplicates(dfr, duplicates):
+    """Returns the dataframe with rows/columns added for duplicates.
+
+    - dfr - pandas DataFrame of results, labelled by organism
+    - duplicates - dictionary of representative organisms, keyed by
+    duplicate (see pyani_files.get_duplicates())
+
+    Each duplicate of an organism in the rows (or columns) gets a copy of
+    that organism's row (or column). A duplicate compared with its
+    representative, or another copy of it, so gets the representative's
+    self-comparison value (e.g. identity 1.0).
+    """
+    rows = list(dfr.index) + [dup for dup, org in sorted(duplicates.items())
+                              if org in dfr.index]
+    cols = list(dfr.columns) + [dup for dup, org in
+                                sorted(duplicates.items())
+                                if org in dfr.columns]
+    dfr = dfr.loc[[duplicates.get(name, name) for name in rows],
+                  [duplicates.get(name, name) for name in cols]]
+    dfr.index, dfr.columns = rows, cols
+    return dfr
+
+
+# Make an ANIResults object for a set of sequences
+def get_ani_results(org_lengths, mode, references=None):
+    """Returns an empty ANIResults object for the passed sequences.
+
+    - org_lengths - dictionary of total sequence lengths, keyed by sequence
+    - mode - ANI method, e.g. "ANIm"
+    - references - names of reference sequences (optional)
+
+    By default, results are square (all-vs-all), with the alignment length
+    of each sequence against itself set to its total length. If references
+    are given, results are rectangular: the other sequences (queries) are
+    rows, and the references are columns.
+    """
+    if references is None:
+        results = ANIResults(list(org_lengths.keys()), mode)
+        # Fill diagonal NA values for alignment_length with org_lengths
+        for org, length in list(org_lengths.items()):
+            results.alignment_lengths[org][org] = length
+        return results
+    refset = set(references)
+    return ANIResults([org for org in org_lengths if org not in refset],
+                      mode, columns=list(references))
+
+
 # Class to hold BLAST functions
 class BLASTfunctions(object):
     """Class to hold BLAST functions."""
@@ -93,11 +184,18 @@ class BLASTcmds(object):
     """Class to hold BLAST command data for construction of BLASTN and
     database formatting commands.
     """
-    def __init__(self, funcs, exes, prefix, outdir):
+    def __init__(self, funcs, exes, prefix, outdir, threads=1, shard=False):
         self.funcs = funcs
         self.exes = exes
         self.prefix = prefix
         self.outdir = outdir
+        self.threads = threads
+        self.shard = shard  # Write BLAST output to shard subdirectories?
+        self.shards = set()  # Shard subdirectories created so far
+
+    def build_db(self, fname):
+        """Return (database format/build command, database filename)"""
+        return self.funcs.db_func(fname, self.outdir, self.exes.format_exe)
 
     def build_db_cmd(self, fname):
         """Return database format/build command"""
@@ -109,10 +207,32 @@ class BLASTcmds(object):
         return self.funcs.db_func(fname, self.outdir,
                                   self.exes.format_exe)[1]
 
-    def build_blast_cmd(self, fname, dbname):
-        """Return BLASTN command"""
-        return self.funcs.blastn_func(fname, dbname, self.outdir,
-                                      self.exes.blast_exe)
+    def build_blast_cmd(self, fname, dbname, threads=None):
+        """Return BLASTN command, using threads (default: self.threads)"""
+        return self.funcs.blastn_func(fname, dbname,
+                                      self.get_blast_outdir(fname, dbname),
+                                      self.exes.blast_exe,
+                                      threads or self.threads)
+
+    def get_blast_outdir(self, fname, dbname):
+        """Return the output directory for a BLASTN search
+
+        If sharding, this is the shard subdirectory for the search's
+        <query>_vs_<subject> output (see pyani_files.get_shard()), which is
+        created if necessary.
+        """
+        if not self.shard:
+            return self.outdir
+        stems = [os.path.splitext(os.path.split(name)[-1])[0] for name in
+                 (fname, dbname)]
+        outdir = os.path.join(self.outdir,
+                              get_shard("%s_vs_%s" %
+                                        (stems[0].replace('-fragments', ''),
+                                         stems[1])))
+        if outdir not in self.shards:
+            os.makedirs(outdir, exist_ok=True)
+            self.shards.add(outdir)
+        return outdir
 
 
 # Read sequence annotations in from file
@@ -15,45 +15,290 @@ import multiprocessing
 import subprocess
 import sys
 
+from collections import defaultdict, deque
+from itertools import islice
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .pyani_config import (CHUNKS_PER_WORKER, MEMORY_BACKFILL,
+                           MEMORY_LOOKAHEAD, STREAM_LOOKAHEAD)
+from .pyani_jobs import chunk_jobs
+
 CUMRETVAL = 0
 
 
 # Run a job dependency graph with multiprocessing
-def run_dependency_graph(jobgraph, workers=None, logger=None):
+def run_dependency_graph(jobgraph, workers=None, logger=None, memory=None,
+                         chunksize=1):
     """Creates and runs pools of jobs based on the passed jobgraph.
 
     - jobgraph - list of jobs, which may have dependencies.
-    - verbose - flag for multiprocessing verbosity
+    - workers - number of cores to use (default: all available)
     - logger - a logger module logger (optional)
+    - memory - memory budget for concurrent jobs, in bytes (optional)
+    - chunksize - number of jobs to run one after another in each pool
+    job; zero sizes batches from estimated job cost (default: 1, no batching)
 
     The strategy here is to loop over each job in the list of jobs (jobgraph),
-    and create/populate a series of Sets of commands, to be run in
-    reverse order with multiprocessing_run as asynchronous pools.
+    and create/populate a series of sets of jobs, to be run in
+    reverse order with multiprocessing_run_jobs, packed by core count.
+    Within each set, jobs are started in decreasing order of estimated
+    cost (longest processing time first), to shorten the tail of each pool.
+    If chunking, consecutive jobs in that order are batched with
+    pyani_jobs.chunk_jobs(), aiming for pyani_config.CHUNKS_PER_WORKER
+    batches per core when sizing automatically.
     """
-    cmdsets = []
+    jobsets = []
     for job in jobgraph:
-        cmdsets = populate_cmdsets(job, cmdsets, depth=1)
+        jobsets = populate_jobsets(job, jobsets, depth=1)
 
-    # Put command sets in reverse order, and submit to multiprocessing_run
-    cmdsets.reverse()
+    # Put job sets in reverse order, and submit to multiprocessing_run_jobs
+    jobsets.reverse()
     cumretval = 0
-    for cmdset in cmdsets:
+    nchunks = (workers or multiprocessing.cpu_count()) * CHUNKS_PER_WORKER
+    for jobset in jobsets:
         if logger:  # Try to be informative, if the logger module is being used
             logger.info("Command pool now running:")
-            for cmd in cmdset:
-                logger.info(cmd)
-        cumretval += multiprocessing_run(cmdset, workers)
+            for job in jobset:
+                logger.info(job.command)
+        jobs = sorted(jobset, key=lambda job: -job.cost)
+        if chunksize != 1:
+            jobs = [chunk for chunk, _ in chunk_jobs(jobs, chunksize,
+                                                     nchunks)]
+        cumretval += multiprocessing_run_jobs(jobs, workers, memory)
         if logger:  # Try to be informative, if the logger module is being used
             logger.info("Command pool done.")
     return cumretval
 
 
+# Run jobs with multiprocessing, as they are generated
+def run_job_stream(jobs, workers=None, logger=None, memory=None,
+                   lookahead=None):
+    """Runs the passed jobs, and the jobs they depend on, as they arrive.
+
+    - jobs - an iterable of Jobs, which may have dependencies (e.g. a
+    generator from anim.iter_nucmer_jobs())
+    - workers - number of cores to use (default: all available)
+    - logger - a logger module logger (optional)
+    - memory - memory budget for concurrent jobs, in bytes (optional)
+    - lookahead - the most jobs to hold that have been taken from jobs but
+    not started (default: pyani_config.STREAM_LOOKAHEAD per core)
+
+    Unlike run_dependency_graph(), the job graph is not built up front:
+    jobs are taken from the iterable only while fewer than lookahead are
+    waiting to start, so the first jobs start at once, and memory use does
+    not grow with the size of the graph. Each job starts as soon as all of
+    its dependencies have finished, so it is not held back by unrelated
+    jobs at the same depth. Cores and memory are shared between jobs as
+    described for JobQueues, in the order the jobs become ready. Jobs are
+    not reordered here, so to start the largest jobs first the iterable
+    should yield them first, as anim.iter_nucmer_jobs() and
+    anib.iter_job_graph() do when given sequence lengths.
+
+    Progress is recorded on the Jobs themselves: each job's submitted flag
+    is set once it has been seen, and its finished flag and returncode
+    once it has run, so jobs shared by several others (such as BLAST
+    database jobs) run only once.
+
+    Returns the sum of exit codes from each job that was run.
+    """
+    cores = workers or multiprocessing.cpu_count()
+    if lookahead is None:
+        lookahead = cores * STREAM_LOOKAHEAD
+    jobs = iter(jobs)
+    ready = JobQueues(cores, memory)
+    blocked = {}                 # Job -> count of unfinished dependencies
+    waiting = defaultdict(list)  # Job -> jobs waiting for it to finish
+    counts = {'pending': 0}
+
+    def add(job):
+        """Adds a Job, and any unseen jobs it depends on."""
+        stack = [job]
+        while len(stack):
+            current = stack[-1]
+            if current.submitted:
+                stack.pop()
+                continue
+            unseen = [dep for dep in current.dependencies if
+                      not dep.submitted]
+            if len(unseen):
+                stack.extend(unseen)
+                continue
+            stack.pop()
+            current.submitted = True
+            counts['pending'] += 1
+            unfinished = [dep for dep in current.dependencies if
+                          not dep.finished]
+            for dep in unfinished:
+                waiting[dep].append(current)
+            if len(unfinished):
+                blocked[current] = len(unfinished)
+            else:
+                ready.enqueue(current)
+
+    cumretval, exhausted = 0, False
+    with ThreadPoolExecutor(max_workers=cores) as executor:
+        while True:
+            while not exhausted and counts['pending'] < lookahead:
+                job = next(jobs, None)
+                if job is None:
+                    exhausted = True
+                else:
+                    add(job)
+            counts['pending'] -= ready.start(executor, logger)
+            if not len(ready.running):
+                break
+            for job, returncode in ready.wait():
+                job.returncode = returncode
+                job.finished = True
+                cumretval += returncode
+                for dependent in waiting.pop(job, []):
+                    blocked[dependent] -= 1
+                    if not blocked[dependent]:
+                        del blocked[dependent]
+                        ready.enqueue(dependent)
+    return cumretval
+
+
+# Queue ready jobs, and start them within a budget of cores and memory
+class JobQueues(object):
+    """Jobs that are ready to run, queued by the number of cores they use.
+
+    Each Job occupies job.threads cores (capped at the budget) while it runs.
+    Jobs are started in the order they were queued but, where the next Job
+    needs more cores than are free, the earliest later Job that fits is
+    started instead. Multithreaded Jobs therefore wait until enough cores
+    are free, while single-threaded Jobs keep the remaining cores busy.
+
+    If a memory budget is given, a Job is only started while the estimated
+    memory (job.memory) of all running Jobs stays within it. A Job whose
+    estimate exceeds the whole budget is run on its own. Where the next Job
+    needing a given number of cores does not fit in the free memory, the
+    earliest of the next pyani_config.MEMORY_LOOKAHEAD Jobs that does fit is
+    started instead, so that a large Job does not hold back smaller ones
+    queued behind it. So that the large Job is not held back until it is
+    the last left to run, once backfill Jobs have been started past it,
+    no more Jobs are started until it has started: running Jobs drain
+    until it fits.
+    """
+    def __init__(self, cores, memory=None, backfill=MEMORY_BACKFILL):
+        """Instantiate JobQueues.
+
+        - cores         Int, number of cores available
+        - memory        Int, memory available to running Jobs, in bytes
+                        (default: no limit)
+        - backfill      Int, the most Jobs started past a Job waiting for
+                        memory
+        """
+        self.cores = cores
+        self.free = cores
+        self.freemem = memory
+        self.backfill = backfill
+        self.queues = defaultdict(deque)  # (order, Job), by core count
+        self.order = 0
+        self.running = {}  # Future -> Job
+        self.skipped = {}  # Job waiting for memory -> Jobs started past it
+
+    def threads(self, job):
+        """Returns the number of cores the Job occupies."""
+        return min(max(job.threads, 1), self.cores)
+
+    def enqueue(self, job):
+        """Queues a Job that is ready to run."""
+        self.queues[self.threads(job)].append((self.order, job))
+        self.order += 1
+
+    def admissible(self, job):
+        """Returns True if the Job's memory estimate fits the budget."""
+        return self.freemem is None or job.memory <= self.freemem or \
+            not len(self.running)
+
+    def first_admissible(self, queue):
+        """Returns the index of the first Job in the queue that fits the
+        memory budget, looking MEMORY_LOOKAHEAD Jobs ahead, or None."""
+        for idx, (_, job) in enumerate(islice(queue, MEMORY_LOOKAHEAD)):
+            if self.admissible(job):
+                return idx
+        return None
+
+    def start(self, executor, logger=None):
+        """Starts queued Jobs while they fit, returning the number started.
+
+        - executor - concurrent.futures executor to run the Jobs' commands
+        - logger - a logger module logger (optional)
+        """
+        started = 0
+        while self.free:
+            fits = []  # (order, queue, index) of the Job to start, per queue
+            waiting = []  # Jobs at the head of a queue that need memory
+            for threads, queue in self.queues.items():
+                if threads <= self.free and len(queue):
+                    if not self.admissible(queue[0][1]):
+                        waiting.append(queue[0])
+                    idx = self.first_admissible(queue)
+                    if idx is not None:
+                        fits.append((queue[idx][0], queue, idx))
+            if not len(fits):
+                break
+            order, queue, idx = min(fits, key=lambda fit: fit[0])
+            passed = [head for head in waiting if head[0] < order]
+            if any([self.skipped.get(head, 0) >= self.backfill for
+                    _, head in passed]):
+                break  # Hold cores and memory for a Job that has waited
+            for _, head in passed:
+                self.skipped[head] = self.skipped.get(head, 0) + 1
+            _, job = queue[idx]
+            del queue[idx]
+            self.skipped.pop(job, None)
+            self.free -= self.threads(job)
+            if self.freemem is not None:
+                self.freemem -= job.memory
+            if logger:
+                logger.info(job.command)
+            self.running[executor.submit(run_command, job.command)] = job
+            started += 1
+        return started
+
+    def wait(self):
+        """Waits for running Jobs, returning (Job, exit code) for each that
+        finished, and releasing their cores and memory."""
+        done, _ = wait(self.running, return_when=FIRST_COMPLETED)
+        finished = []
+        for future in done:
+            job = self.running.pop(future)
+            self.free += self.threads(job)
+            if self.freemem is not None:
+                self.freemem += job.memory
+            finished.append((job, future.result().returncode))
+        return finished
+
+
+def populate_jobsets(job, jobsets, depth):
+    """Creates a list of ordered sets containing jobs at different depths of
+    the dependency tree.
+
+    Each set is a dictionary keyed by Job, so that jobs shared between
+    branches of the graph are only run once, and jobs keep the order in
+    which they were generated.
+    """
+    if len(jobsets) < depth:
+        jobsets.append(dict())
+    jobsets[depth-1][job] = None
+    if len(job.dependencies) == 0:
+        return jobsets
+    for j in job.dependencies:
+        jobsets = populate_jobsets(j, jobsets, depth+1)
+    return jobsets
+
+
 def populate_cmdsets(job, cmdsets, depth):
     """Creates a list of sets containing jobs at different depths of the
     dependency tree.
 
     This is a recursive function (is there something quicker in the itertools
     module?) that descends each 'root' job in turn, populating each
+
+    No longer used by pyani itself (see populate_jobsets()); kept for API
+    compatibility.
     """
     if len(cmdsets) < depth:
         cmdsets.append(set())
@@ -74,6 +319,9 @@ def multiprocessing_run(cmdlines, workers=None):
     Returns the sum of exit codes from each job that was run. If
     all goes well, this should be 0. Anything else and the calling
     function should act accordingly.
+
+    No longer used by pyani itself (see multiprocessing_run_jobs()); kept
+    for API compatibility.
     """
     # Run jobs
     # If workers is None or greater than the number of cores available,
@@ -87,3 +335,34 @@ def multiprocessing_run(cmdlines, workers=None):
     pool.close()
     pool.join()
     return sum([r.get().returncode for r in results])
+
+
+# Run a set of Jobs, packing them into a budget of cores
+def multiprocessing_run_jobs(jobs, workers=None, memory=None):
+    """Runs the passed Jobs concurrently, within a budget of cores and memory.
+
+    - jobs - an iterable of Job objects
+    - workers - the number of cores available (default: all available)
+    - memory - the memory available to running Jobs, in bytes (default:
+    no limit)
+
+    Jobs are started in the order passed, packed into the budget as
+    described for JobQueues. Dependencies are not considered: the Jobs are
+    assumed to be ready to run.
+
+    Returns the sum of exit codes from each job that was run.
+    """
+    ready = JobQueues(workers or multiprocessing.cpu_count(), memory)
+    for job in jobs:
+        ready.enqueue(job)
+    cumretval = 0
+    with ThreadPoolExecutor(max_workers=ready.cores) as executor:
+        while ready.start(executor) or len(ready.running):
+            cumretval += sum([returncode for _, returncode in ready.wait()])
+    return cumretval
+
+
+def run_command(cline):
+    """Runs a single command line, returning the CompletedProcess."""
+    return subprocess.run(str(cline), shell=sys.platform != "win32",
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
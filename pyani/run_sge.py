@@ -9,15 +9,23 @@
 
 For parallelisation on multi-node system, we use some custom code to submit
 jobs.
+
+Submission to, and polling of, the scheduler is delegated to a backend from
+pyani_backends.py, so the same code can run jobs on SGE (the default) or on
+other schedulers, such as SLURM.
 """
 
 import itertools
 import os
+import subprocess
+import time
 
-from collections import defaultdict
+from collections import defaultdict, deque
 
 from . import pyani_config
-from .pyani_jobs import JobGroup
+# get_job_reference() and parse_qstat_xml() are also available from here
+from .pyani_backends import SGEBackend, get_job_reference, parse_qstat_xml
+from .pyani_jobs import JobGroup, chunk_jobs
 
 
 def split_seq(iterable, size):
@@ -31,36 +39,158 @@ def split_seq(iterable, size):
 
 # Build a list of SGE jobs from a graph
 def build_joblist(jobgraph):
-    """Returns a list of jobs, from a passed jobgraph."""
-    jobset = set()
+    """Returns a list of jobs, from a passed jobgraph.
+
+    Jobs shared between branches of the graph (e.g. a makeblastdb job that
+    many BLASTN jobs depend on) are included once, by identity. Jobs are
+    listed in the order they are found.
+    """
+    jobset = dict()
     for job in jobgraph:
         jobset = populate_jobset(job, jobset, depth=1)
     return list(jobset)
 
 
 # Convert joblist into jobgroups
-def compile_jobgroups_from_joblist(joblist, jgprefix, sgegroupsize):
-    """Return list of jobgroups, rather than list of jobs."""
-    jobcmds = defaultdict(list)
+def compile_jobgroups_from_joblist(joblist, jgprefix, sgegroupsize,
+                                   chunksize=1):
+    """Return list of jobgroups, rather than list of jobs.
+
+    If chunksize is not 1, jobs are first batched into tasks with
+    pyani_jobs.chunk_jobs() (zero sizes batches from estimated job cost).
+    """
+    if chunksize != 1:
+        joblist = [chunk for chunk, _ in
+                   chunk_jobs(joblist, chunksize, pyani_config.SGE_CHUNKS)]
+    return [jobgroup for jobgroup, _ in
+            group_jobs(joblist, jgprefix, sgegroupsize)]
+
+
+# Split jobs into JobGroups, by executable and thread count
+def group_jobs(joblist, jgprefix, sgegroupsize, start=0):
+    """Returns a list of (JobGroup, jobs) tuples for the passed jobs.
+
+    - joblist - list of Job objects
+    - jgprefix - a prefix for the JobGroup names
+    - sgegroupsize - the maximum number of tasks in a JobGroup
+    - start - JobGroups are numbered from start + 1
+
+    Jobs running the same executable with the same number of threads are
+    placed, in the order passed, into JobGroups of at most sgegroupsize
+    tasks. The jobs run by each JobGroup are returned alongside it, in task
+    order.
+    """
+    jobsets = defaultdict(list)
     for job in joblist:
-        jobcmds[job.command.split(' ', 1)[0]].append(job.command)
+        jobsets[(job.command.split(' ', 1)[0], job.threads)].append(job)
     jobgroups = []
-    for cmds in list(jobcmds.items()):
+    count = start  # Numbering is shared by all groups, so names are unique
+    for (_, threads), jobs in list(jobsets.items()):
         # Break arglist up into batches of sgegroupsize (default: 10,000)
-        sublists = split_seq(cmds[1], sgegroupsize)
-        count = 0
+        sublists = split_seq(jobs, sgegroupsize)
         for sublist in sublists:
             count += 1
-            sge_jobcmdlist = ['\"%s\"' % jc for jc in sublist]
-            jobgroups.append(JobGroup("%s_%d" % (jgprefix, count),
-                                      "$cmds",
-                                      arguments={'cmds': sge_jobcmdlist}))
+            jobgroups.append((JobGroup("%s_%d" % (jgprefix, count), None,
+                                       commands=[job.command for job in
+                                                 sublist],
+                                       threads=threads), sublist))
+    return jobgroups
+
+
+# Convert a job dependency graph into layers of dependent jobgroups
+def compile_jobgroups_from_jobgraph(joblist, jgprefix, sgegroupsize,
+                                    chunksize=1, start=0, placed=None):
+    """Return list of jobgroups for the passed jobs, keeping dependencies.
+
+    - joblist - list of Job objects, which may have dependencies
+    - jgprefix - a prefix for the JobGroup names
+    - sgegroupsize - the maximum number of tasks in a JobGroup
+    - chunksize - number of jobs to run one after another in each task;
+    zero sizes batches from estimated job cost (default: 1, no batching)
+    - start - JobGroups are numbered from start + 1
+    - placed - dictionary of Job -> (order, JobGroup, task index) for jobs
+    already compiled into JobGroups, e.g. by an earlier call; jobs in
+    joblist may depend on these. Updated with the jobs in joblist.
+
+    Jobs are placed in layers by their depth in the dependency graph (jobs
+    with no dependencies first), and each layer is compiled into JobGroups.
+    Where task i of a JobGroup depends only on task i of a single JobGroup
+    of the same size in an earlier layer (e.g. NUCmer -> delta-filter), the
+    dependency is held task-by-task (qsub -hold_jid_ad). Otherwise the
+    JobGroup is held until every JobGroup containing one of its jobs'
+    dependencies has finished (qsub -hold_jid). Within each layer after the
+    first, jobs are ordered by the position of their dependencies, so that
+    one-to-one dependencies line up as tasks.
+
+    If chunking, consecutive jobs in each layer are batched into single tasks
+    with pyani_jobs.chunk_jobs(), aiming for pyani_config.SGE_CHUNKS tasks
+    per layer when sizing automatically. A task then depends on the tasks
+    running its jobs' dependencies.
+
+    JobGroups are returned in layer order, which is a valid submission order.
+    """
+    # Depth of each job: jobs with no dependencies are at depth zero
+    depths = {}
+    for job in joblist:
+        stack = [job]
+        while len(stack):
+            current = stack[-1]
+            pending = [dep for dep in current.dependencies if
+                       dep not in depths]
+            if len(pending):
+                stack.extend(pending)
+                continue
+            stack.pop()
+            depths[current] = 1 + max([depths[dep] for dep in
+                                       current.dependencies] + [-1])
+    layers = defaultdict(list)
+    for job in joblist:
+        layers[depths[job]].append(job)
+
+    jobgroups = []
+    if placed is None:
+        placed = {}  # Job -> (order, JobGroup, task)
+    for depth in sorted(layers):
+        layer = layers[depth]
+        if depth:
+            layer = sorted(layer, key=lambda job: min([placed[dep][0] for dep
+                                                       in job.dependencies]))
+        if chunksize == 1:
+            chunks = [(job, [job]) for job in layer]
+        else:
+            chunks = chunk_jobs(layer, chunksize, pyani_config.SGE_CHUNKS)
+        members = dict(chunks)  # Task Job -> the Jobs it runs
+        for jobgroup, tasks in group_jobs([chunk for chunk, _ in chunks],
+                                          jgprefix, sgegroupsize,
+                                          start + len(jobgroups)):
+            for idx, task in enumerate(tasks):
+                for job in members[task]:
+                    placed[job] = (len(placed), jobgroup, idx)
+            jobgroups.append(jobgroup)
+            if not depth:
+                continue
+            # Hold task-by-task if task i depends only on task i of a single
+            # earlier JobGroup of the same size
+            holds = [set([placed[dep][1:] for job in members[task] for dep
+                          in job.dependencies]) for task in tasks]
+            parent = list(holds[0])[0][0]
+            if parent.tasks == jobgroup.tasks and \
+               holds == [{(parent, idx)} for idx in range(len(tasks))]:
+                jobgroup.add_task_dependency(parent)
+                continue
+            for parent in dict.fromkeys([placed[dep][1] for task in tasks
+                                         for job in members[task]
+                                         for dep in job.dependencies]):
+                jobgroup.add_dependency(parent)
     return jobgroups
 
 
 # Run a job dependency graph, with SGE
 def run_dependency_graph(jobgraph, logger=None, jgprefix="ANIm_SGE_JG",
-                         sgegroupsize=10000, sgeargs=None):
+                         sgegroupsize=10000, sgeargs=None, chunksize=1,
+                         qsub_exe=pyani_config.QSUB_DEFAULT,
+                         qstat_exe=pyani_config.QSTAT_DEFAULT,
+                         backend=None):
     """Creates and runs GridEngine scripts for jobs based on the passed
     jobgraph.
 
@@ -70,6 +200,12 @@ def run_dependency_graph(jobgraph, logger=None, jgprefix="ANIm_SGE_JG",
     - jgprefix - a prefix for the submitted jobs, in the scheduler
     - sgegroupsize - the maximum size for an array job submission
     - sgeargs - additional arguments to qsub
+    - chunksize - number of jobs to run one after another in each array
+    task; zero sizes batches from estimated job cost (default: 1)
+    - qsub_exe - path to the qsub executable
+    - qstat_exe - path to the qstat executable
+    - backend - the scheduler backend (default: SGE, using qsub_exe and
+    qstat_exe)
 
     The strategy here is to loop over each job in the list of jobs (jobgraph),
     and create/populate a series of Sets of commands, to be run in
@@ -78,8 +214,16 @@ def run_dependency_graph(jobgraph, logger=None, jgprefix="ANIm_SGE_JG",
     The strategy here is to loop over each job in the dependency graph, and
     add the job to a new list of jobs, swapping out the Job dependency for
     the name of the Job on which it depends.
+
+    Returns the sum of exit codes from each job that was run, as reported
+    by the jobs' sentinel files.
     """
-    joblist = build_joblist(jobgraph)
+    if backend is None:
+        backend = SGEBackend(qsub_exe, qstat_exe)
+
+    # Submit the most expensive jobs first, to shorten the tail of the run
+    joblist = sorted(build_joblist(jobgraph),
+                     key=lambda job: (-job.cost, job.name))
 
     # Try to be informative by telling the user what jobs will run
     dep_count = 0  # how many dependencies are there
@@ -93,34 +237,112 @@ def run_dependency_graph(jobgraph, logger=None, jgprefix="ANIm_SGE_JG",
                     logger.info("\t[^ depends on: %s]" % dep.name)
     logger.info("There are %d job dependencies" % dep_count)
 
-    # If there are no job dependencies, we can use an array (or series of
-    # arrays) to schedule our jobs. This cuts down on problems with long
-    # job lists choking up the queue.
-    if dep_count == 0:
-        logger.info("Compiling jobs into JobGroups")
-        joblist = compile_jobgroups_from_joblist(joblist, jgprefix,
-                                                 sgegroupsize)
+    # We use an array (or series of arrays) for each layer of the dependency
+    # graph to schedule our jobs, holding each array on those it depends on.
+    # This cuts down on problems with long job lists choking up the queue.
+    logger.info("Compiling jobs into JobGroups")
+    joblist = compile_jobgroups_from_jobgraph(joblist, jgprefix,
+                                              sgegroupsize, chunksize)
 
     # Send jobs to scheduler
     logger.info("Running jobs with scheduler...")
     logger.info("Jobs passed to scheduler in order:")
     for job in joblist:
         logger.info("\t%s" % job.name)
-    build_and_submit_jobs(os.curdir, joblist, sgeargs)
-    logger.info("Waiting for SGE-submitted jobs to finish (polling)")
-    for job in joblist:
-        job.wait()
+    build_and_submit_jobs(os.curdir, joblist, sgeargs, backend=backend)
+    logger.info("Waiting for %s-submitted jobs to finish (sentinel files)",
+                backend.name)
+    return wait_for_sentinels(os.curdir, joblist, logger=logger,
+                              backend=backend)
+
+
+# Run jobs with SGE, submitting them as they are generated
+def run_job_stream(jobs, logger=None, jgprefix="ANIm_SGE_JG",
+                   sgegroupsize=10000, sgeargs=None, chunksize=1,
+                   qsub_exe=pyani_config.QSUB_DEFAULT,
+                   qstat_exe=pyani_config.QSTAT_DEFAULT,
+                   backend=None):
+    """Submits the passed jobs to the scheduler in batches, as they are
+    generated, then waits for them all to finish.
+
+    - jobs - an iterable of Jobs, which may have dependencies (e.g. a
+    generator from anim.iter_nucmer_jobs())
+    - logger - a logger module logger (optional)
+    - jgprefix - a prefix for the submitted jobs, in the scheduler
+    - sgegroupsize - the maximum size for an array job submission, and the
+    number of jobs taken from jobs for each batch
+    - sgeargs - additional arguments to qsub
+    - chunksize - number of jobs to run one after another in each array
+    task; zero sizes batches from estimated job cost (default: 1)
+    - qsub_exe - path to the qsub executable
+    - qstat_exe - path to the qstat executable
+    - backend - the scheduler backend (default: SGE, using qsub_exe and
+    qstat_exe)
+
+    Each batch of sgegroupsize jobs, with any jobs they depend on that were
+    not in an earlier batch, is compiled into JobGroups as by
+    run_dependency_graph() and submitted before the next batch is
+    generated, so the scheduler can start work while later jobs are still
+    being built. Jobs may depend on jobs from earlier batches (e.g. BLAST
+    databases); holds on JobGroups whose tasks have all written their
+    sentinel files are dropped, as some schedulers reject holds on jobs
+    they no longer know about.
+
+    Returns the sum of exit codes from each job that was run, as reported
+    by the jobs' sentinel files.
+    """
+    if backend is None:
+        backend = SGEBackend(qsub_exe, qstat_exe)
+    statusdir = os.path.join(os.curdir, "status")
+    jobgroups, placed = [], {}
+    for batch in split_seq(jobs, sgegroupsize):
+        # Submit the most expensive jobs in each batch first
+        joblist = sorted([job for job in build_joblist(batch) if
+                          job not in placed],
+                         key=lambda job: (-job.cost, job.name))
+        compiled = compile_jobgroups_from_jobgraph(joblist, jgprefix,
+                                                   sgegroupsize, chunksize,
+                                                   len(jobgroups), placed)
+        for jobgroup in compiled:
+            for parent in list(jobgroup.dependencies) + \
+                    jobgroup.task_dependencies:
+                if parent in jobgroups and \
+                   all([os.path.exists(os.path.join(statusdir, name)) for
+                        name in get_sentinel_names(parent)]):
+                    if parent in jobgroup.dependencies:
+                        jobgroup.remove_dependency(parent)
+                    else:
+                        jobgroup.task_dependencies.remove(parent)
+        if logger:
+            logger.info("Submitting %d jobs as %d JobGroups: %s",
+                        len(joblist), len(compiled),
+                        ", ".join([jobgroup.name for jobgroup in compiled]))
+        build_and_submit_jobs(os.curdir, compiled, sgeargs, backend=backend)
+        jobgroups.extend(compiled)
+    if logger:
+        logger.info("Waiting for %s-submitted jobs to finish (sentinel "
+                    "files)", backend.name)
+    return wait_for_sentinels(os.curdir, jobgroups, logger=logger,
+                              backend=backend)
 
 
 def populate_jobset(job, jobset, depth):
     """ Creates a set of jobs, containing jobs at difference depths of the
     dependency tree, retaining dependencies as strings, not Jobs.
+
+    The passed job and everything it depends on are added to jobset (a set,
+    or a dictionary keyed by Job to keep the order in which jobs are found).
+    The graph is walked iteratively, and the dependencies of a job already
+    in jobset are not visited again, so each shared subgraph is walked once.
     """
-    jobset.add(job)
-    if len(job.dependencies) == 0:
-        return jobset
-    for j in job.dependencies:
-        jobset = populate_jobset(j, jobset, depth+1)
+    add = jobset.add if isinstance(jobset, set) else jobset.setdefault
+    stack = [job]
+    while len(stack):
+        current = stack.pop()
+        if current in jobset:
+            continue
+        add(current)
+        stack.extend(reversed(current.dependencies))
     return jobset
 
 
@@ -132,6 +354,7 @@ def build_directories(root_dir):
         stderr           Stores the stderr output from SGE
         stdout           Stores the stdout output from SGE
         output           Stores output (if the scripts place the output here)
+        status           Stores a sentinel file for each completed job/task
 
     - root_dir   Path to the top-level directory for creation of subdirectories
     """
@@ -141,113 +364,165 @@ def build_directories(root_dir):
 
     # Create subdirectories
     directories = [os.path.join(root_dir, subdir) for subdir in
-                   ("output", "stderr", "stdout", "jobs")]
+                   ("output", "stderr", "stdout", "jobs", "status")]
     for dirname in directories:
         os.makedirs(dirname, exist_ok=True)
 
 
-def build_job_scripts(root_dir, jobs):
+def build_job_scripts(root_dir, jobs, backend=None):
     """Constructs the script for each passed Job in the jobs iterable
 
     - root_dir      Path to output directory
+    - backend       Scheduler backend, providing the script header
+    (default: SGE)
+
+    JobGroups built from command lists also have their command file
+    written to the jobs subdirectory.
+
+    Each script traps its exit to write its exit code to a sentinel
+    file in the status subdirectory (one per task, for JobGroups; see
+    get_sentinel_names()), so that completion can be detected without
+    polling the scheduler. Stale sentinels from earlier runs are removed.
     """
     # Loop over the job list, creating each job script in turn, and then adding
     # scriptPath to the Job object
+    header = (backend or SGEBackend()).script_header
+    statusdir = os.path.join(root_dir, "status")
     for job in jobs:
+        for name in get_sentinel_names(job):
+            if os.path.exists(os.path.join(statusdir, name)):
+                os.remove(os.path.join(statusdir, name))
+        sentinel = os.path.join(statusdir, job.name)
+        if isinstance(job, JobGroup):
+            sentinel += ".${SGE_TASK_ID}"
+        if isinstance(job, JobGroup) and job.commands is not None:
+            job.write_command_file(os.path.join(root_dir, "jobs"))
         scriptpath = os.path.join(root_dir, "jobs", job.name)
         with open(scriptpath, "w") as scriptfile:
-            scriptfile.write("#!/bin/sh\n#$ -S /bin/bash\n%s\n" % job.script)
+            scriptfile.write(header)
+            scriptfile.write("trap 'echo $? > %s.tmp && mv %s.tmp %s' EXIT\n" %
+                             (sentinel, sentinel, sentinel))
+            scriptfile.write("%s\n" % job.script)
         job.scriptpath = scriptpath
 
 
+def get_sentinel_names(job):
+    """Returns the list of sentinel filenames written by the passed job.
+
+    A Job writes a single sentinel named for the job; a JobGroup writes one
+    per task, named <job name>.<task ID>.
+    """
+    if isinstance(job, JobGroup):
+        return ["%s.%d" % (job.name, task) for task in
+                range(1, job.tasks + 1)]
+    return [job.name]
+
+
 def extract_submittable_jobs(waiting):
     """Obtain a list of jobs that are able to be submitted from the passed
     list of pending jobs
 
     - waiting           List of Job objects
     """
-    submittable = set()            # Holds jobs that are able to be submitted
+    submittable = []               # Holds jobs that are able to be submitted
     # Loop over each job, and check all the subjobs in that job's dependency
     # list.  If there are any, and all of these have been submitted, then
-    # append the job to the list of submittable jobs.
+    # append the job to the list of submittable jobs. The order of the
+    # waiting list is kept.
     for job in waiting:
         unsatisfied = sum([(subjob.submitted is False) for subjob in
                            job.dependencies])
         if unsatisfied == 0:
-            submittable.add(job)
-    return list(submittable)
+            submittable.append(job)
+    return submittable
 
 
-def submit_safe_jobs(root_dir, jobs, sgeargs=None):
+def submit_safe_jobs(root_dir, jobs, sgeargs=None,
+                     qsub_exe=pyani_config.QSUB_DEFAULT, backend=None):
     """Submit the passed list of jobs to the Grid Engine server, using the
     passed directory as the root for scheduler output.
 
     - root_dir      Path to output directory
     - jobs          Iterable of Job objects
+    - sgeargs       Additional arguments to qsub
+    - qsub_exe      Path to the qsub executable
+    - backend       Scheduler backend (default: SGE, using qsub_exe)
+
+    Each job's scheduler ID is stored as job.jobid. Jobs are held on the
+    IDs of their dependencies, rather than their names, so that concurrent
+    runs using the same job names do not hold each other. Raises
+    subprocess.CalledProcessError if submission fails.
     """
-    # Loop over each job, constructing SGE command-line based on job settings
+    if backend is None:
+        backend = SGEBackend(qsub_exe=qsub_exe)
     for job in jobs:
         job.out = os.path.join(root_dir, "stdout")
         job.err = os.path.join(root_dir, "stderr")
-
-        # Add the job name, current working directory, and SGE stdout/stderr
-        # directories to the SGE command line
-        args = " -N %s " % (job.name)
-        args += " -cwd "
-        args += " -o %s -e %s " % (job.out, job.err)
-
-        # If a queue is specified, add this to the SGE command line
-        # LP: This has an undeclared variable, not sure why - delete?
-        #if job.queue is not None and job.queue in local_queues:
-        #    args += local_queues[job.queue]
-
-        # If the job is actually a JobGroup, add the task numbering argument
-        if isinstance(job, JobGroup):
-            args += "-t 1:%d " % (job.tasks)
-
-        # If there are dependencies for this job, hold the job until they are
-        # complete
-        if len(job.dependencies) > 0:
-            args += "-hold_jid "
-            for dep in job.dependencies:
-                args += dep.name + ","
-            args = args[:-1]
-
-        # Build the qsub SGE commandline (passing local environment)
-        qsubcmd = ("%s -V %s %s" %
-                   (pyani_config.QSUB_DEFAULT, args, job.scriptpath))
-        if sgeargs is not None:
-            qsubcmd = "%s %s" % (qsubcmd, sgeargs)
-        os.system(qsubcmd)               # Run the command
+        backend.submit(job, root_dir, sgeargs)
         job.submitted = True             # Set the job's submitted flag to True
 
 
-def submit_jobs(root_dir, jobs, sgeargs=None):
+def submit_jobs(root_dir, jobs, sgeargs=None,
+                qsub_exe=pyani_config.QSUB_DEFAULT, backend=None):
     """ Submit each of the passed jobs to the SGE server, using the passed
     directory as root for SGE output.
 
     - root_dir       Path to output directory
     - jobs           List of Job objects
+    - sgeargs        Additional arguments to qsub
+    - qsub_exe       Path to the qsub executable
+    - backend        Scheduler backend (default: SGE, using qsub_exe)
+    """
+    submit_safe_jobs(root_dir, get_submission_order(jobs), sgeargs, qsub_exe,
+                     backend)
+
+
+def get_submission_order(jobs):
+    """Returns the passed jobs in an order in which they can be submitted.
+
+    - jobs           List of Job objects
+
+    Jobs are ordered topologically with Kahn's algorithm: each job counts
+    its dependencies that are passed or are not yet submitted, and is
+    released when that count reaches zero. Jobs that are ready are kept in
+    the order passed. Each job and dependency is visited once, and jobs are
+    handled by identity. Raises a ValueError if some jobs can never be submitted,
+    because they depend on unsubmitted jobs that were not passed or on
+    each other.
     """
-    waiting = list(jobs)                 # List of jobs still to be done
-    # Loop over the list of pending jobs, while there still are any
-    while len(waiting) > 0:
-        # extract submittable jobs
-        submittable = extract_submittable_jobs(waiting)
-        # run those jobs
-        submit_safe_jobs(root_dir, submittable, sgeargs)
-        # remove those from the waiting list
-        for job in submittable:
-            waiting.remove(job)
-
-
-def build_and_submit_jobs(root_dir, jobs, sgeargs=None):
+    jobs = list(jobs)
+    indegree = dict.fromkeys(jobs, 0)
+    dependents = defaultdict(list)
+    for job in jobs:
+        for dep in job.dependencies:
+            if dep in indegree or not dep.submitted:
+                indegree[job] += 1
+                dependents[dep].append(job)
+    ready = deque([job for job in jobs if indegree[job] == 0])
+    ordered = []
+    while len(ready):
+        job = ready.popleft()
+        ordered.append(job)
+        for dependent in dependents[job]:
+            indegree[dependent] -= 1
+            if indegree[dependent] == 0:
+                ready.append(dependent)
+    if len(ordered) < len(jobs):
+        raise ValueError("%d jobs have dependencies that cannot be "
+                         "submitted" % (len(jobs) - len(ordered)))
+    return ordered
+
+
+def build_and_submit_jobs(root_dir, jobs, sgeargs=None,
+                          qsub_exe=pyani_config.QSUB_DEFAULT, backend=None):
     """Submits the passed iterable of Job objects to SGE, placing SGE's
     output in the passed root directory
 
     - root_dir   Root directory for SGE and job output
     - jobs       List of Job objects, describing each job to be submitted
     - sgeargs    Additional arguments to qsub
+    - qsub_exe   Path to the qsub executable
+    - backend    Scheduler backend (default: SGE, using qsub_exe)
     """
     # If the passed set of jobs is not a list, turn it into one. This makes the
     # use of a single JobGroup a little more intutitive
@@ -256,5 +531,139 @@ def build_and_submit_jobs(root_dir, jobs, sgeargs=None):
 
     # Build and submit the passed jobs
     build_directories(root_dir)        # build all necessary directories
-    build_job_scripts(root_dir, jobs)  # build job scripts
-    submit_jobs(root_dir, jobs, sgeargs)        # submit the jobs to SGE
+    build_job_scripts(root_dir, jobs, backend)  # build job scripts
+    submit_jobs(root_dir, jobs, sgeargs, qsub_exe, backend)  # submit jobs
+
+
+# Poll SGE for the status of all outstanding jobs at once
+def poll_jobs(jobs, qstat_exe=pyani_config.QSTAT_DEFAULT, backend=None):
+    """Updates the state of the passed jobs from a single call to qstat.
+
+    - jobs        Iterable of Job/JobGroup objects
+    - qstat_exe   Path to the qstat executable
+    - backend     Scheduler backend (default: SGE, using qstat_exe)
+
+    Jobs that the scheduler no longer reports are marked as finished.
+    Returns the list of jobs still known to the scheduler, or raises
+    subprocess.CalledProcessError if the scheduler cannot be queried.
+    """
+    if backend is None:
+        backend = SGEBackend(qstat_exe=qstat_exe)
+    return backend.poll(jobs)
+
+
+# Wait for all passed jobs to leave the scheduler
+def wait_for_jobs(jobs, interval=pyani_config.SGE_WAIT,
+                  maxinterval=pyani_config.SGE_MAXWAIT,
+                  qstat_exe=pyani_config.QSTAT_DEFAULT, logger=None,
+                  backend=None):
+    """Waits until none of the passed jobs are reported by qstat.
+
+    - jobs          Iterable of Job/JobGroup objects
+    - interval      Initial time (s) between polls; doubled after each poll
+    - maxinterval   Longest time (s) between polls
+    - qstat_exe     Path to the qstat executable
+    - logger        a logger module logger (optional)
+    - backend       Scheduler backend (default: SGE, using qstat_exe)
+
+    qstat is called once per poll for all outstanding jobs, rather than once
+    per job, to keep the load on the qmaster low. If a poll fails, it is
+    retried after the next interval.
+    """
+    if backend is None:
+        backend = SGEBackend(qstat_exe=qstat_exe)
+    outstanding = [job for job in jobs if not job.finished]
+    while len(outstanding):
+        time.sleep(interval)
+        interval = min(2 * interval, maxinterval)
+        try:
+            outstanding = backend.poll(outstanding)
+        except (OSError, subprocess.CalledProcessError) as err:
+            if logger:
+                logger.warning("%s poll failed (%s), retrying", backend.name,
+                               err)
+            continue
+        if logger:
+            errored = [job.name for job in outstanding if
+                       backend.is_error_state(job.state)]
+            if len(errored):
+                logger.warning("%s reports jobs in error state: %s",
+                               backend.name, ', '.join(errored))
+
+
+# Wait for jobs to write their sentinel files
+def wait_for_sentinels(root_dir, jobs, interval=pyani_config.SGE_WAIT,
+                       maxinterval=pyani_config.SGE_MAXWAIT,
+                       qstat_exe=pyani_config.QSTAT_DEFAULT, logger=None,
+                       backend=None, rescans=pyani_config.SGE_RESCANS):
+    """Waits until all passed jobs have written their sentinel files, and
+    returns the sum of their exit codes.
+
+    - root_dir      Root directory for SGE and job output
+    - jobs          Iterable of Job/JobGroup objects
+    - interval      Initial time (s) between scans; doubled after each scan
+    - maxinterval   Longest time (s) between scans
+    - qstat_exe     Path to the qstat executable, or None
+    - logger        a logger module logger (optional)
+    - backend       Scheduler backend (default: SGE, using qstat_exe)
+    - rescans       Further scans for the sentinels of a job that has left
+                    the scheduler, before they are counted as missing
+
+    The status directory is scanned once per interval, so the scheduler is
+    not polled while jobs report progress. If a scan at the longest interval
+    finds nothing new, the scheduler is polled once (unless there is no
+    backend and qstat_exe is None) to catch
+    jobs that left the scheduler without writing a sentinel, e.g. because
+    they were killed. A shared filesystem may show a sentinel some time
+    after its job has finished, so the sentinels of such a job are looked
+    for by name in each of the next rescans scans; any still missing then
+    count as an exit code of one each. The exit codes of each job are
+    summed in job.returncode.
+    """
+    if backend is None and qstat_exe is not None:
+        backend = SGEBackend(qstat_exe=qstat_exe)
+    statusdir = os.path.join(root_dir, "status")
+    remaining = {job: set(get_sentinel_names(job)) for job in jobs}
+    for job in jobs:
+        job.returncode = 0
+    lost, cumretval = {}, 0  # Lost jobs, with the rescans left for each
+    while len(remaining):
+        time.sleep(interval)
+        interval = min(2 * interval, maxinterval)
+        found = set([entry.name for entry in os.scandir(statusdir)])
+        progress = False
+        for job, names in list(remaining.items()):
+            if job in lost:  # Check directly, in case the listing is stale
+                found.update([name for name in names if os.path.exists(
+                    os.path.join(statusdir, name))])
+            for name in names & found:
+                with open(os.path.join(statusdir, name), 'r') as ifh:
+                    job.returncode += int(ifh.read())
+                names.discard(name)
+                progress = True
+            if job in lost and len(names) and lost[job] > 0:
+                lost[job] -= 1
+            elif job in lost and len(names):  # Left without a sentinel
+                if logger:
+                    logger.warning("Job %s finished without writing %d " +
+                                   "sentinel file(s) (state: %s)", job.name,
+                                   len(names), job.state)
+                job.returncode += len(names)
+                names.clear()
+            if not len(names):
+                job.finished = True
+                cumretval += job.returncode
+                del remaining[job]
+                lost.pop(job, None)
+        if not progress and interval >= maxinterval and \
+           backend is not None and len(remaining):
+            try:
+                queued = backend.poll(list(remaining))
+            except (OSError, subprocess.CalledProcessError) as err:
+                if logger:
+                    logger.warning("%s poll failed (%s)", backend.name, err)
+                continue
+            for job in remaining:
+                if job not in queued:
+                    lost.setdefault(job, rescans)
+    return cumretval
@@ -0,0 +1,302 @@
+# Copyright 2017, The James Hutton Insitute
+# Author: Leighton Pritchard
+#
+# This code is part of the pyani package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of
+# this package.
+
+"""Code to estimate ANI from MinHash sketches, to prefilter comparisons.
+
+Each input genome is reduced to a bottom-k MinHash sketch: the smallest
+hash values of its canonical k-mers. The Jaccard index of two genomes'
+k-mer sets is estimated from their sketches, and converted to the Mash
+distance, as described in:
+
+Ondov et al. (2016) Mash: fast genome and metagenome distance estimation
+using MinHash. Genome Biol. 17: 132. doi:10.1186/s13059-016-0997-x
+
+One minus the Mash distance approximates ANI, well enough to identify the
+pairs of genomes that are too distant for an alignment-based ANI
+comparison to be worth running.
+
+Scaled (FracMinHash) sketches, which keep every k-mer hash below a fixed
+fraction of the hash space, are also provided. These estimate the
+containment of one genome's k-mers in another's, from which ANI is
+estimated by the ANIkmer method (see anikmer.py).
+"""
+
+import math
+import os
+
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+from Bio import SeqIO
+from scipy import sparse
+
+from .pyani_config import SKETCH_KMER, SKETCH_SCALE, SKETCH_SIZE
+
+# 2-bit codes for each base; all other symbols are coded 4
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _idx, _base in enumerate('ACGT'):
+    BASE_CODES[ord(_base)] = _idx
+    BASE_CODES[ord(_base.lower())] = _idx
+
+
+# Hash an array of k-mer codes
+def hash_kmers(codes):
+    """Returns an array of 64-bit hashes of the passed uint64 k-mer codes.
+
+    Uses the splitmix64 finaliser, so that the hashes of similar k-mers
+    are uniformly spread (arithmetic wraps modulo 2**64).
+    """
+    codes = codes ^ (codes >> np.uint64(30))
+    codes *= np.uint64(0xbf58476d1ce4e5b9)
+    codes ^= codes >> np.uint64(27)
+    codes *= np.uint64(0x94d049bb133111eb)
+    codes ^= codes >> np.uint64(31)
+    return codes
+
+
+# Get hashes of the canonical k-mers in a single sequence
+def get_kmer_hashes(seq, kmer=SKETCH_KMER):
+    """Returns an array of hashes of the canonical k-mers in a sequence.
+
+    - seq - sequence, as a string
+    - kmer - k-mer size (at most 32)
+
+    Each k-mer is encoded in 2 bits per base, on both strands, and the
+    smaller of the two codes (the canonical k-mer) is hashed, so that a
+    sequence and its reverse complement give the same hashes. K-mers
+    containing any symbol other than A, C, G or T are skipped.
+    """
+    bases = BASE_CODES[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+    nkmers = len(bases) - kmer + 1
+    if nkmers < 1:
+        return np.zeros(0, dtype=np.uint64)
+    # K-mers are valid if they contain no coded-4 symbols
+    invalid = np.concatenate(([0], np.cumsum(bases == 4)))
+    valid = (invalid[kmer:] - invalid[:-kmer]) == 0
+    bases = np.where(bases == 4, 0, bases).astype(np.uint64)
+    forward = np.zeros(nkmers, dtype=np.uint64)
+    reverse = np.zeros(nkmers, dtype=np.uint64)
+    for pos in range(kmer):
+        window = bases[pos:pos + nkmers]
+        forward = (forward << np.uint64(2)) | window
+        reverse |= (np.uint64(3) - window) << np.uint64(2 * pos)
+    return hash_kmers(np.minimum(forward, reverse)[valid])
+
+
+# Find the smallest distinct values in an array
+def get_bottom_k(hashes, size=SKETCH_SIZE):
+    """Returns a sorted array of the (up to) size smallest distinct hashes.
+
+    Rather than sorting all the hashes, the smallest few are selected with
+    np.partition(), and only these are sorted. The selection is widened
+    until it holds size distinct values, in case of repeated k-mers.
+    """
+    count = 2 * size
+    while count < len(hashes):
+        smallest = np.unique(np.partition(hashes, count - 1)[:count])
+        if len(smallest) >= size:
+            return smallest[:size]
+        count *= 4
+    return np.unique(hashes)[:size]
+
+
+# Sketch a single FASTA file
+def get_sketch(filename, kmer=SKETCH_KMER, size=SKETCH_SIZE):
+    """Returns the bottom-k MinHash sketch of the passed FASTA file.
+
+    - filename - path to FASTA file
+    - kmer - k-mer size
+    - size - number of hashes to keep in the sketch
+
+    The sketch is a sorted array of the (up to) size smallest distinct
+    k-mer hashes, over all sequences in the file.
+    """
+    sketch = np.zeros(0, dtype=np.uint64)
+    for rec in SeqIO.parse(filename, 'fasta'):
+        sketch = np.union1d(sketch, get_bottom_k(
+            get_kmer_hashes(str(rec.seq), kmer), size))[:size]
+    return sketch
+
+
+# Sketch a set of FASTA files
+def get_sketches(filenames, kmer=SKETCH_KMER, size=SKETCH_SIZE,
+                 workers=None):
+    """Returns a dictionary of MinHash sketches, keyed by organism.
+
+    - filenames - paths to FASTA files
+    - kmer - k-mer size
+    - size - number of hashes to keep in each sketch
+    - workers - number of worker processes (default: one per core)
+    """
+    with Pool(processes=workers) as pool:
+        sketches = pool.map(partial(get_sketch, kmer=kmer, size=size),
+                            filenames)
+    return {os.path.splitext(os.path.split(fname)[-1])[0]: fsketch for
+            fname, fsketch in zip(filenames, sketches)}
+
+
+# Make a scaled sketch of a single FASTA file
+def get_scaled_sketch(filename, kmer=SKETCH_KMER, scale=SKETCH_SCALE):
+    """Returns the scaled (FracMinHash) sketch of the passed FASTA file.
+
+    - filename - path to FASTA file
+    - kmer - k-mer size
+    - scale - about one in every scale distinct k-mers is kept
+
+    The sketch is a sorted array of all distinct k-mer hashes, over all
+    sequences in the file, that are below 2**64 / scale. As the same
+    hashes are kept for every genome, sketch sizes are proportional to
+    genome size, and the proportion of one sketch found in another
+    estimates the containment of one genome's k-mers in the other's.
+    """
+    threshold = np.uint64((2 ** 64 - 1) // scale)
+    hashes = [np.zeros(0, dtype=np.uint64)]
+    for rec in SeqIO.parse(filename, 'fasta'):
+        seqhashes = get_kmer_hashes(str(rec.seq), kmer)
+        hashes.append(seqhashes[seqhashes <= threshold])
+    return np.unique(np.concatenate(hashes))
+
+
+# Count hashes shared between two sets of sketches
+def get_shared_hashes(qsketches, ssketches):
+    """Returns an array of the number of hashes shared by each pair of
+    sketches, with query sketches as rows and subject sketches as columns.
+
+    - qsketches - list of query sketches (sorted arrays of hashes)
+    - ssketches - list of subject sketches
+
+    Each set of sketches is indexed against the sorted array of all hashes,
+    as a sparse (sketch x hash) presence matrix, so that all intersections
+    are counted by a single sparse matrix product.
+    """
+    allhashes = np.unique(np.concatenate([np.zeros(0, dtype=np.uint64)] +
+                                         qsketches + ssketches))
+
+    def presence(sketches):
+        """Returns sparse sketch x hash presence matrix."""
+        indptr = np.cumsum([0] + [len(sketch) for sketch in sketches])
+        indices = np.searchsorted(allhashes, np.concatenate(
+            [np.zeros(0, dtype=np.uint64)] + sketches))
+        return sparse.csr_matrix((np.ones(len(indices), dtype=np.int64),
+                                  indices, indptr),
+                                 shape=(len(sketches), len(allhashes)))
+
+    return (presence(qsketches) * presence(ssketches).T).toarray()
+
+
+# Estimate Jaccard index from two sketches
+def get_jaccard(sketch1, sketch2, size=SKETCH_SIZE):
+    """Returns the Jaccard index estimated from two bottom-k sketches.
+
+    - sketch1, sketch2 - sorted arrays of hashes, from get_sketch()
+    - size - sketch size
+
+    As in Mash, the estimate is the proportion of the size smallest hashes
+    of the union of the two sketches that are found in both.
+    """
+    union = np.union1d(sketch1, sketch2)[:size]
+    if not len(union):
+        return 0.0
+    shared = np.intersect1d(sketch1, sketch2, assume_unique=True)
+    return np.count_nonzero(shared <= union[-1]) / float(len(union))
+
+
+# Estimate Jaccard indices between two sets of sketches
+def get_jaccards(qsketches, ssketches):
+    """Returns an array of the Jaccard index estimated from each pair of
+    bottom-k sketches, with query sketches as rows and subject sketches as
+    columns.
+
+    - qsketches - list of query sketches (sorted arrays of hashes)
+    - ssketches - list of subject sketches
+
+    Both sketches of a pair hold every hash of their genome up to the
+    smaller of their largest hashes, so their union up to that hash is the
+    bottom of the union of the two genomes' hashes. The estimate is the
+    proportion of this union found in both sketches. Unlike get_jaccard(),
+    which follows Mash in taking only the size smallest hashes of the
+    union, this uses every hash up to the cutoff, so that all pairs are
+    counted at once: shared hashes with get_shared_hashes(), and the
+    union by searching each sketch for the largest hash of every other.
+    """
+    shared = get_shared_hashes(qsketches, ssketches)
+
+    def largest(sketches):
+        """Returns array of the largest hash in each sketch."""
+        return np.array([sketch[-1] if len(sketch) else 0 for sketch in
+                         sketches], dtype=np.uint64)
+
+    def below(sketches, cutoffs):
+        """Returns (cutoff x sketch) array of hashes up to each cutoff."""
+        return np.array([np.searchsorted(sketch, cutoffs, side='right') for
+                         sketch in sketches],
+                        dtype=np.int64).reshape(len(sketches),
+                                                len(cutoffs)).T
+
+    qmax, smax = largest(qsketches), largest(ssketches)
+    qsizes = np.array([len(sketch) for sketch in qsketches], dtype=np.int64)
+    ssizes = np.array([len(sketch) for sketch in ssketches], dtype=np.int64)
+    union = np.where(qmax[:, None] <= smax[None, :],
+                     qsizes[:, None] + below(ssketches, qmax),
+                     ssizes[None, :] + below(qsketches, smax).T) - shared
+    return np.where(union > 0, shared / np.maximum(union, 1), 0.0)
+
+
+# Convert a Jaccard index to Mash distance
+def get_mash_distance(jaccard, kmer=SKETCH_KMER):
+    """Returns the Mash distance for the passed Jaccard index and k-mer size.
+
+    The distance is 1 (unrelated) if no k-mers are shared.
+    """
+    if jaccard <= 0:
+        return 1.0
+    return min(1.0, -math.log(2 * jaccard / (1 + jaccard)) / kmer)
+
+
+# Convert an array of Jaccard indices to Mash distances
+def get_mash_distances(jaccards, kmer=SKETCH_KMER):
+    """Returns an array of the Mash distances for the passed array of
+    Jaccard indices, as get_mash_distance().
+    """
+    with np.errstate(divide='ignore'):
+        distances = -np.log(2 * jaccards / (1 + jaccards)) / kmer
+    return np.where(jaccards > 0, np.minimum(1.0, distances), 1.0)
+
+
+# Find pairs of genomes too distant to compare
+def get_pruned_pairs(sketches, floor, kmer=SKETCH_KMER, size=SKETCH_SIZE,
+                     references=None):
+    """Returns the set of pairs of organisms with estimated ANI below floor.
+
+    - sketches - dictionary of sketches, keyed by organism, from
+    get_sketches()
+    - floor - estimated ANI (as a fraction, e.g. 0.8) below which a pair is
+    pruned
+    - kmer - k-mer size used to make the sketches
+    - size - sketch size (not needed by get_jaccards(); kept for
+    compatibility)
+    - references - names of reference organisms; if given, only pairs of
+    another organism (query) and a reference are considered
+
+    Each pair is returned as a frozenset of the two organism names. The
+    estimated ANI of a pair is one minus its Mash distance, from Jaccard
+    indices estimated for all pairs at once by get_jaccards().
+    """
+    rows = sorted(sketches)
+    if references is None:
+        columns = rows
+    else:
+        refset = set(references)
+        rows = [name for name in rows if name not in refset]
+        columns = list(references)
+    jaccards = get_jaccards([sketches[name] for name in rows],
+                            [sketches[name] for name in columns])
+    distant = 1 - get_mash_distances(jaccards, kmer) < floor
+    return set([frozenset((rows[row], columns[col])) for row, col in
+                zip(*np.nonzero(distant)) if rows[row] != columns[col]])
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""benchmark_sge.py
+
+Benchmark the run_sge.py driver on synthetic job graphs, using the fake
+SGE cluster in fake_sge.py.
+
+Each graph is ANIm-shaped: half of the jobs are independent "comparison"
+jobs, and each of the others depends on one of them (as delta-filter jobs
+depend on NUCmer jobs). All jobs run `true`. For each graph size the
+benchmark reports the time to build the graph, the time the driver takes to
+compile and order it without submitting anything, and (unless --driver_only
+is given) the end-to-end time of run_sge.run_dependency_graph() on the fake
+cluster, with the number of qsub and qstat calls made.
+
+Run from the repository root, e.g.:
+
+python tests/benchmark_sge.py -n 10000 100000 --driver_only
+python tests/benchmark_sge.py -n 10000 --chunksize 0
+
+(c) The James Hutton Institute 2017
+Author: Leighton Pritchard
+
+Contact:
+leighton.pritchard@hutton.ac.uk
+
+Leighton Pritchard,
+Information and Computing Sciences,
+James Hutton Institute,
+Errol Road,
+Invergowrie,
+Dundee,
+DD6 9LH,
+Scotland,
+UK
+
+The MIT License
+
+Copyright (c) 2017 The James Hutton Institute
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import logging
+import os
+import sys
+import time
+
+from argparse import ArgumentParser
+
+from fake_sge import call_counts, make_fake_sge
+
+from pyani import (pyani_jobs, run_sge)
+
+
+def parse_cmdline():
+    """Parse command-line arguments for the benchmark."""
+    parser = ArgumentParser(prog="benchmark_sge.py")
+    parser.add_argument("-n", "--njobs", dest="njobs", nargs='+', type=int,
+                        default=[10000],
+                        help="Number of jobs in each synthetic graph "
+                        "(default 10000)")
+    parser.add_argument("--chunksize", dest="chunksize", type=int, default=1,
+                        help="Jobs per array task, as --chunksize for "
+                        "average_nucleotide_identity.py (default 1)")
+    parser.add_argument("--SGEgroupsize", dest="sgegroupsize", type=int,
+                        default=10000,
+                        help="Number of jobs to place in an SGE array group "
+                        "(default 10000)")
+    parser.add_argument("--driver_only", dest="driver_only",
+                        action="store_true", default=False,
+                        help="Only time the driver; do not run jobs")
+    parser.add_argument("-o", "--outdir", dest="outdir",
+                        default=os.path.join('tests', 'test_output',
+                                             'benchmark_sge'),
+                        help="Working directory for the fake cluster")
+    return parser.parse_args()
+
+
+def make_graph(njobs):
+    """Returns an ANIm-shaped synthetic job graph of (about) njobs jobs."""
+    jobgraph = []
+    for idx in range(njobs // 2):
+        job = pyani_jobs.Job("bench_%09d-n" % idx, "true", cost=idx % 97)
+        dependent = pyani_jobs.Job("bench_%09d-f" % idx, "true",
+                                   cost=idx % 97)
+        dependent.add_dependency(job)
+        jobgraph.append(dependent)
+    return jobgraph
+
+
+def benchmark(njobs, args, logger):
+    """Runs the benchmark for one graph size, and returns timings."""
+    timings = {'njobs': njobs}
+    start = time.time()
+    jobgraph = make_graph(njobs)
+    timings['build'] = time.time() - start
+
+    start = time.time()
+    joblist = run_sge.build_joblist(jobgraph)
+    jobgroups = run_sge.compile_jobgroups_from_jobgraph(joblist, "bench",
+                                                        args.sgegroupsize,
+                                                        args.chunksize)
+    run_sge.get_submission_order(jobgroups)
+    timings['driver'] = time.time() - start
+    timings['arrays'] = len(jobgroups)
+    timings['tasks'] = sum([jobgroup.tasks for jobgroup in jobgroups])
+    if args.driver_only:
+        return timings
+
+    workdir = os.path.abspath(os.path.join(args.outdir, str(njobs)))
+    spooldir = os.path.join(workdir, 'spool')
+    qsub_exe, qstat_exe = make_fake_sge(os.path.join(workdir, 'bin'),
+                                        spooldir)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        start = time.time()
+        timings['retval'] = run_sge.run_dependency_graph(
+            make_graph(njobs), logger=logger, jgprefix="bench",
+            sgegroupsize=args.sgegroupsize, chunksize=args.chunksize,
+            qsub_exe=qsub_exe, qstat_exe=qstat_exe)
+        timings['run'] = time.time() - start
+    finally:
+        os.chdir(cwd)
+    timings.update(call_counts(spooldir))
+    return timings
+
+
+def main():
+    """Runs the benchmark for each graph size, and prints a table."""
+    args = parse_cmdline()
+    logger = logging.getLogger('benchmark_sge')
+    logger.addHandler(logging.NullHandler())
+    fields = ['njobs', 'arrays', 'tasks', 'build', 'driver']
+    if not args.driver_only:
+        fields += ['run', 'qsub', 'qstat', 'retval']
+    print('\t'.join(fields))
+    for njobs in args.njobs:
+        timings = benchmark(njobs, args, logger)
+        print('\t'.join([("%.3f" % timings[field]) if
+                         isinstance(timings[field], float) else
+                         str(timings[field]) for field in fields]))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""fake_sge.py
+
+A local stand-in for an SGE cluster, for testing and benchmarking the
+run_sge.py driver without a grid.
+
+make_fake_sge() writes qsub and qstat executables to a directory. These
+share a spool directory:
+
+- qsub records each submitted job in the spool, reports a job ID (-terse
+output), and starts a background runner for the job. The runner waits
+for the job's holds (-hold_jid on whole jobs; -hold_jid_ad on matching
+array tasks), then runs its tasks (-t) through a local pool of
+FAKE_SGE_SLOTS (default 4) threads, each running the job script with bash
+and $SGE_TASK_ID set. The exit code of each task is recorded in the spool.
+- qstat -xml lists the jobs that have not yet finished.
+
+Jobs run in the directory qsub was called from, with its environment (as
+-cwd and -V would give). Other options (-N, -o, -e, -pe, -l, ...) are
+accepted; task output is discarded. The number of calls to qsub and qstat
+is counted, for benchmarking (see call_counts()).
+
+(c) The James Hutton Institute 2017
+Author: Leighton Pritchard
+
+Contact:
+leighton.pritchard@hutton.ac.uk
+
+Leighton Pritchard,
+Information and Computing Sciences,
+James Hutton Institute,
+Errol Road,
+Invergowrie,
+Dundee,
+DD6 9LH,
+Scotland,
+UK
+
+The MIT License
+
+Copyright (c) 2017 The James Hutton Institute
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+# qsub options that take a value (-pe takes two)
+VALUE_OPTIONS = ('-N', '-o', '-e', '-t', '-hold_jid', '-hold_jid_ad', '-l',
+                 '-q', '-S', '-P', '-A', '-M', '-m', '-wd', '-v')
+POLL_INTERVAL = 0.02  # Time (s) between checks on held jobs
+
+WRAPPER = """#!/bin/sh
+FAKE_SGE_SPOOL={spool} exec {python} {module} {command} "$@"
+"""
+
+
+def make_fake_sge(bindir, spooldir):
+    """Writes fake qsub and qstat executables, and returns their paths.
+
+    - bindir - directory for the executables
+    - spooldir - directory in which the fake cluster keeps its jobs; any
+    existing contents are removed
+    """
+    if os.path.exists(spooldir):
+        shutil.rmtree(spooldir)
+    os.makedirs(spooldir)
+    os.makedirs(bindir, exist_ok=True)
+    paths = []
+    for command in ('qsub', 'qstat'):
+        path = os.path.join(bindir, command)
+        with open(path, 'w') as ofh:
+            ofh.write(WRAPPER.format(spool=os.path.abspath(spooldir),
+                                     python=sys.executable,
+                                     module=os.path.abspath(__file__),
+                                     command=command))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        paths.append(path)
+    return tuple(paths)
+
+
+def call_counts(spooldir):
+    """Returns a dictionary of the number of qsub and qstat calls made."""
+    counts = {}
+    for command in ('qsub', 'qstat'):
+        path = os.path.join(spooldir, '%s.calls' % command)
+        counts[command] = os.path.getsize(path) if os.path.exists(path) else 0
+    return counts
+
+
+def count_call(spooldir, command):
+    """Records a call to the passed command, as one byte in a log file."""
+    with open(os.path.join(spooldir, '%s.calls' % command), 'a') as ofh:
+        ofh.write('.')
+
+
+def parse_qsub_args(args):
+    """Returns a dictionary describing the job from qsub's arguments."""
+    job = {'name': None, 'tasks': None, 'hold_jid': [], 'hold_jid_ad': [],
+           'script': None}
+    idx = 0
+    while idx < len(args):
+        arg = args[idx]
+        if arg in VALUE_OPTIONS:
+            value = args[idx + 1]
+            if arg == '-N':
+                job['name'] = value
+            elif arg == '-t':
+                last = value.replace('-', ':').split(':')[1]
+                job['tasks'] = int(last)
+            elif arg in ('-hold_jid', '-hold_jid_ad'):
+                job[arg[1:]] = value.split(',')
+            idx += 2
+        elif arg == '-pe':
+            idx += 3
+        elif arg.startswith('-'):
+            idx += 1
+        else:
+            job['script'] = os.path.abspath(arg)  # Later arguments: script's
+            break
+    if job['name'] is None:
+        job['name'] = os.path.split(job['script'])[-1]
+    return job
+
+
+def qsub(spooldir, args):
+    """Records a job in the spool, starts its runner and prints its ID."""
+    count_call(spooldir, 'qsub')
+    job = parse_qsub_args(args)
+    job['cwd'] = os.getcwd()
+    with open(os.path.join(spooldir, 'lock'), 'a') as lockfh:
+        fcntl.flock(lockfh, fcntl.LOCK_EX)
+        counter = os.path.join(spooldir, 'counter')
+        jobid = 1
+        if os.path.exists(counter):
+            with open(counter) as ifh:
+                jobid = int(ifh.read()) + 1
+        with open(counter, 'w') as ofh:
+            ofh.write(str(jobid))
+        with open(os.path.join(spooldir, '%d.job' % jobid), 'w') as ofh:
+            json.dump(job, ofh)
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), 'run',
+                      str(jobid)], env=dict(os.environ),
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+    if job['tasks'] is None:
+        print(jobid)
+    else:
+        print('%d.1-%d:1' % (jobid, job['tasks']))
+
+
+def qstat(spooldir, args):
+    """Prints the unfinished jobs in the spool, as qstat -xml would."""
+    count_call(spooldir, 'qstat')
+    lines = ['<?xml version="1.0"?>', '<job_info>', '<queue_info>']
+    for entry in os.scandir(spooldir):
+        if not entry.name.endswith('.job'):
+            continue
+        jobid = entry.name[:-4]
+        if os.path.exists(os.path.join(spooldir, '%s.done' % jobid)):
+            continue
+        with open(entry.path) as ifh:
+            job = json.load(ifh)
+        lines.append('<job_list state="running"><JB_job_number>%s'
+                     '</JB_job_number><JB_name>%s</JB_name><state>r</state>'
+                     '</job_list>' % (jobid, job['name']))
+    lines += ['</queue_info>', '<job_info>', '</job_info>', '</job_info>']
+    print('\n'.join(lines))
+
+
+def resolve_holds(spooldir, holds):
+    """Returns the job IDs for the passed list of job IDs or names."""
+    jobids, names = [], []
+    for hold in holds:
+        (jobids if hold.isdigit() else names).append(hold)
+    if len(names):
+        for entry in os.scandir(spooldir):
+            if entry.name.endswith('.job'):
+                with open(entry.path) as ifh:
+                    if json.load(ifh)['name'] in names:
+                        jobids.append(entry.name[:-4])
+    return jobids
+
+
+def wait_for(paths):
+    """Waits until all of the passed files exist."""
+    for path in paths:
+        while not os.path.exists(path):
+            time.sleep(POLL_INTERVAL)
+
+
+def run_task(spooldir, jobid, job, task):
+    """Runs one task of a job, once its task-level holds are released."""
+    wait_for([os.path.join(spooldir, '%s.%s.done' % (held, task)) for
+              held in job['hold_ad_ids']])
+    env = dict(os.environ)
+    env['JOB_ID'] = str(jobid)
+    env['SGE_TASK_ID'] = str(task)
+    result = subprocess.run(['bash', job['script']], cwd=job['cwd'], env=env,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    with open(os.path.join(spooldir, '%s.%s.done' % (jobid, task)),
+              'w') as ofh:
+        ofh.write(str(result.returncode))
+
+
+def run(spooldir, jobid):
+    """Runs a job's tasks once its holds are released, then marks it done."""
+    with open(os.path.join(spooldir, '%s.job' % jobid)) as ifh:
+        job = json.load(ifh)
+    wait_for([os.path.join(spooldir, '%s.done' % held) for held in
+              resolve_holds(spooldir, job['hold_jid'])])
+    job['hold_ad_ids'] = resolve_holds(spooldir, job['hold_jid_ad'])
+    if job['tasks'] is None:
+        tasks = ['undefined']
+    else:
+        tasks = range(1, job['tasks'] + 1)
+    slots = int(os.environ.get('FAKE_SGE_SLOTS', 4))
+    with ThreadPoolExecutor(max_workers=slots) as executor:
+        for future in [executor.submit(run_task, spooldir, jobid, job, task)
+                       for task in tasks]:
+            future.result()
+    with open(os.path.join(spooldir, '%s.done' % jobid), 'w') as ofh:
+        ofh.write('done')
+
+
+if __name__ == '__main__':
+    SPOOL = os.environ['FAKE_SGE_SPOOL']
+    if sys.argv[1] == 'qsub':
+        qsub(SPOOL, sys.argv[2:])
+    elif sys.argv[1] == 'qstat':
+        qstat(SPOOL, sys.argv[2:])
+    elif sys.argv[1] == 'run':
+        run(SPOOL, sys.argv[2])
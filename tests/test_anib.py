@@ -50,7 +50,9 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import json
 import os
+import shutil
 import unittest
 
 import pandas as pd
@@ -58,7 +60,7 @@ import pandas as pd
 from nose.tools import (assert_equal,)
 from pandas.util.testing import (assert_frame_equal,)
 
-from pyani import (anib, pyani_files)
+from pyani import (anib, pyani_config, pyani_files)
 
 
 class TestBLASTCmdline(unittest.TestCase):
@@ -262,6 +264,73 @@ class TestBLASTCmdline(unittest.TestCase):
             dep = job.dependencies[0]
             assert(dep.script.startswith('makeblastdb'))
 
+    def test_blastn_references(self):
+        """create BLASTN jobs for queries against references only."""
+        infiles = sorted(self.infiles)
+        queries, references = infiles[:1], infiles[1:]
+        fragresult = anib.fragment_fasta_files(queries, self.outdir,
+                                               self.fraglen)
+        blastcmds = anib.make_blastcmd_builder("ANIb", self.outdir)
+        jobgraph = anib.make_job_graph(queries, fragresult[0], blastcmds,
+                                       references=references)
+        assert_equal(len(jobgraph), len(references))
+        for job, ref in zip(jobgraph, references):
+            assert(job.script.startswith('blastn -out %s' %
+                                         os.path.join(self.outdir,
+                                                      'NC_002696_vs_' +
+                                                      os.path.splitext(
+                                                          os.path.split(
+                                                              ref)[-1])[0])))
+            assert_equal(job.dependencies[0].script.split()[4], ref)
+
+    def test_blastn_shards(self):
+        """write BLASTN+ output to shard subdirectories."""
+        blastcmds = anib.make_blastcmd_builder("ANIb", self.outdir,
+                                               shard=True)
+        cmd = blastcmds.build_blast_cmd('NC_002696-fragments.fna',
+                                        'NC_011916.fna')
+        outdir = os.path.join(self.outdir,
+                              pyani_files.get_shard('NC_002696_vs_NC_011916'))
+        assert(cmd.startswith('blastn -out %s' %
+                              os.path.join(outdir,
+                                           'NC_002696_vs_NC_011916')))
+        assert(os.path.isdir(outdir))
+
+    def test_blast_costs(self):
+        """estimate BLAST job costs from sequence lengths."""
+        lengths = {'NC_002696': 4, 'NC_011916': 3}
+        assert_equal(0, anib.get_blast_cost(self.infiles[0]))
+        assert_equal(4, anib.get_blast_cost('NC_002696-fragments.fna',
+                                            lengths=lengths))
+        assert_equal(12, anib.get_blast_cost('NC_002696-fragments.fna',
+                                             'NC_011916.fna', lengths))
+
+    def test_blast_threads(self):
+        """give larger BLAST searches more threads."""
+        lengths = {'g1': 10, 'g2': 10, 'g3': 2}
+        fragfiles = ['%s-fragments.fna' % name for name in sorted(lengths)]
+        blastcmds = anib.make_blastcmd_builder("ANIb", self.outdir,
+                                               threads=4)
+        jobs = list(anib.iter_blast_jobs(fragfiles, blastcmds, {},
+                                         lengths=lengths))
+        assert_equal([job.threads for job in jobs], [4, 4, 1, 1, 1, 1])
+        assert ' -num_threads 4' in jobs[0].script
+        assert '-num_threads' not in jobs[-1].script
+
+    def test_blast_memory(self):
+        """estimate BLAST job memory for two bacterial genomes."""
+        seqfiles = [os.path.join(self.seqdir, fname) for fname in
+                    ('NC_002696.fna', 'NC_011916.fna')]
+        lengths = pyani_files.get_sequence_lengths(seqfiles)
+        total = sum(lengths.values())
+        assert_equal(0, anib.get_blast_memory(seqfiles))
+        assert_equal(pyani_config.BLASTN_MEMORY_PER_BASE * total,
+                     anib.get_blast_memory(['NC_002696-fragments.fna',
+                                            'NC_011916.fna'], lengths))
+        # About 8Mbp of genome: a BLASTN estimate between 5MB and 100MB
+        assert 5 * 1024 ** 2 < pyani_config.BLASTN_MEMORY_PER_BASE * total
+        assert pyani_config.BLASTN_MEMORY_PER_BASE * total < 100 * 1024 ** 2
+
     def test_blastall_graph(self):
         """create jobgraph for legacy BLASTN jobs."""
         fragresult = anib.fragment_fasta_files(self.infiles, self.outdir,
@@ -375,3 +444,201 @@ class TestParsing(unittest.TestCase):
                                     fraglengths, mode="ANIblastall")
         assert_frame_equal(result.percentage_identity.sort_index(1).sort_index(),
                            self.aniblastalltgt.sort_index(1).sort_index())
+
+
+class TestBLASTDBCache(unittest.TestCase):
+
+    """Class defining tests of the persistent BLAST database cache."""
+
+    def setUp(self):
+        """Set parameters for tests."""
+        self.seqdir = os.path.join('tests', 'test_input', 'sequences')
+        self.outdir = os.path.join('tests', 'test_output', 'anib_cache')
+        self.cachedir = os.path.join(self.outdir, 'cache')
+        self.dbdir = os.path.join(self.outdir, 'blastn')
+        self.infiles = [os.path.join(self.seqdir, fname) for fname in
+                        ('NC_002696.fna', 'NC_011916.fna')]
+        if os.path.isdir(self.outdir):
+            shutil.rmtree(self.outdir)
+        os.makedirs(self.dbdir, exist_ok=True)
+
+    def test_cache_key(self):
+        """cache key depends on file contents and tool version."""
+        key1 = anib.get_blastdb_cache_key(self.infiles[0], 'makeblastdb')
+        key2 = anib.get_blastdb_cache_key(self.infiles[1], 'makeblastdb')
+        key3 = anib.get_blastdb_cache_key(self.infiles[0], 'formatdb')
+        assert_equal(key1, anib.get_blastdb_cache_key(self.infiles[0],
+                                                      'makeblastdb'))
+        assert key1 != key2
+        assert key1 != key3
+
+    def test_cached_dbs_skip_jobs(self):
+        """cached BLAST databases are linked, and not rebuilt."""
+        blastcmds = anib.make_blastcmd_builder("ANIb", self.dbdir)
+        # Fake the output of makeblastdb for the first input file only
+        for ext in ('.nhr', '.nin', '.nsq'):
+            with open(os.path.join(self.dbdir,
+                                   'NC_002696.fna' + ext), 'w') as ofh:
+                ofh.write("db")
+        assert_equal(1, anib.cache_blastdbs(self.infiles, blastcmds,
+                                            self.cachedir))
+        for fname in os.listdir(self.dbdir):
+            os.remove(os.path.join(self.dbdir, fname))
+        jobdict = anib.build_db_jobs(self.infiles, blastcmds, self.cachedir)
+        assert_equal([os.path.join(self.dbdir, 'NC_011916.fna')],
+                     list(jobdict.keys()))
+        assert os.path.islink(os.path.join(self.dbdir, 'NC_002696.fna.nin'))
+
+    def test_cache_renamed_input(self):
+        """cached BLAST database found for same sequence under a new name."""
+        blastcmds = anib.make_blastcmd_builder("ANIb", self.dbdir)
+        for ext in ('.nhr', '.nin', '.nsq'):
+            with open(os.path.join(self.dbdir,
+                                   'NC_002696.fna' + ext), 'w') as ofh:
+                ofh.write("db")
+        anib.cache_blastdbs(self.infiles[:1], blastcmds, self.cachedir)
+        renamed = os.path.join(self.outdir, 'renamed.fna')
+        shutil.copy(self.infiles[0], renamed)
+        jobdict = anib.build_db_jobs([renamed], blastcmds, self.cachedir)
+        assert_equal({}, jobdict)
+        assert os.path.islink(os.path.join(self.dbdir, 'renamed.fna.nin'))
+
+    def test_cache_key_no_version(self):
+        """cache key for a tool without -version depends on its mtime."""
+        exe = os.path.join(self.outdir, 'formatdb')
+        with open(exe, 'w') as ofh:
+            ofh.write("#!/bin/sh\nexit 1\n")
+        os.chmod(exe, 0o755)
+        version = anib.get_blastdb_tool_version(exe)
+        assert version.startswith(os.path.realpath(exe))
+        os.utime(exe, ns=(0, 0))
+        anib.get_blastdb_tool_version.cache_clear()
+        assert version != anib.get_blastdb_tool_version(exe)
+
+
+class TestCombinedDB(unittest.TestCase):
+
+    """Class defining tests of ANIb against a combined BLAST database."""
+
+    def setUp(self):
+        """Set parameters for tests."""
+        self.seqdir = os.path.join('tests', 'test_input', 'sequences')
+        self.outdir = os.path.join('tests', 'test_output', 'anib_combined')
+        self.infiles = [os.path.join(self.seqdir, fname) for fname in
+                        ('NC_002696.fna', 'NC_011916.fna')]
+        self.genomes = ['NC_002696', 'NC_011916', 'NC_014100']
+        self.combinedfile = os.path.join(self.outdir,
+                                         'NC_002696.blast_combined')
+        self.lengths = {'NC_002696': 1000000, 'NC_011916': 3000000,
+                        'NC_014100': 2000000}
+        self.pairdir = os.path.join(self.outdir, 'pairwise')
+        self.combdir = os.path.join(self.outdir, 'combined')
+        for dirname in (self.pairdir, self.combdir):
+            if os.path.isdir(dirname):
+                shutil.rmtree(dirname)
+            os.makedirs(dirname)
+        os.makedirs(self.outdir, exist_ok=True)
+
+    def test_combined_graph(self):
+        """create jobgraph with one BLASTN job per genome."""
+        fragfiles, _ = anib.fragment_fasta_files(self.infiles, self.outdir,
+                                                 1000)
+        blastcmds = anib.make_blastcmd_builder("ANIb", self.outdir)
+        jobgraph = anib.make_combined_job_graph(self.infiles, fragfiles,
+                                                blastcmds)
+        assert_equal(len(self.infiles), len(jobgraph))
+        for job in jobgraph:
+            assert('.blast_combined' in job.script)
+            assert_equal(1, len(job.dependencies))
+            dep = job.dependencies[0]
+            assert(dep.script.endswith('-parse_seqids'))
+            assert(dep is jobgraph[0].dependencies[0])
+
+    @staticmethod
+    def blast_line(frag, sid, alnlen, mismatch, evalue=None, bitscore=None):
+        """Return a line of BLASTN tabular output for a 1000bp fragment."""
+        fields = [frag, sid, alnlen, mismatch,
+                  100. * (alnlen - mismatch) / alnlen, alnlen - mismatch,
+                  1000, 5000, 1, alnlen, 1, alnlen, alnlen - mismatch,
+                  100. * (alnlen - mismatch) / alnlen, 0]
+        if evalue is not None:
+            fields += [evalue, bitscore]
+        return '\t'.join([str(field) for field in fields]) + '\n'
+
+    def write_searches(self):
+        """Write the same searches as pairwise and combined output.
+
+        The combined output also has, for each query, a weaker hit to
+        another sequence of each subject genome, listed before the best
+        hit, and a hit that is significant against the combined database's
+        size, but which a pairwise search reports only for subject genomes
+        up to 2.5 times that size.
+        """
+        with open(os.path.join(self.combdir,
+                               pyani_config.COMBINED_GENOMES), 'w') as ofh:
+            json.dump(self.genomes, ofh)
+        for qidx, qname in enumerate(self.genomes):
+            comblines = []
+            for sidx, sname in enumerate(self.genomes):
+                lines = [('frag%05d' % fidx, 950 + fidx + sidx,
+                          10 * (fidx + qidx)) for fidx in range(3)]
+                comblines.append(self.blast_line(
+                    'frag00000', 'g%06d_000001' % sidx, 990, 400, 1e-20, 50))
+                for frag, alnlen, mismatch in lines:
+                    comblines.append(self.blast_line(
+                        frag, 'g%06d_000000' % sidx, alnlen, mismatch,
+                        1e-100, 1000))
+                comblines.append(self.blast_line(
+                    'frag00009', 'g%06d_000000' % sidx, 999, 1, 4e-16, 60))
+                if sname == qname:
+                    continue
+                if self.lengths[sname] <= 2500000:
+                    lines.append(('frag00009', 999, 1))
+                with open(os.path.join(self.pairdir, "%s_vs_%s.blast_tab" %
+                                       (qname, sname)), 'w') as ofh:
+                    ofh.writelines([self.blast_line(frag, 'seq1', alnlen,
+                                                    mismatch) for
+                                    frag, alnlen, mismatch in lines])
+            with open(os.path.join(self.combdir,
+                                   qname + '.blast_combined'), 'w') as ofh:
+                ofh.writelines(comblines)
+
+    def test_split_combined(self):
+        """split combined BLASTN output into pairwise best hits."""
+        self.write_searches()
+        combinedfile = os.path.join(self.combdir, 'NC_002696.blast_combined')
+        outfiles = anib.split_combined_blast(combinedfile, self.genomes,
+                                             self.combdir, self.lengths)
+        assert_equal([os.path.join(self.combdir, fname) for fname in
+                      ('NC_002696_vs_NC_011916.blast_tab',
+                       'NC_002696_vs_NC_014100.blast_tab')], outfiles)
+        # Only hits to the best subject sequence are kept, without E-value
+        # and bit score; the weakest hit is not significant against the
+        # largest genome
+        with open(outfiles[0], 'r') as ifh:
+            lines = ifh.readlines()
+        assert_equal(3, len(lines))
+        assert_equal(15, len(lines[0].split('\t')))
+        assert all(['\tg000001_000000\t' in line for line in lines])
+        with open(outfiles[1], 'r') as ifh:
+            assert_equal(4, len(ifh.readlines()))
+
+    def test_combined_matches_pairwise(self):
+        """combined-database and pairwise searches give the same ANIb."""
+        self.write_searches()
+        pairwise = anib.process_blast(self.pairdir, self.lengths)
+        combined = anib.process_blast(self.combdir, self.lengths)
+        for dfr1, dfr2 in zip([dfr for dfr, _ in pairwise.data],
+                              [dfr for dfr, _ in combined.data]):
+            assert dfr1.equals(dfr2)
+
+    def test_combined_sharded(self):
+        """split combined-database output written to shard directories."""
+        self.write_searches()
+        pairwise = anib.process_blast(self.pairdir, self.lengths)
+        combined = anib.process_blast(self.combdir, self.lengths,
+                                      shard=True)
+        assert not os.path.isfile(os.path.join(
+            self.combdir, 'NC_002696_vs_NC_011916.blast_tab'))
+        assert pairwise.percentage_identity.equals(
+            combined.percentage_identity)
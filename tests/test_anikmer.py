@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test_anikmer.py
+
+Test anikmer.py module.
+
+These tests are intended to be run from the repository root using:
+
+nosetests -v
+
+print() statements will be caught by nosetests unless there is an
+error. They can also be recovered with the -s option.
+
+(c) The James Hutton Institute 2017
+Author: Leighton Pritchard
+
+Contact:
+leighton.pritchard@hutton.ac.uk
+
+Leighton Pritchard,
+Information and Computing Sciences,
+James Hutton Institute,
+Errol Road,
+Invergowrie,
+Dundee,
+DD6 9LH,
+Scotland,
+UK
+
+The MIT License
+
+Copyright (c) 2017 The James Hutton Institute
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import unittest
+
+from nose.tools import (assert_equal, assert_less)
+
+from pyani import (anikmer, pyani_files)
+
+
+class TestANIkmer(unittest.TestCase):
+
+    """Class defining tests of alignment-free ANI estimation."""
+
+    def setUp(self):
+        """Sketch input sequences for tests."""
+        self.indir = os.path.join('tests', 'test_input', 'concordance')
+        self.infiles = pyani_files.get_fasta_files(self.indir)
+        self.orglengths = pyani_files.get_sequence_lengths(self.infiles)
+        self.sketches = anikmer.get_sketches(self.infiles, workers=2)
+        # JSpecies ANIm for the two closely-related genomes
+        self.pair = ('GCF_000011325.1_ASM1132v1_genomic',
+                     'GCF_002243555.1_ASM224355v1_genomic')
+        self.anim = 0.9819
+        # JSpecies ANIm and ANIb (lowest pairwise values) for the distant
+        # genome against each of the pair
+        self.distant = 'GCF_000227605.2_ASM22760v2_genomic'
+        self.distant_anim = 0.8409
+        self.distant_anib = 0.6866
+
+    def test_anikmer(self):
+        """estimate ANI for all pairs, close to ANIm for related genomes."""
+        results = anikmer.process_sketches(self.sketches, self.orglengths)
+        pid = results.percentage_identity
+        assert_equal(sorted(pid.index), sorted(self.orglengths))
+        assert_equal(sorted(pid.columns), sorted(self.orglengths))
+        for org in self.orglengths:
+            assert_equal(pid.loc[org, org], 1)
+            assert_equal(results.alignment_lengths.loc[org, org],
+                         self.orglengths[org])
+        for qname, sname in (self.pair, self.pair[::-1]):
+            assert_less(abs(pid.loc[qname, sname] - self.anim), 0.002)
+
+    def test_anikmer_distant(self):
+        """estimate ANI below ANIm, but above ANIb, for distant genomes."""
+        results = anikmer.process_sketches(self.sketches, self.orglengths)
+        pid = results.percentage_identity
+        for org in self.pair:
+            for qname, sname in ((org, self.distant), (self.distant, org)):
+                # Known bias: about 9% below ANIm (see pyani.anikmer)
+                assert_less(self.distant_anib, pid.loc[qname, sname])
+                assert_less(pid.loc[qname, sname], self.distant_anim - 0.07)
+                assert_less(abs(pid.loc[qname, sname] - 0.748), 0.015)
+
+    def test_anikmer_references(self):
+        """estimate ANI for queries against references only."""
+        results = anikmer.process_sketches(self.sketches, self.orglengths,
+                                           references=self.pair[1:])
+        pid = results.percentage_identity
+        assert_equal(pid.shape, (2, 1))
+        assert_equal(list(pid.columns), list(self.pair[1:]))
+        assert_less(abs(pid.loc[self.pair[0], self.pair[1]] - self.anim),
+                    0.002)
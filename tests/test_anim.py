@@ -59,7 +59,7 @@ import pandas as pd
 from nose.tools import (assert_equal,)
 from pandas.util.testing import (assert_frame_equal,)
 
-from pyani import (anim, pyani_files)
+from pyani import (anim, pyani_config, pyani_files)
 
 
 class TestNUCmerCmdline(unittest.TestCase):
@@ -145,6 +145,113 @@ class TestNUCmerCmdline(unittest.TestCase):
             assert_equal(job.dependencies[0].name,
                          "test_%06d-n" % idx)            # NUCmer job name
 
+    def test_nucmer_job_commands(self):
+        """NUCmer/delta-filter jobs render the generated command-lines."""
+        joblist = anim.generate_nucmer_jobs(self.files, jobprefix="test")
+        assert_equal(([job.dependencies[0].command for job in joblist],
+                      [job.command for job in joblist]),
+                     (self.ncmdlist, self.fcmdlist))
+        assert(joblist[0].template is joblist[1].template)
+
+    def test_nucmer_job_iteration(self):
+        """generate NUCmer/delta-filter jobs on demand."""
+        jobs = anim.iter_nucmer_jobs(self.files, jobprefix="test")
+        assert_equal(next(jobs).command, self.fcmdlist[0])
+        assert_equal(len(list(jobs)), 5)
+
+    def test_nucmer_job_skip(self):
+        """skip NUCmer/delta-filter jobs for pruned pairs."""
+        skip = {frozenset(('file1', 'file3')), frozenset(('file4', 'file2'))}
+        joblist = anim.generate_nucmer_jobs(self.files, jobprefix="test",
+                                            skip=skip)
+        assert_equal([job.command for job in joblist],
+                     [self.fcmdlist[idx] for idx in (0, 2, 3, 5)])
+
+    def test_nucmer_job_references(self):
+        """generate NUCmer/delta-filter jobs for queries against references."""
+        joblist = anim.generate_nucmer_jobs(self.files[:1], jobprefix="test",
+                                            references=self.files[1:])
+        assert_equal([job.command for job in joblist], self.fcmdlist[:3])
+        joblist = anim.generate_nucmer_jobs(self.files[2:], jobprefix="test",
+                                            references=self.files[:1])
+        assert_equal([job.command.split()[-1] for job in joblist],
+                     ['./nucmer_output/file3_vs_file1.filter',
+                      './nucmer_output/file4_vs_file1.filter'])
+
+    def test_nucmer_job_costs(self):
+        """estimate NUCmer job costs from sequence lengths."""
+        lengths = {'file1': 2, 'file2': 12, 'file3': 5, 'file4': 1}
+        joblist = anim.generate_nucmer_jobs(self.files, jobprefix="test",
+                                            lengths=lengths)
+        # Largest comparisons first
+        assert_equal([job.cost for job in joblist], [17, 14, 13, 7, 6, 3])
+        assert_equal([job.dependencies[0].cost for job in joblist],
+                     [17, 14, 13, 7, 6, 3])
+
+    def test_nucmer_job_memory(self):
+        """estimate NUCmer job memory for two bacterial genomes."""
+        seqdir = os.path.join('tests', 'test_input', 'sequences')
+        seqfiles = [os.path.join(seqdir, fname) for fname in
+                    ('NC_002696.fna', 'NC_011916.fna')]
+        lengths = pyani_files.get_sequence_lengths(seqfiles)
+        total = sum(lengths.values())
+        for maxmatch, per_base in (
+                (False, pyani_config.NUCMER_MEMORY_PER_BASE),
+                (True, pyani_config.NUCMER_MAXMATCH_MEMORY_PER_BASE)):
+            job = anim.generate_nucmer_jobs(seqfiles, lengths=lengths,
+                                            maxmatch=maxmatch)[0]
+            assert_equal(per_base * total, job.dependencies[0].memory)
+        # About 8Mbp of genome: a NUCmer estimate between 50MB and 1GB
+        assert 50 * 1024 ** 2 < pyani_config.NUCMER_MEMORY_PER_BASE * total
+        assert pyani_config.NUCMER_MEMORY_PER_BASE * total < 1024 ** 3
+
+    def test_nucmer_job_shards(self):
+        """write NUCmer/delta-filter output to shard subdirectories."""
+        outdir = os.path.join(self.outdir, 'sharded')
+        joblist = anim.generate_nucmer_jobs(self.files, outdir,
+                                            jobprefix="test", shard=True)
+        filterfiles = []
+        for job, fname in zip(joblist, self.fcmdlist):
+            stem = os.path.splitext(os.path.split(fname)[-1])[0]
+            shard = pyani_files.get_shard(stem)
+            filterfile = os.path.join(outdir, 'nucmer_output', shard,
+                                      stem + '.filter')
+            assert_equal(job.command.split()[-1], filterfile)
+            assert(os.path.isdir(os.path.dirname(filterfile)))
+            open(filterfile, 'w').close()
+            filterfiles.append(filterfile)
+        assert_equal(sorted(pyani_files.get_sharded_files(
+            os.path.join(outdir, 'nucmer_output'), '.filter')),
+                     sorted(filterfiles))
+
+    def test_nucmer_job_manifest(self):
+        """record expected NUCmer output in a manifest, and read it back."""
+        outdir = os.path.join(self.outdir, 'manifest')
+        files = ["org_vs_1", "org2"]
+        joblist = anim.generate_nucmer_jobs(files, outdir, jobprefix="test",
+                                            shard=True, manifest=True)
+        alndir = os.path.join(outdir, 'nucmer_output')
+        filterfile = joblist[0].command.split()[-1]
+        open(filterfile, 'w').close()
+        outputs = list(pyani_files.get_pairwise_outputs(
+            alndir, '.filter', {'org_vs_1': 1, 'org2': 1}))
+        assert_equal(outputs, [('org_vs_1', 'org2',
+                                os.path.join(alndir, os.path.relpath(
+                                    filterfile, alndir)))])
+        os.remove(filterfile)
+        assert_equal(list(pyani_files.get_pairwise_outputs(
+            alndir, '.filter', {'org_vs_1': 1, 'org2': 1})), [])
+
+    def test_split_pair_name(self):
+        """split output file names into known sequence names."""
+        names = {'a_vs_b': 1, 'c': 1, 'a': 1}
+        assert_equal(pyani_files.split_pair_name('a_vs_b_vs_c', names),
+                     ('a_vs_b', 'c'))
+        assert_equal(pyani_files.split_pair_name('c_vs_a_vs_b', names),
+                     ('c', 'a_vs_b'))
+        assert_equal(pyani_files.split_pair_name('x_vs_y', names),
+                     ('x', 'y'))
+
 
 class TestDeltafileProcessing(unittest.TestCase):
 
@@ -177,3 +284,37 @@ class TestDeltafileProcessing(unittest.TestCase):
         result = anim.process_deltadir(self.deltadir, orglengths)
         assert_frame_equal(result.percentage_identity.sort_index(1).sort_index(),
                            self.df_pid.sort_index(1).sort_index())
+
+
+class TestNUCmerThreads(unittest.TestCase):
+
+    """Class defining tests of multithreaded NUCmer jobs."""
+
+    def test_threaded_cmd_generation(self):
+        """generate multithreaded NUCmer command line and jobs."""
+        ncmd, _ = anim.construct_nucmer_cmdline("file1.fna", "file2.fna",
+                                                threads=4)
+        assert_equal(ncmd, ' '.join(["nucmer --mum --threads 4 -p",
+                                     "./nucmer_output/file1_vs_file2",
+                                     "file1.fna file2.fna"]))
+        joblist = anim.generate_nucmer_jobs(["file1", "file2"], threads=4)
+        assert_equal(1, joblist[0].threads)                  # delta-filter
+        assert_equal(4, joblist[0].dependencies[0].threads)  # NUCmer
+
+    def test_threads_by_size(self):
+        """give larger NUCmer jobs more threads."""
+        lengths = {'file1': 2, 'file2': 12, 'file3': 5, 'file4': 1}
+        joblist = anim.generate_nucmer_jobs(
+            ['%s.fna' % name for name in sorted(lengths)], threads=4,
+            lengths=lengths)
+        njobs = [job.dependencies[0] for job in joblist]
+        # Threads scale with the product of genome lengths: 60 is largest
+        assert_equal([(job.args[3], job.args[4], job.threads) for
+                      job in njobs],
+                     [('file2', 'file3', 4), ('file1', 'file2', 2),
+                      ('file2', 'file4', 1), ('file1', 'file3', 1),
+                      ('file3', 'file4', 1), ('file1', 'file4', 1)])
+        assert_equal([job.command.split()[1:3] for job in njobs[:2]],
+                     [['--mum', '--threads'], ['--mum', '--threads']])
+        assert_equal(njobs[0].command.split()[3], '4')
+        assert_equal(njobs[2].command.split()[1:3], ['--mum', '-p'])
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test_archive.py
+
+Test pyani_archive.py module.
+
+These tests are intended to be run from the repository root using:
+
+nosetests -v
+
+print() statements will be caught by nosetests unless there is an
+error. They can also be recovered with the -s option.
+
+(c) The James Hutton Institute 2017
+Author: Leighton Pritchard
+
+Contact:
+leighton.pritchard@hutton.ac.uk
+
+Leighton Pritchard,
+Information and Computing Sciences,
+James Hutton Institute,
+Errol Road,
+Invergowrie,
+Dundee,
+DD6 9LH,
+Scotland,
+UK
+
+The MIT License
+
+Copyright (c) 2017 The James Hutton Institute
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import gzip
+import os
+import shutil
+import tarfile
+import unittest
+import zipfile
+
+from nose.tools import (assert_equal, assert_raises)
+
+from pyani import pyani_archive
+
+
+class TestArchive(unittest.TestCase):
+
+    """Class defining tests of output archiving."""
+
+    def setUp(self):
+        """Write some pairwise output to archive."""
+        self.outdir = os.path.join('tests', 'test_output', 'archive',
+                                   'nucmer_output')
+        if os.path.exists(os.path.dirname(self.outdir)):
+            shutil.rmtree(os.path.dirname(self.outdir))
+        os.makedirs(self.outdir)
+        self.contents = {}  # Keyed by name in the archive
+        for idx in range(4):
+            path = os.path.join(self.outdir, 'g%d_vs_g%d.delta' % (idx,
+                                                                   idx + 1))
+            data = os.urandom(1024) * (idx + 1)
+            self.contents[os.path.relpath(path, os.path.dirname(
+                self.outdir))] = data
+            with open(path, 'wb') as ofh:
+                ofh.write(data)
+        self.blocksize = pyani_archive.ARCHIVE_BLOCKSIZE
+
+    def tearDown(self):
+        """Restore the archive block size."""
+        pyani_archive.ARCHIVE_BLOCKSIZE = self.blocksize
+
+    def make_archive(self, fmt):
+        """Archive one file as if read, then the rest of the tree."""
+        archive = pyani_archive.Archive(self.outdir, fmt, threads=2)
+        first = os.path.basename(sorted(self.contents)[0])
+        archive.add(os.path.join(self.outdir, first))
+        archive.add(os.path.join(self.outdir, '.', first))
+        archive.add_tree()
+        archive.close()
+        return archive.path
+
+    def test_gzip_archive(self):
+        """output archived as parallel-compressed .tar.gz."""
+        pyani_archive.ARCHIVE_BLOCKSIZE = 1000  # Many gzip members
+        path = self.make_archive('gzip')
+        assert_equal(path, self.outdir + '.tar.gz')
+        with gzip.open(path) as ifh:  # Multi-member stream reads as one
+            assert_equal(len(ifh.read()) % tarfile.RECORDSIZE, 0)
+        with tarfile.open(path, 'r:gz') as tfh:
+            names = tfh.getnames()
+            assert_equal(sorted(names), sorted(self.contents))
+            for name in names:
+                assert_equal(tfh.extractfile(name).read(),
+                             self.contents[name])
+
+    def test_zip_archive(self):
+        """output archived as indexed .zip."""
+        path = self.make_archive('zip')
+        assert_equal(path, self.outdir + '.zip')
+        with zipfile.ZipFile(path) as zfh:
+            assert_equal(sorted(zfh.namelist()), sorted(self.contents))
+            for name in self.contents:
+                assert_equal(zfh.read(name), self.contents[name])
+
+    def test_bad_format(self):
+        """unknown or unavailable archive formats raise ValueError."""
+        assert_raises(ValueError, pyani_archive.Archive, self.outdir, 'rar')
+        if pyani_archive.zstandard is None:
+            assert_raises(ValueError, pyani_archive.Archive, self.outdir,
+                          'zstd')
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test_backends.py
+
+Test pyani_backends.py module.
+
+These tests are intended to be run from the repository root using:
+
+nosetests -v
+
+print() statements will be caught by nosetests unless there is an
+error. They can also be recovered with the -s option.
+
+(c) The James Hutton Institute 2017
+Author: Leighton Pritchard
+
+Contact:
+leighton.pritchard@hutton.ac.uk
+
+Leighton Pritchard,
+Information and Computing Sciences,
+James Hutton Institute,
+Errol Road,
+Invergowrie,
+Dundee,
+DD6 9LH,
+Scotland,
+UK
+
+The MIT License
+
+Copyright (c) 2017 The James Hutton Institute
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import stat
+import subprocess
+import sys
+import unittest
+
+from nose.tools import (assert_equal, )
+
+from pyani import (pyani_backends, pyani_jobs, run_sge)
+
+
+# Stand-ins for sbatch, squeue and sacct. sbatch records its arguments and
+# reports sequential job IDs; squeue and sacct report the jobs listed in
+# the files squeue_jobs and sacct_jobs
+FAKE_SBATCH = """#!{python}
+import os
+import sys
+
+logfile = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])),
+                       'sbatch_calls')
+count = 0
+if os.path.exists(logfile):
+    with open(logfile) as ifh:
+        count = len(ifh.readlines())
+with open(logfile, 'a') as ofh:
+    ofh.write(' '.join(sys.argv[1:]) + '\\n')
+print('%d;cluster' % (201 + count))
+"""
+
+FAKE_REPORT = """#!/bin/sh
+cat `dirname $0`/{0}_jobs
+"""
+
+
+class TestSLURMBackend(unittest.TestCase):
+
+    """Class defining tests of the SLURM backend, with stub executables."""
+
+    def setUp(self):
+        """Set up stub SLURM executables, and a small job graph."""
+        self.outdir = os.path.join('tests', 'test_output', 'slurm')
+        run_sge.build_directories(self.outdir)
+        self.exes = {}
+        stubs = (('sbatch', FAKE_SBATCH.format(python=sys.executable)),
+                 ('squeue', FAKE_REPORT.format('squeue')),
+                 ('sacct', FAKE_REPORT.format('sacct')))
+        for exe, text in stubs:
+            self.exes[exe] = os.path.join(self.outdir, exe)
+            with open(self.exes[exe], 'w') as ofh:
+                ofh.write(text)
+            os.chmod(self.exes[exe],
+                     os.stat(self.exes[exe]).st_mode | stat.S_IEXEC)
+        if os.path.exists(os.path.join(self.outdir, 'sbatch_calls')):
+            os.remove(os.path.join(self.outdir, 'sbatch_calls'))
+        self.backend = pyani_backends.SLURMBackend(self.exes['sbatch'],
+                                                   self.exes['squeue'],
+                                                   self.exes['sacct'])
+        self.first = pyani_jobs.JobGroup('ANI_1', None,
+                                         commands=['true', 'true'])
+        self.second = pyani_jobs.JobGroup('ANI_2', None,
+                                          commands=['true', 'exit 2'],
+                                          threads=4)
+        self.second.add_task_dependency(self.first)
+        self.last = pyani_jobs.Job('ANI_3', 'true')
+        self.last.add_dependency(self.second)
+        self.jobs = [self.first, self.second, self.last]
+
+    def test_submit_jobs(self):
+        """SLURM backend submits arrays with dependencies on job IDs."""
+        run_sge.build_job_scripts(self.outdir, self.jobs, self.backend)
+        run_sge.submit_jobs(self.outdir, self.jobs, "--partition=short",
+                            backend=self.backend)
+        assert_equal([job.jobid for job in self.jobs], ['201', '202', '203'])
+        with open(os.path.join(self.outdir, 'sbatch_calls')) as ifh:
+            calls = [line.split() for line in ifh]
+        assert_equal(calls[0][0], '--parsable')
+        assert_equal(calls[0][-2:], ['--partition=short',
+                                     self.first.scriptpath])
+        assert '--array=1-2' in calls[1]
+        assert '--cpus-per-task=4' in calls[1]
+        assert '--dependency=aftercorr:201' in calls[1]
+        assert '--dependency=afterany:202' in calls[2]
+        assert '--kill-on-invalid-dep=yes' in calls[2]
+
+    def test_array_task_script(self):
+        """SLURM array tasks run their own command and write sentinels."""
+        run_sge.build_job_scripts(self.outdir, self.jobs, self.backend)
+        env = dict(os.environ)
+        env['SLURM_ARRAY_TASK_ID'] = '2'
+        subprocess.run(['bash', self.second.scriptpath], env=env)
+        with open(os.path.join(self.outdir, 'status', 'ANI_2.2')) as ifh:
+            assert_equal(ifh.read().strip(), '2')
+
+    def test_poll(self):
+        """SLURM backend polls squeue, and sacct for finished jobs."""
+        for job, jobid in zip(self.jobs, ('301', '302', '303')):
+            job.jobid = jobid
+        with open(os.path.join(self.outdir, 'squeue_jobs'), 'w') as ofh:
+            ofh.write("302 R\n302 PD\n999 R\n")
+        with open(os.path.join(self.outdir, 'sacct_jobs'), 'w') as ofh:
+            ofh.write("301_1|COMPLETED\n301_2|FAILED\n"
+                      "303|CANCELLED by 0\n")
+        outstanding = self.backend.poll(self.jobs)
+        assert_equal(outstanding, [self.second])
+        assert_equal([job.state for job in self.jobs],
+                     ['COMPLETED,FAILED', 'PD,R', 'CANCELLED'])
+        assert_equal([job.finished for job in self.jobs],
+                     [True, False, True])
+        assert self.backend.is_error_state(self.last.state)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test_dereplicate.py
+
+Test dereplicate.py module.
+
+These tests are intended to be run from the repository root using:
+
+nosetests -v
+
+print() statements will be caught by nosetests unless there is an
+error. They can also be recovered with the -s option.
+
+(c) The James Hutton Institute 2017
+Author: Leighton Pritchard
+
+Contact:
+leighton.pritchard@hutton.ac.uk
+
+Leighton Pritchard,
+Information and Computing Sciences,
+James Hutton Institute,
+Errol Road,
+Invergowrie,
+Dundee,
+DD6 9LH,
+Scotland,
+UK
+
+The MIT License
+
+Copyright (c) 2017 The James Hutton Institute
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import unittest
+
+from nose.tools import (assert_equal, assert_less)
+
+from pyani import (dereplicate, pyani_files)
+
+
+class TestDereplicate(unittest.TestCase):
+
+    """Class defining tests of greedy genome dereplication."""
+
+    def setUp(self):
+        """Define genomes in three species, with known pairwise identity."""
+        self.species = {'a1': 'a', 'a2': 'a', 'a3': 'a', 'b1': 'b',
+                        'b2': 'b', 'c1': 'c', 'c2': 'c', 'c3': 'c'}
+        self.names = sorted(self.species)
+        self.lengths = {name: 1000 for name in self.names}
+        self.compared = []
+
+    def compare(self, queries, references=None):
+        """Yield alignments: 98% identity within, 80% between species."""
+        for qname, sname in pyani_files.iter_pairs(queries, references):
+            self.compared.append((qname, sname))
+            errors = 20 if self.species[qname] == self.species[sname] \
+                else 200
+            yield qname, sname, 1000, errors
+
+    def test_clusters(self):
+        """genomes clustered by species, first genome representative."""
+        clusters, results = dereplicate.dereplicate(
+            self.names, self.lengths, self.compare, 0.95)
+        assert_equal(list(clusters), ['a1', 'b1', 'c1'])
+        assert_equal(clusters['c1'], ['c1', 'c2', 'c3'])
+        # Each genome compared only with representatives found before it
+        assert_equal(len(self.compared), 0 + 1 + 1 + 1 + 2 + 2 + 3 + 3)
+        pid = results.percentage_identity
+        assert_equal(list(pid.index), ['a1', 'b1', 'c1'])
+        assert_equal(pid.loc['c1', 'a1'], 0.8)
+        assert_equal(pid.loc['a1', 'c1'], 0.8)
+
+    def test_batches(self):
+        """clusters are the same for any batch size."""
+        expected = dereplicate.dereplicate(self.names, self.lengths,
+                                           self.compare, 0.95)[0]
+        for batchsize in (2, 3, 8):
+            clusters, results = dereplicate.dereplicate(
+                self.names, self.lengths, self.compare, 0.95,
+                batchsize=batchsize)
+            assert_equal(clusters, expected)
+            assert_equal(results.percentage_identity.loc['b1', 'c1'], 0.8)
+
+    def test_threshold(self):
+        """all genomes are representatives above within-species identity."""
+        clusters, _ = dereplicate.dereplicate(self.names, self.lengths,
+                                              self.compare, 0.99)
+        assert_equal(list(clusters), self.names)
+
+    def test_coverage(self):
+        """genomes with low alignment coverage are not clustered."""
+        self.lengths['a3'] = 4000
+        clusters, _ = dereplicate.dereplicate(self.names, self.lengths,
+                                              self.compare, 0.95,
+                                              coverage=0.5)
+        assert_equal(list(clusters), ['a1', 'a3', 'b1', 'c1'])
+
+    def test_missing(self):
+        """comparisons without output are no match, and not computed."""
+        def compare(queries, references=None):
+            """Drop comparisons of c1."""
+            return [aln for aln in self.compare(queries, references) if
+                    'c1' not in aln[:2]]
+        clusters, results = dereplicate.dereplicate(self.names, self.lengths,
+                                                    compare, 0.95)
+        assert_less(3, len(clusters))
+        assert_equal(results.percentage_identity['a1'].isnull().sum(), 1)
+
+    def test_cluster_table(self):
+        """cluster table lists duplicates with the genome they copy."""
+        clusters, _ = dereplicate.dereplicate(self.names, self.lengths,
+                                              self.compare, 0.95)
+        table = dereplicate.get_cluster_table(clusters, {'b2copy': 'b2'})
+        assert_equal(table[3:6], [('b1', 'b1'), ('b2', 'b1'),
+                                  ('b2copy', 'b1')])
+        assert_equal(len(table), len(self.names) + 1)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test_duplicates.py
+
+Test detection of input genomes with identical sequences, and copying of
+results to them.
+
+These tests are intended to be run from the repository root using:
+
+nosetests -v
+
+print() statements will be caught by nosetests unless there is an
+error. They can also be recovered with the -s option.
+
+(c) The James Hutton Institute 2017
+Author: Leighton Pritchard
+
+Contact:
+leighton.pritchard@hutton.ac.uk
+
+Leighton Pritchard,
+Information and Computing Sciences,
+James Hutton Institute,
+Errol Road,
+Invergowrie,
+Dundee,
+DD6 9LH,
+Scotland,
+UK
+
+The MIT License
+
+Copyright (c) 2017 The James Hutton Institute
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import unittest
+
+from nose.tools import assert_equal
+
+from Bio import SeqIO
+
+from pyani import (pyani_files, pyani_tools)
+
+
+class TestDuplicates(unittest.TestCase):
+
+    """Class defining tests of duplicate genome detection."""
+
+    def setUp(self):
+        """Write copies of an input genome, reformatted and reordered."""
+        self.indir = os.path.join('tests', 'test_input', 'concordance')
+        self.outdir = os.path.join('tests', 'test_output', 'duplicates')
+        os.makedirs(self.outdir, exist_ok=True)
+        self.infiles = pyani_files.get_fasta_files(self.indir)
+        self.orgs = [os.path.splitext(os.path.split(fname)[-1])[0] for
+                     fname in self.infiles]
+        records = list(SeqIO.parse(self.infiles[0], 'fasta'))
+        # Same sequences, lower case and renamed, in reverse order
+        self.copyfile = os.path.join(self.outdir, 'copy.fna')
+        for rec in records:
+            rec.seq = rec.seq.lower()
+            rec.id = 'copy_' + rec.id
+            rec.description = ''
+        SeqIO.write(records[::-1], self.copyfile, 'fasta')
+        # Sequence with a single base changed is not a duplicate
+        self.changedfile = os.path.join(self.outdir, 'changed.fna')
+        changed = records[0][:-1] + records[0][:1]
+        SeqIO.write([changed] + records[1:], self.changedfile, 'fasta')
+
+    def test_get_duplicates(self):
+        """identical genomes found, ignoring case, names and order."""
+        digests = {}
+        lengths = pyani_files.get_sequence_lengths(
+            self.infiles + [self.copyfile, self.changedfile], digests)
+        assert_equal(set(digests), set(lengths))
+        assert_equal(pyani_files.get_duplicates(digests),
+                     {'copy': self.orgs[0]})
+
+    def test_no_digests(self):
+        """sequence lengths unchanged when digests are requested."""
+        digests = {}
+        assert_equal(pyani_files.get_sequence_lengths(self.infiles),
+                     pyani_files.get_sequence_lengths(self.infiles, digests))
+
+    def test_add_duplicates(self):
+        """duplicate results copied from representative."""
+        results = pyani_tools.ANIResults(self.orgs[:2], 'ANIm')
+        results.add_pid(self.orgs[0], self.orgs[1], 0.9)
+        results.add_duplicates({'copy': self.orgs[0]})
+        pid = results.percentage_identity
+        assert_equal(list(pid.index), self.orgs[:2] + ['copy'])
+        assert_equal(list(pid.columns), self.orgs[:2] + ['copy'])
+        assert_equal(pid.loc['copy', 'copy'], 1.0)
+        assert_equal(pid.loc['copy', self.orgs[0]], 1.0)
+        assert_equal(pid.loc['copy', self.orgs[1]], 0.9)
+        assert_equal(pid.loc[self.orgs[1], 'copy'], 0.9)
+
+    def test_add_duplicates_references(self):
+        """duplicate queries and references copied in rectangular results."""
+        results = pyani_tools.ANIResults([self.orgs[0]], 'ANIm',
+                                         columns=[self.orgs[1]])
+        results.add_pid(self.orgs[0], self.orgs[1], 0.9)
+        results.add_duplicates({'qcopy': self.orgs[0],
+                                'rcopy': self.orgs[1]})
+        pid = results.percentage_identity
+        assert_equal(list(pid.index), [self.orgs[0], 'qcopy'])
+        assert_equal(list(pid.columns), [self.orgs[1], 'rcopy'])
+        assert_equal(pid.loc['qcopy', 'rcopy'], 0.9)
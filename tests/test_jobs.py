@@ -51,9 +51,10 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import subprocess
 import unittest
 
-from nose.tools import (assert_equal, )
+from nose.tools import (assert_equal, assert_raises)
 
 from pyani import (pyani_jobs, )
 
@@ -76,6 +77,23 @@ class TestJob(unittest.TestCase):
         job = pyani_jobs.Job('dummy', self.cmds[0])
         assert_equal(job.script, self.cmds[0])
 
+    def test_create_job_with_template(self):
+        """create dummy job with command template and arguments."""
+        job = pyani_jobs.Job('dummy', 'ls {0} {1}', args=('-ltrh', '.'))
+        assert_equal(job.script, 'ls -ltrh .')
+        assert_raises(AttributeError, setattr, job, 'undeclared', 1)
+
+    def test_set_job_attributes(self):
+        """set a job's command, script and script path directly."""
+        job = pyani_jobs.Job('dummy', 'ls {0} {1}', args=('-ltrh', '.'))
+        job.command = self.cmds[1]
+        assert_equal(job.script, self.cmds[1])
+        job.script = self.cmds[0]
+        assert_equal(job.command, self.cmds[0])
+        job.scriptPath = 'jobs/dummy'
+        assert_equal(job.scriptpath, 'jobs/dummy')
+        assert_equal(job.dependencies, [])
+
     def test_add_dependency(self):
         """create dummy job with dependency."""
         job1 = pyani_jobs.Job('dummy_with_dependency', self.cmds[0])
@@ -98,6 +116,14 @@ class TestJob(unittest.TestCase):
         assert_equal(0, len(job1.dependencies))
 
 
+    def test_job_threads(self):
+        """size job thread counts by estimated cost."""
+        assert_equal([pyani_jobs.get_job_threads(cost, 100, 8) for cost in
+                      (100, 50, 30, 1, 0)], [8, 4, 3, 1, 1])
+        assert_equal(pyani_jobs.get_job_threads(0, 0, 8), 8)
+        assert_equal(pyani_jobs.get_job_threads(50, 100, 1), 1)
+
+
 class TestJobGroup(unittest.TestCase):
 
     """Class defining tests of JobGroup object generation."""
@@ -142,6 +168,14 @@ class TestJobGroup(unittest.TestCase):
         assert_equal(jobgroup.script, self.p2script)
         assert_equal(4, jobgroup.tasks)
 
+    def test_commands_jobgroup(self):
+        """create jobgroup reading tasks from a command file."""
+        jobgroup = pyani_jobs.JobGroup('cmds', None,
+                                       commands=['ls -ltrh', 'echo ${PWD}'])
+        assert_equal(2, jobgroup.tasks)
+        assert_equal(jobgroup.commandfile, 'cmds.cmds')
+        assert 'ls -ltrh' not in jobgroup.script
+
     def test_add_dependency(self):
         """add jobgroup dependency."""
         jg1 = pyani_jobs.JobGroup('1d-sweep', 'cat', arguments=self.params1)
@@ -163,3 +197,46 @@ class TestJobGroup(unittest.TestCase):
         assert_equal('1d-sweep', dep.name)
         jg2.remove_dependency(dep)
         assert_equal(0, len(jg2.dependencies))
+
+
+class TestChunkJobs(unittest.TestCase):
+
+    """Class defining tests of batching jobs into chunks."""
+
+    def setUp(self):
+        """Define jobs of varying cost."""
+        self.jobs = [pyani_jobs.Job('job_%d' % idx, 'exit %d' % (idx % 2),
+                                    cost=cost, memory=cost) for
+                     idx, cost in enumerate([40, 20, 5, 5, 5, 5, 5, 5, 5, 5])]
+
+    def test_fixed_chunks(self):
+        """chunk jobs into batches of a fixed size."""
+        chunks = pyani_jobs.chunk_jobs(self.jobs, chunksize=4)
+        assert_equal([len(members) for _, members in chunks], [4, 4, 2])
+        assert_equal(chunks[0][0].name, 'job_0_chunk_4')
+        assert_equal(chunks[0][0].cost, 70)
+        assert_equal(chunks[0][0].memory, 40)
+
+    def test_auto_chunks(self):
+        """chunk jobs into batches sized from their costs."""
+        chunks = pyani_jobs.chunk_jobs(self.jobs, nchunks=5)
+        assert_equal([len(members) for _, members in chunks], [1, 1, 4, 4])
+        assert chunks[0][0] is self.jobs[0]
+
+    def test_chunk_command(self):
+        """chunk commands report the number of failed commands."""
+        chunks = pyani_jobs.chunk_jobs(self.jobs, chunksize=5)
+        assert_equal(chunks[0][0].command,
+                     "fail=0; (exit 0) || fail=$((fail + 1)); "
+                     "(exit 1) || fail=$((fail + 1)); "
+                     "(exit 0) || fail=$((fail + 1)); "
+                     "(exit 1) || fail=$((fail + 1)); "
+                     "(exit 0) || fail=$((fail + 1)); "
+                     "exit $((fail > 255 ? 255 : fail))")
+
+    def test_chunk_exit_code(self):
+        """chunk exit codes are capped, rather than wrapping to success."""
+        jobs = [pyani_jobs.Job('job_%d' % idx, 'false') for idx in range(256)]
+        chunk, _ = pyani_jobs.chunk_jobs(jobs, chunksize=256)[0]
+        assert_equal(subprocess.run(chunk.command, shell=True).returncode,
+                     255)
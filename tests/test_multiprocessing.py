@@ -54,9 +54,11 @@ THE SOFTWARE.
 import os
 import unittest
 
+from concurrent.futures import ThreadPoolExecutor
+
 from nose.tools import (assert_equal, )
 
-from pyani import (run_multiprocessing, pyani_jobs, anib)
+from pyani import (run_multiprocessing, pyani_jobs, anib, anim)
 
 
 class TestMultiprocessing(unittest.TestCase):
@@ -99,3 +101,145 @@ class TestMultiprocessing(unittest.TestCase):
                                        blastcmds)
         result = run_multiprocessing.run_dependency_graph(jobgraph)
         assert_equal(0, result)
+
+    def test_jobsets(self):
+        """module builds ordered job sets, sharing dependencies."""
+        job1 = pyani_jobs.Job('dummy_with_dependency', self.cmds[0])
+        job2 = pyani_jobs.Job('dummy_with_dependency', self.cmds[0])
+        job3 = pyani_jobs.Job('dummy_dependency', self.cmds[1])
+        job1.add_dependency(job3)
+        job2.add_dependency(job3)
+        jobsets = []
+        for job in (job1, job2):
+            jobsets = run_multiprocessing.populate_jobsets(job, jobsets,
+                                                           depth=1)
+        assert_equal([list(jobset) for jobset in jobsets],
+                     [[job1, job2], [job3]])
+
+    def test_multiprocessing_run_jobs(self):
+        """multiprocessing_run_jobs() packs multithreaded jobs."""
+        jobs = [pyani_jobs.Job('job_%d' % idx, cmd, threads=idx) for
+                idx, cmd in enumerate(self.cmdlist)]
+        jobs.append(pyani_jobs.Job('failing', 'exit 3', threads=8))
+        result = run_multiprocessing.multiprocessing_run_jobs(jobs,
+                                                              workers=2)
+        assert_equal(3, result)
+
+    def test_multiprocessing_run_jobs_memory(self):
+        """multiprocessing_run_jobs() keeps jobs within a memory budget."""
+        logfile = os.path.join(self.outdir, 'memory_budget.log')
+        if os.path.exists(logfile):
+            os.remove(logfile)
+        cmd = "echo start >> %s; sleep 0.2; echo end >> %s" % (logfile,
+                                                                logfile)
+        jobs = [pyani_jobs.Job('job_%d' % idx, cmd, memory=mem) for
+                idx, mem in enumerate([6, 6, 20])]
+        result = run_multiprocessing.multiprocessing_run_jobs(jobs,
+                                                              workers=3,
+                                                              memory=10)
+        assert_equal(0, result)
+        with open(logfile, 'r') as ifh:
+            events = [line.strip() for line in ifh]
+        assert_equal(events, ['start', 'end'] * 3)
+
+    def test_multiprocessing_run_jobs_memory_lookahead(self):
+        """multiprocessing_run_jobs() starts small jobs past a large one."""
+        logfile = os.path.join(self.outdir, 'memory_lookahead.log')
+        if os.path.exists(logfile):
+            os.remove(logfile)
+        cmd = "echo start %s >> {0}; sleep 0.3; echo end %s >> {0}".format(
+            logfile)
+        jobs = [pyani_jobs.Job(name, cmd % (name, name), memory=mem) for
+                name, mem in (('first', 6), ('large', 6), ('small', 2))]
+        result = run_multiprocessing.multiprocessing_run_jobs(jobs,
+                                                              workers=3,
+                                                              memory=10)
+        assert_equal(0, result)
+        with open(logfile, 'r') as ifh:
+            events = [line.strip() for line in ifh]
+        # The small job runs alongside the first; the large job waits for
+        # the first to free its memory
+        assert_equal(set(events[:2]), {'start first', 'start small'})
+        assert(events.index('start large') > events.index('end first'))
+
+    def test_job_queues_backfill_limit(self):
+        """JobQueues stops backfilling past a large job after a limit."""
+        started = []
+
+        class Logger(object):
+            """Records the commands started."""
+            def info(self, msg, *args):
+                started.append(msg % args)
+
+        jobs = [pyani_jobs.Job('small_%d' % idx, 'sleep 0.02 # small',
+                               memory=3) for idx in range(30)]
+        jobs.insert(1, pyani_jobs.Job('large', 'sleep 0.02 # large',
+                                      memory=8))
+        ready = run_multiprocessing.JobQueues(2, memory=10, backfill=4)
+        for job in jobs:
+            ready.enqueue(job)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            while ready.start(executor, Logger()) or len(ready.running):
+                ready.wait()
+        assert_equal(len(started), 31)
+        # The first small job, then at most four backfilled past the large
+        assert(started.index('sleep 0.02 # large') <= 5)
+
+    def test_dependency_graph_chunks(self):
+        """run_dependency_graph() runs jobs in cost-sized chunks."""
+        jobs = [pyani_jobs.Job('job_%d' % idx, 'exit %d' % (idx % 3 == 0))
+                for idx in range(30)]
+        result = run_multiprocessing.run_dependency_graph(jobs, workers=2,
+                                                          chunksize=0)
+        assert_equal(10, result)
+
+    def test_run_job_stream(self):
+        """run_job_stream() runs generated jobs, after their dependencies."""
+        outfile = os.path.join(self.outdir, 'stream_%d')
+        taken = []
+        database = pyani_jobs.Job('database', 'sleep 0.2')
+
+        def generate():
+            """Yields dependent jobs, recording how many were taken."""
+            for idx in range(20):
+                taken.append(os.path.exists(outfile % 0))
+                prerequisite = pyani_jobs.Job('write_%d' % idx,
+                                              'touch %s' % (outfile % idx))
+                job = pyani_jobs.Job('check_%d' % idx,
+                                     'test -e %s && exit %d' %
+                                     (outfile % idx, idx == 7))
+                job.add_dependency(prerequisite)
+                job.add_dependency(database)
+                yield job
+
+        for idx in range(20):
+            if os.path.exists(outfile % idx):
+                os.remove(outfile % idx)
+        jobs = generate()
+        result = run_multiprocessing.run_job_stream(jobs, workers=2,
+                                                    lookahead=4)
+        assert_equal(1, result)
+        assert_equal(len(taken), 20)
+        assert(taken[-1])  # Jobs ran before the last was generated
+        assert(database.finished)
+
+    def test_run_job_stream_order(self):
+        """run_job_stream() starts the largest generated jobs first."""
+        lengths = {'file%d' % idx: length for idx, length in
+                   enumerate([2, 12, 5, 1, 7])}
+        infiles = ['%s.fna' % name for name in sorted(lengths)]
+        started = []
+
+        class Logger(object):
+            """Records the commands started."""
+            def info(self, msg, *args):
+                started.append(msg % args)
+
+        jobs = anim.iter_nucmer_jobs(infiles, self.outdir, nucmer_exe='echo',
+                                     filter_exe='true', lengths=lengths)
+        run_multiprocessing.run_job_stream(jobs, workers=1, logger=Logger(),
+                                           lookahead=2)
+        costs = [sum(lengths[arg[:-4]] for arg in cmd.split()[-2:]) for
+                 cmd in started if cmd.startswith('echo')]
+        assert_equal(len(costs), 10)
+        assert_equal(costs, sorted(costs, reverse=True))
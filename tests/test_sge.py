@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test_sge.py
+
+Test run_sge.py module.
+
+These tests are intended to be run from the repository root using:
+
+nosetests -v
+
+print() statements will be caught by nosetests unless there is an
+error. They can also be recovered with the -s option.
+
+(c) The James Hutton Institute 2017
+Author: Leighton Pritchard
+
+Contact:
+leighton.pritchard@hutton.ac.uk
+
+Leighton Pritchard,
+Information and Computing Sciences,
+James Hutton Institute,
+Errol Road,
+Invergowrie,
+Dundee,
+DD6 9LH,
+Scotland,
+UK
+
+The MIT License
+
+Copyright (c) 2017 The James Hutton Institute
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import logging
+import os
+import stat
+import subprocess
+import sys
+import unittest
+
+from nose.tools import (assert_equal, assert_raises)
+
+from pyani import (run_sge, pyani_jobs)
+
+from fake_sge import (call_counts, make_fake_sge)
+
+
+# A stand-in for qstat -xml: each job named in the queue file is reported
+# for the number of polls given alongside it; the call count is recorded
+FAKE_QSTAT = """#!{python}
+import os
+import sys
+
+basedir = os.path.dirname(os.path.abspath(sys.argv[0]))
+countfile = os.path.join(basedir, 'qstat_calls')
+count = 0
+if os.path.exists(countfile):
+    with open(countfile) as ifh:
+        count = int(ifh.read())
+with open(countfile, 'w') as ofh:
+    ofh.write(str(count + 1))
+print('<?xml version="1.0"?>')
+print('<job_info><queue_info>')
+with open(os.path.join(basedir, 'qstat_queue')) as ifh:
+    for line in ifh:
+        name, polls, state = line.split()
+        if count < int(polls):
+            print('<job_list state="running"><JB_name>%s</JB_name>'
+                  '<state>%s</state></job_list>' % (name, state))
+print('</queue_info><job_info></job_info></job_info>')
+"""
+
+
+class TestSGEPolling(unittest.TestCase):
+
+    """Class defining tests of batched SGE status polling."""
+
+    def setUp(self):
+        """Set up a fake qstat, and jobs for it to report."""
+        self.outdir = os.path.join('tests', 'test_output', 'sge')
+        os.makedirs(self.outdir, exist_ok=True)
+        self.qstat = os.path.join(self.outdir, 'qstat')
+        with open(self.qstat, 'w') as ofh:
+            ofh.write(FAKE_QSTAT.format(python=sys.executable))
+        os.chmod(self.qstat, os.stat(self.qstat).st_mode | stat.S_IEXEC)
+        with open(os.path.join(self.outdir, 'qstat_queue'), 'w') as ofh:
+            ofh.write("job_1 1 r\njob_2 3 qw\njob_3 2 Eqw\n")
+        countfile = os.path.join(self.outdir, 'qstat_calls')
+        if os.path.exists(countfile):
+            os.remove(countfile)
+        self.jobs = [pyani_jobs.Job('job_%d' % idx, 'true') for
+                     idx in range(1, 5)]
+
+    def qstat_calls(self):
+        """Returns the number of times the fake qstat has been run."""
+        with open(os.path.join(self.outdir, 'qstat_calls')) as ifh:
+            return int(ifh.read())
+
+    def test_parse_qstat_xml(self):
+        """parse_qstat_xml() reads job states from qstat -xml output."""
+        xmltext = ('<job_info><queue_info><job_list state="running">'
+                   '<JB_job_number>11</JB_job_number>'
+                   '<JB_name>job_1</JB_name><state>r</state></job_list>'
+                   '</queue_info><job_info><job_list state="pending">'
+                   '<JB_job_number>12</JB_job_number>'
+                   '<JB_name>job_2</JB_name><state>qw</state></job_list>'
+                   '</job_info></job_info>')
+        assert_equal(run_sge.parse_qstat_xml(xmltext),
+                     {'11': {'r'}, '12': {'qw'}})
+        assert_equal(run_sge.parse_qstat_xml(xmltext, 'JB_name'),
+                     {'job_1': {'r'}, 'job_2': {'qw'}})
+
+    def test_poll_jobs(self):
+        """poll_jobs() updates all jobs from one qstat call."""
+        outstanding = run_sge.poll_jobs(self.jobs, qstat_exe=self.qstat)
+        assert_equal([job.name for job in outstanding],
+                     ['job_1', 'job_2', 'job_3'])
+        assert_equal([job.state for job in self.jobs],
+                     ['r', 'qw', 'Eqw', None])
+        assert_equal([job.finished for job in self.jobs],
+                     [False, False, False, True])
+        assert_equal(self.qstat_calls(), 1)
+
+    def test_wait_for_jobs(self):
+        """wait_for_jobs() polls once per interval for all jobs."""
+        run_sge.wait_for_jobs(self.jobs, interval=0.01, maxinterval=0.01,
+                              qstat_exe=self.qstat)
+        assert_equal([job.finished for job in self.jobs], [True] * 4)
+        assert_equal(self.qstat_calls(), 4)
+
+
+class TestSGESentinels(unittest.TestCase):
+
+    """Class defining tests of sentinel-file completion detection."""
+
+    def setUp(self):
+        """Set up job scripts, and a fake qstat reporting no jobs."""
+        self.outdir = os.path.join('tests', 'test_output', 'sge_sentinels')
+        run_sge.build_directories(self.outdir)
+        self.qstat = os.path.join(self.outdir, 'qstat')
+        with open(self.qstat, 'w') as ofh:
+            ofh.write("#!/bin/sh\necho '<job_info></job_info>'\n")
+        os.chmod(self.qstat, os.stat(self.qstat).st_mode | stat.S_IEXEC)
+        self.jobs = [pyani_jobs.Job('ok', 'true'),
+                     pyani_jobs.Job('fail', 'exit 3'),
+                     pyani_jobs.JobGroup('group', None,
+                                         commands=['true', 'exit 2'])]
+        run_sge.build_job_scripts(self.outdir, self.jobs)
+
+    def run_script(self, job, task=None):
+        """Runs the passed job's script, as SGE would."""
+        env = dict(os.environ)
+        if task is not None:
+            env['SGE_TASK_ID'] = str(task)
+        subprocess.run(['bash', job.scriptpath], env=env)
+
+    def test_sentinel_names(self):
+        """get_sentinel_names() names one sentinel per job/task."""
+        assert_equal([run_sge.get_sentinel_names(job) for job in self.jobs],
+                     [['ok'], ['fail'], ['group.1', 'group.2']])
+
+    def test_wait_for_sentinels(self):
+        """wait_for_sentinels() collects exit codes from sentinel files."""
+        self.run_script(self.jobs[0])
+        self.run_script(self.jobs[1])
+        self.run_script(self.jobs[2], 1)
+        self.run_script(self.jobs[2], 2)
+        result = run_sge.wait_for_sentinels(self.outdir, self.jobs,
+                                            interval=0.01, qstat_exe=None)
+        assert_equal(result, 5)
+        assert_equal([job.returncode for job in self.jobs], [0, 3, 2])
+
+    def test_wait_for_lost_jobs(self):
+        """wait_for_sentinels() fails jobs that leave SGE without sentinels."""
+        self.run_script(self.jobs[0])
+        self.run_script(self.jobs[2], 1)
+        result = run_sge.wait_for_sentinels(self.outdir, self.jobs,
+                                            interval=0.01, maxinterval=0.01,
+                                            qstat_exe=self.qstat)
+        assert_equal(result, 2)
+        assert_equal([job.returncode for job in self.jobs], [0, 1, 1])
+
+    def test_wait_for_late_sentinels(self):
+        """wait_for_sentinels() rescans for sentinels seen after jobs leave."""
+        self.run_script(self.jobs[0])
+        self.run_script(self.jobs[2], 1)
+        self.run_script(self.jobs[2], 2)
+        # qstat reports no jobs; the failing job's sentinel appears only
+        # after the second poll, as on a slow shared filesystem
+        calls = os.path.join(self.outdir, 'qstat.calls')
+        if os.path.exists(calls):
+            os.remove(calls)
+        with open(self.qstat, 'w') as ofh:
+            ofh.write("#!/bin/sh\necho '<job_info></job_info>'\n"
+                      "echo . >> %s\n"
+                      "if [ $(wc -l < %s) -eq 2 ]; then bash %s; fi\n" %
+                      (calls, calls, self.jobs[1].scriptpath))
+        result = run_sge.wait_for_sentinels(self.outdir, self.jobs,
+                                            interval=0.01, maxinterval=0.01,
+                                            qstat_exe=self.qstat)
+        assert_equal(result, 5)
+        assert_equal([job.returncode for job in self.jobs], [0, 3, 2])
+
+    def test_command_file_tasks(self):
+        """array tasks run their own line of the command file."""
+        outfile = os.path.join(self.outdir, 'tasks.out')
+        commands = ['echo "task %d; ok" >> %s' % (idx, outfile) for
+                    idx in range(1, 13)]
+        jobgroup = pyani_jobs.JobGroup('cmdfile', None, commands=commands)
+        run_sge.build_job_scripts(self.outdir, [jobgroup])
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        for task in (12, 1, 7):
+            self.run_script(jobgroup, task)
+        with open(outfile, 'r') as ifh:
+            assert_equal(ifh.read(), "task 12; ok\ntask 1; ok\ntask 7; ok\n")
+
+
+class TestSGEJobGroups(unittest.TestCase):
+
+    """Class defining tests of compiling dependent jobs into JobGroups."""
+
+    def setUp(self):
+        """Build ANIm-like and ANIb-like job graphs."""
+        self.anim = []
+        for idx in range(5):
+            njob = pyani_jobs.Job('n_%d' % idx, 'nucmer %d' % idx)
+            fjob = pyani_jobs.Job('f_%d' % idx, 'filter %d' % idx)
+            fjob.add_dependency(njob)
+            self.anim.extend([njob, fjob])
+        dbjobs = [pyani_jobs.Job('db_%d' % idx, 'makeblastdb %d' % idx) for
+                  idx in range(3)]
+        self.anib = list(dbjobs)
+        for idx, dbjob in enumerate(dbjobs):
+            for jdx in range(3):
+                if idx != jdx:
+                    job = pyani_jobs.Job('b_%d_%d' % (idx, jdx),
+                                         'blastn %d %d' % (idx, jdx))
+                    job.add_dependency(dbjob)
+                    self.anib.append(job)
+
+    def test_task_dependencies(self):
+        """one-to-one dependencies are held task-by-task."""
+        jobgroups = run_sge.compile_jobgroups_from_jobgraph(self.anim,
+                                                            'JG', 2)
+        assert_equal([jg.name for jg in jobgroups],
+                     ['JG_%d' % idx for idx in range(1, 7)])
+        assert_equal([jg.tasks for jg in jobgroups], [2, 2, 1, 2, 2, 1])
+        assert_equal([[dep.name for dep in jg.task_dependencies] for jg in
+                      jobgroups], [[], [], [], ['JG_1'], ['JG_2'], ['JG_3']])
+        assert_equal([jg.dependencies for jg in jobgroups], [[]] * 6)
+
+    def test_chunked_task_dependencies(self):
+        """chunked one-to-one dependencies are held task-by-task."""
+        jobgroups = run_sge.compile_jobgroups_from_jobgraph(self.anim,
+                                                            'JG', 10,
+                                                            chunksize=2)
+        assert_equal([jg.tasks for jg in jobgroups], [2, 1, 2, 1])
+        assert_equal([[dep.name for dep in jg.task_dependencies] for jg in
+                      jobgroups], [[], [], ['JG_1'], ['JG_2']])
+
+    def test_layer_dependencies(self):
+        """many-to-one dependencies are held layer-by-layer."""
+        jobgroups = run_sge.compile_jobgroups_from_jobgraph(self.anib,
+                                                            'JG', 4)
+        assert_equal([jg.tasks for jg in jobgroups], [3, 4, 2])
+        assert_equal([[dep.name for dep in jg.dependencies] for jg in
+                      jobgroups], [[], ['JG_1'], ['JG_1']])
+        assert_equal(jobgroups[1].commands[:3],
+                     ['blastn 0 1', 'blastn 0 2', 'blastn 1 0'])
+
+
+class TestSGESubmissionOrder(unittest.TestCase):
+
+    """Class defining tests of ordering jobs for submission."""
+
+    def setUp(self):
+        """Build a graph with a dependency shared by many jobs."""
+        self.dbjob = pyani_jobs.Job('db', 'makeblastdb')
+        self.jobs = [pyani_jobs.Job('b_%d' % idx, 'blastn %d' % idx) for
+                     idx in range(3)]
+        for job in self.jobs:
+            job.add_dependency(self.dbjob)
+        self.final = pyani_jobs.Job('final', 'cat')
+        self.final.add_dependency(self.jobs[1])
+
+    def test_build_joblist(self):
+        """build_joblist() includes shared dependencies once."""
+        joblist = run_sge.build_joblist(self.jobs + [self.final])
+        assert_equal([job.name for job in joblist],
+                     ['b_0', 'db', 'b_1', 'b_2', 'final'])
+
+    def test_submission_order(self):
+        """get_submission_order() submits dependencies first."""
+        ordered = run_sge.get_submission_order([self.final] + self.jobs +
+                                               [self.dbjob])
+        assert_equal([job.name for job in ordered],
+                     ['db', 'b_0', 'b_1', 'b_2', 'final'])
+
+    def test_unsubmittable(self):
+        """get_submission_order() rejects unsatisfiable dependencies."""
+        assert_raises(ValueError, run_sge.get_submission_order, self.jobs)
+
+
+# A stand-in for qsub -terse: records its arguments, one submission per
+# line, and reports sequential job IDs
+FAKE_QSUB = """#!{python}
+import os
+import sys
+
+logfile = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])),
+                       'qsub_calls')
+count = 0
+if os.path.exists(logfile):
+    with open(logfile) as ifh:
+        count = len(ifh.readlines())
+with open(logfile, 'a') as ofh:
+    ofh.write(' '.join(sys.argv[1:]) + '\\n')
+if '-t' in sys.argv:
+    print('%d.1-2:1' % (101 + count))
+else:
+    print(101 + count)
+"""
+
+
+class TestSGESubmission(unittest.TestCase):
+
+    """Class defining tests of submitting jobs with qsub."""
+
+    def setUp(self):
+        """Set up a fake qsub, and a small job graph."""
+        self.outdir = os.path.join('tests', 'test_output', 'sge_qsub')
+        run_sge.build_directories(self.outdir)
+        self.qsub = os.path.join(self.outdir, 'qsub')
+        with open(self.qsub, 'w') as ofh:
+            ofh.write(FAKE_QSUB.format(python=sys.executable))
+        os.chmod(self.qsub, os.stat(self.qsub).st_mode | stat.S_IEXEC)
+        if os.path.exists(os.path.join(self.outdir, 'qsub_calls')):
+            os.remove(os.path.join(self.outdir, 'qsub_calls'))
+        self.first = pyani_jobs.Job('ANI_1', 'true')
+        self.group = pyani_jobs.JobGroup('ANI_2', None,
+                                         commands=['true', 'true'])
+        self.last = pyani_jobs.Job('ANI_1', 'true')
+        self.last.add_dependency(self.first)
+        self.last.add_dependency(self.group)
+
+    def test_submit_jobs(self):
+        """submit_jobs() records qsub job IDs and holds on them."""
+        jobs = [self.last, self.group, self.first]
+        run_sge.build_job_scripts(self.outdir, jobs)
+        run_sge.submit_jobs(self.outdir, jobs, sgeargs="-l h_vmem=1G",
+                            qsub_exe=self.qsub)
+        assert_equal([job.jobid for job in jobs], ['103', '101', '102'])
+        with open(os.path.join(self.outdir, 'qsub_calls')) as ifh:
+            calls = [line.split() for line in ifh]
+        assert_equal(calls[0][:2], ['-terse', '-V'])
+        assert_equal(calls[0][-3:], ['-l', 'h_vmem=1G', self.group.scriptpath])
+        assert_equal(calls[2][calls[2].index('-hold_jid') + 1], '102,101')
+
+
+class TestFakeSGE(unittest.TestCase):
+
+    """Class defining end-to-end tests of the driver on a fake SGE cluster."""
+
+    def setUp(self):
+        """Set up the fake cluster, and a small ANIm-shaped job graph."""
+        self.outdir = os.path.abspath(os.path.join('tests', 'test_output',
+                                                   'fake_sge'))
+        self.spooldir = os.path.join(self.outdir, 'spool')
+        self.qsub, self.qstat = make_fake_sge(os.path.join(self.outdir,
+                                                           'bin'),
+                                              self.spooldir)
+        self.logger = logging.getLogger('test_sge')
+        self.jobs = []
+        for idx, status in enumerate([0, 0, 1, 0]):
+            job = pyani_jobs.Job('ANI_%06d-n' % idx,
+                                 'sleep 0.1; touch pair_%d; exit %d' %
+                                 (idx, status))
+            dependent = pyani_jobs.Job('ANI_%06d-f' % idx,
+                                       'test -e pair_%d' % idx)
+            dependent.add_dependency(job)
+            self.jobs.append(dependent)
+        for fname in os.listdir(self.outdir):
+            if fname.startswith('pair_'):
+                os.remove(os.path.join(self.outdir, fname))
+        self.cwd = os.getcwd()
+        os.chdir(self.outdir)
+
+    def tearDown(self):
+        """Return to the original working directory."""
+        os.chdir(self.cwd)
+
+    def test_run_dependency_graph(self):
+        """run_dependency_graph() runs a job graph on the fake cluster."""
+        result = run_sge.run_dependency_graph(self.jobs, logger=self.logger,
+                                              qsub_exe=self.qsub,
+                                              qstat_exe=self.qstat)
+        assert_equal(result, 1)
+        assert_equal(call_counts(self.spooldir), {'qsub': 2, 'qstat': 0})
+
+    def test_run_job_stream(self):
+        """run_job_stream() submits generated jobs in dependent batches."""
+        database = pyani_jobs.Job('ANI_db', 'sleep 0.2; touch pair_db')
+        for job in self.jobs:
+            job.add_dependency(database)
+            job.template += ' && test -e pair_db'
+        if os.path.exists('pair_db'):
+            os.remove('pair_db')
+        result = run_sge.run_job_stream(iter(self.jobs), logger=self.logger,
+                                        sgegroupsize=2, qsub_exe=self.qsub,
+                                        qstat_exe=self.qstat)
+        assert_equal(result, 1)
+        assert_equal(call_counts(self.spooldir)['qsub'], 5)
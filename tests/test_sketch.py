@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test_sketch.py
+
+Test sketch.py module.
+
+These tests are intended to be run from the repository root using:
+
+nosetests -v
+
+print() statements will be caught by nosetests unless there is an
+error. They can also be recovered with the -s option.
+
+(c) The James Hutton Institute 2017
+Author: Leighton Pritchard
+
+Contact:
+leighton.pritchard@hutton.ac.uk
+
+Leighton Pritchard,
+Information and Computing Sciences,
+James Hutton Institute,
+Errol Road,
+Invergowrie,
+Dundee,
+DD6 9LH,
+Scotland,
+UK
+
+The MIT License
+
+Copyright (c) 2017 The James Hutton Institute
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import random
+import unittest
+
+import numpy as np
+
+from Bio.Seq import Seq
+from nose.tools import (assert_equal, assert_less)
+
+from pyani import sketch
+
+
+class TestSketch(unittest.TestCase):
+
+    """Class defining tests of MinHash sketching."""
+
+    def setUp(self):
+        """Define sequences and input files for tests."""
+        rng = random.Random(42)
+        self.seq = ''.join([rng.choice('ACGT') for _ in range(2000)])
+        self.seqdir = os.path.join('tests', 'test_input', 'sequences')
+        self.infiles = [os.path.join(self.seqdir, fname) for fname in
+                        ('NC_002696.fna', 'NC_011916.fna')]
+
+    def test_canonical_kmers(self):
+        """sequence and reverse complement give the same k-mer hashes."""
+        revcomp = str(Seq(self.seq).reverse_complement())
+        assert_equal(set(sketch.get_kmer_hashes(self.seq, 15)),
+                     set(sketch.get_kmer_hashes(revcomp, 15)))
+
+    def test_ambiguous_kmers(self):
+        """k-mers with ambiguity symbols are skipped."""
+        seq = self.seq[:100] + 'N' + self.seq[100:200]
+        assert_equal(len(sketch.get_kmer_hashes(seq, 21)), 80 + 80)
+
+    def test_bottom_k(self):
+        """smallest distinct hashes are selected."""
+        hashes = np.array([random.randint(0, 50) for _ in range(5000)],
+                          dtype=np.uint64)
+        assert_equal(list(sketch.get_bottom_k(hashes, 20)),
+                     sorted(set(hashes))[:20])
+
+    def test_jaccard(self):
+        """estimate Jaccard index and Mash distance from sketches."""
+        sketch1 = np.arange(0, 100, dtype=np.uint64)
+        sketch2 = np.arange(50, 150, dtype=np.uint64)
+        assert_equal(sketch.get_jaccard(sketch1, sketch1, 100), 1)
+        assert_equal(sketch.get_jaccard(sketch1, sketch2, 100), 0.5)
+        assert_equal(sketch.get_mash_distance(1), 0)
+        assert_equal(sketch.get_mash_distance(0), 1)
+
+    def test_jaccards(self):
+        """estimate Jaccard indices and Mash distances for all pairs."""
+        sketches = [np.arange(0, 100, dtype=np.uint64),
+                    np.arange(50, 150, dtype=np.uint64),
+                    np.arange(0, 200, 2, dtype=np.uint64),
+                    np.zeros(0, dtype=np.uint64)]
+        jaccards = sketch.get_jaccards(sketches, sketches)
+        # Hashes up to 99: 50 of 100 shared; up to 149: 50 of 125 shared
+        assert_equal(jaccards.tolist(),
+                     [[1, 0.5, 0.5, 0], [0.5, 1, 0.4, 0],
+                      [0.5, 0.4, 1, 0], [0, 0, 0, 0]])
+        assert_equal(sketch.get_jaccards(sketches[:1],
+                                         sketches[1:]).tolist(),
+                     [[0.5, 0.5, 0]])
+        assert_equal(sketch.get_mash_distances(np.array([1, 0])).tolist(),
+                     [0, 1])
+
+    def test_shared_hashes(self):
+        """count hashes shared between sets of sketches."""
+        sketches = [np.arange(0, 10, dtype=np.uint64),
+                    np.arange(5, 20, dtype=np.uint64),
+                    np.zeros(0, dtype=np.uint64)]
+        assert_equal(sketch.get_shared_hashes(sketches, sketches).tolist(),
+                     [[10, 5, 0], [5, 15, 0], [0, 0, 0]])
+        assert_equal(sketch.get_shared_hashes(sketches[:1],
+                                              sketches[1:]).tolist(),
+                     [[5, 0]])
+
+    def test_pruned_pairs(self):
+        """prune pairs of genomes with low estimated ANI."""
+        sketches = sketch.get_sketches(self.infiles)
+        assert_equal(sorted(sketches), ['NC_002696', 'NC_011916'])
+        jaccard = sketch.get_jaccard(sketches['NC_002696'],
+                                     sketches['NC_011916'])
+        assert_less(sketch.get_mash_distance(jaccard), 0.01)
+        assert_equal(sketch.get_pruned_pairs(sketches, 0.8), set())
+        sketches['random'] = sketch.get_bottom_k(
+            sketch.get_kmer_hashes(self.seq))
+        assert_equal(sketch.get_pruned_pairs(sketches, 0.8),
+                     {frozenset(('NC_002696', 'random')),
+                      frozenset(('NC_011916', 'random'))})